@@ -0,0 +1,167 @@
+# autopost.py
+"""
+Единый планировщик автосообщений.
+
+Вместо run_repeating на каждый чат держим одну кучу (heap) с ближайшим
+реальным сроком каждого чата: last_message_time + AUTOPOST_IDLE, но не
+раньше конца мьюта. Праздничные поздравления рассылает HolidayBroadcast.
+
+Активность в чате только сдвигает срок в словаре; запись в куче
+переставляется лениво, когда до неё доходит очередь, поэтому на чат
+приходится не больше одной живой записи. Фоновая задача спит до
+ближайшего срока и запускает job только для чатов, которым действительно пора.
+
+После перезапуска сохранённые чаты ставятся в расписание по колонкам
+persistence (last_active, autopost_enabled, muted_until), без загрузки
+chat_data. Сроки, прошедшие, пока бот не работал, разносятся случайно по
+startup_spread секундам, чтобы не разбудить все чаты разом.
+"""
+import asyncio
+import heapq
+import logging
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional
+
+from dispatcher import DispatchDropped
+from metrics import AUTOPOST_LAG_SECONDS
+
+# Сколько чат должен молчать, чтобы бот написал сам
+AUTOPOST_IDLE = timedelta(days=1)
+
+
+def _utc_ts(value: datetime) -> float:
+    """Время из chat_data (naive UTC) в unix timestamp."""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class AutopostScheduler:
+    """One deadline heap for all chats instead of a repeating job per chat."""
+
+    def __init__(self, job_queue, default_interval: int = 3600, startup_spread: float = 1800):
+        self.job_queue = job_queue
+        self.default_interval = default_interval
+        self.startup_spread = startup_spread
+        self.callback: Optional[Callable] = None
+        self.fired = 0
+        self._deadlines: Dict[int, float] = {}  # реальный срок чата
+        self._queued: Dict[int, float] = {}  # срок живой записи чата в куче
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def next_deadline(self, chat_data: dict, min_delay: float = 0) -> Optional[float]:
+        """Ближайший момент, когда чату может понадобиться сообщение от бота."""
+        if not chat_data.get("autopost_enabled", True):
+            return None
+        now = time.time()
+        last = chat_data.get("last_message_time")
+        if last is not None:
+            autopost = _utc_ts(last + AUTOPOST_IDLE)
+        else:
+            autopost = now + chat_data.get("autopost_interval", self.default_interval)
+        muted_until = chat_data.get("muted_until")
+        if muted_until is not None:
+            autopost = max(autopost, _utc_ts(muted_until))
+        return max(autopost, now + min_delay)
+
+    def touch(self, chat_id: int, chat_data: dict, min_delay: float = 0) -> None:
+        """Пересчитывает срок чата после активности или смены настроек."""
+        deadline = self.next_deadline(chat_data, min_delay)
+        if deadline is None:
+            self.remove(chat_id)
+            return
+        self.schedule(chat_id, deadline)
+
+    def seed(
+        self,
+        chat_id: int,
+        last_active: Optional[float],
+        autopost_enabled: Optional[bool] = None,
+        muted_until: Optional[float] = None,
+    ) -> None:
+        """Ставит в расписание сохранённый чат, не загружая его chat_data."""
+        # None — колонка не заполнена (строка записана старой версией)
+        chat_data = {"autopost_enabled": autopost_enabled is None or bool(autopost_enabled)}
+        if last_active is not None:
+            chat_data["last_message_time"] = datetime.utcfromtimestamp(last_active)
+        if muted_until is not None:
+            chat_data["muted_until"] = datetime.utcfromtimestamp(muted_until)
+        deadline = self.next_deadline(chat_data)
+        if deadline is None:
+            return
+        now = time.time()
+        if deadline <= now:
+            deadline = now + random.uniform(0, self.startup_spread)
+        self.schedule(chat_id, deadline)
+
+    def schedule(self, chat_id: int, deadline: float) -> None:
+        self._deadlines[chat_id] = deadline
+        queued = self._queued.get(chat_id)
+        if queued is None or deadline < queued:
+            self._queued[chat_id] = deadline
+            heapq.heappush(self._heap, (deadline, chat_id))
+            if self._heap[0][1] == chat_id:
+                self._wakeup.set()
+
+    def remove(self, chat_id: int) -> None:
+        self._deadlines.pop(chat_id, None)
+        self._queued.pop(chat_id, None)
+
+    def start(self, callback: Callable) -> None:
+        self.callback = callback
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            when, chat_id = self._heap[0]
+            delay = when - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            heapq.heappop(self._heap)
+            if self._queued.get(chat_id) != when:
+                continue  # устаревшая запись
+            deadline = self._deadlines[chat_id]
+            if deadline > time.time():
+                # Срок сдвинулся активностью чата — переставляем запись
+                self._queued[chat_id] = deadline
+                heapq.heappush(self._heap, (deadline, chat_id))
+                continue
+            self.remove(chat_id)
+            self.fired += 1
+            self.job_queue.run_once(self._fire, 0, chat_id=chat_id, data=deadline, name=f"autopost:{chat_id}")
+
+    async def _fire(self, context) -> None:
+        chat_id = context.job.chat_id
+        # Насколько позже срока чат реально дошёл до колбэка (куча + job queue)
+        AUTOPOST_LAG_SECONDS.observe(max(time.time() - context.job.data, 0.0))
+        try:
+            if context.chat_data.get("autopost_enabled", True):
+                await self.callback(context)
+        except DispatchDropped as e:
+            # Очередь LLM переполнена — ожидаемая обратная связь, попробуем в следующий срок
+            logging.info(f"[AUTOPOST] Chat {chat_id} skipped: {e}")
+        except Exception:
+            logging.exception(f"[AUTOPOST] Scheduled check failed for chat {chat_id}")
+        # Не раньше чем через autopost_interval: защита от холостых повторов
+        interval = context.chat_data.get("autopost_interval", self.default_interval)
+        self.touch(chat_id, context.chat_data, min_delay=interval)
@@ -0,0 +1,95 @@
+# bench_matcher.py
+"""
+Бенчмарк поиска текстовых признаков сообщения.
+
+Сравнивает прежние проверки (несколько lower(), LAUGHTER_PATTERN и
+any(word in text) по каждому списку слов) с одним проходом TextMatcher.
+С --extra-words словари раздуваются случайными словами, чтобы показать,
+как цена сообщения зависит от размера словарей.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_matcher [--messages 200000] [--extra-words 0 200 2000]
+"""
+import argparse
+import random
+import re
+import time
+
+from text_matcher import TextMatcher
+from utils.constants import TEXT_LEXICONS
+
+BOT_USERNAME = "robert_bot"
+WORDS = [
+    "привет", "как", "дела", "ахах", "роберт", "ну", "да", "нет", "жесть", "топ", "лол", "пиздец", "ок",
+    "хахаха", "Спасибо", "@robert_bot", "помощь", "сегодня", "погода", "работа", "смешно", "ужас",
+]
+LAUGHTER_PATTERN = re.compile(r"\b(ха|хах|ахах)+\b", re.IGNORECASE)
+LETTERS = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+
+
+def make_corpus(n: int, seed: int = 0) -> list:
+    rnd = random.Random(seed)
+    return [" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 20))) for _ in range(n)]
+
+
+def make_lexicons(extra_words: int, seed: int = 0) -> dict:
+    rnd = random.Random(seed)
+    lexicons = {feature: list(words) for feature, words in TEXT_LEXICONS.items()}
+    features = list(lexicons)
+    for _ in range(extra_words):
+        word = "".join(rnd.choice(LETTERS) for _ in range(rnd.randint(4, 10)))
+        lexicons[rnd.choice(features)].append(word)
+    lexicons["mention"].append("@" + BOT_USERNAME)
+    lexicons["bot_tag"] = ["@" + BOT_USERNAME]
+    return lexicons
+
+
+def scan_naive(text: str, lexicons: dict) -> set:
+    """Проверки в том виде, как они были разбросаны по handle_message / Scorer / реакциям."""
+    hits = set()
+    lower_text = text.lower()  # handle_message
+    if "@" + BOT_USERNAME in lower_text and any(k in lower_text for k in lexicons["help"]):
+        hits.add("help")
+    lower_text = text.lower()  # Scorer.evaluate
+    if any(word in lower_text for word in lexicons["mention"]):
+        hits.add("mention")
+    if LAUGHTER_PATTERN.search(text):
+        hits.add("laughter")
+    lower_text = text.lower()  # _maybe_add_reaction
+    for feature in ("react_funny", "react_love", "react_shock"):
+        if any(word in lower_text for word in lexicons[feature]):
+            hits.add(feature)
+    return hits
+
+
+def bench(corpus: list, scan) -> float:
+    start = time.perf_counter()
+    for text in corpus:
+        scan(text)
+    return (time.perf_counter() - start) / len(corpus)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--extra-words", type=int, nargs="+", default=[0, 200, 2000])
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.messages)
+    for extra in args.extra_words:
+        lexicons = make_lexicons(extra)
+        size = sum(len(words) for words in lexicons.values())
+        matcher = TextMatcher(lexicons)
+        for name, scan in (
+            ("naive checks", lambda text: scan_naive(text, lexicons)),
+            ("TextMatcher.scan", matcher.scan),
+        ):
+            per_message = bench(corpus, scan)
+            print(
+                f"{size:5d} words  {name:18s} {per_message * 1e6:8.2f} us/message  "
+                f"{1 / per_message:12,.0f} messages/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# bench_scoring.py
+"""
+Микробенчмарк стоимости оценки одного сообщения в Scorer.
+
+Сравнивает долгоживущий Scorer из chat_data (Scorer.for_chat) с тем, как
+было раньше: новый Scorer на каждое сообщение поверх того же, накопленного
+за прошлые сообщения chat_data['scoring'].
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_scoring [--messages 200000]
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from scoring import Scorer
+
+BOT_ID = 1
+BOT_USERNAME = "robert_bot"
+WORDS = ["привет", "как", "дела", "ахах", "роберт", "ну", "да", "нет", "жесть", "топ", "лол", "пиздец", "ок"]
+
+
+def make_updates(n: int, users: int = 50, seed: int = 0) -> list:
+    rnd = random.Random(seed)
+    updates = []
+    for message_id in range(1, n + 1):
+        reply_to = None
+        if message_id > 1 and rnd.random() < 0.2:
+            reply_to = SimpleNamespace(
+                message_id=rnd.randint(max(1, message_id - 50), message_id - 1),
+                from_user=SimpleNamespace(id=rnd.choice([BOT_ID, 100 + rnd.randrange(users)])),
+            )
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12)))
+        message = SimpleNamespace(
+            message_id=message_id,
+            text=text,
+            from_user=SimpleNamespace(id=100 + rnd.randrange(users)),
+            reply_to_message=reply_to,
+        )
+        updates.append(SimpleNamespace(message=message))
+    return updates
+
+
+def bench(updates: list, persistent: bool) -> float:
+    chat_data = {}
+    start = time.perf_counter()
+    for update in updates:
+        if persistent:
+            scorer = Scorer.for_chat(chat_data, BOT_USERNAME, BOT_ID)
+        else:
+            scorer = Scorer(BOT_USERNAME, BOT_ID, chat_data.setdefault("scoring", {}))
+        scorer.evaluate(update)
+        if not persistent:
+            # Прежний Scorer хранил счётчики прямо в chat_data['scoring']
+            chat_data["scoring"]["message_counter"] = scorer.message_counter
+            chat_data["scoring"]["last_streak_response_time"] = scorer.last_streak_response_time
+    return (time.perf_counter() - start) / len(updates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000)
+    args = parser.parse_args()
+
+    updates = make_updates(args.messages)
+    for name, persistent in (("persistent Scorer.for_chat", True), ("Scorer per message (old)", False)):
+        per_message = bench(updates, persistent)
+        print(f"{name:28s} {per_message * 1e6:8.2f} us/message  {1 / per_message:12,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
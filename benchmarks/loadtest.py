@@ -0,0 +1,371 @@
+# loadtest.py
+"""
+Нагрузочный тест бота без Telegram и DeepSeek.
+
+Поднимает в отдельном процессе заглушку OpenAI-совместимого API
+(задержка — логнормальная с медианой --llm-latency, доля ошибок 500/429,
+стриминг по словам), собирает настоящее приложение через
+main.build_application с фейковым ExtBot, который не ходит в сеть, а
+записывает вызовы Bot API, и прогоняет через очередь апдейтов
+синтетическую переписку или реплей из JSONL.
+
+В конце печатает:
+- пропускную способность (апдейтов в секунду до конца обработки);
+- перцентили задержки ответа (апдейт -> sendMessage с reply на него);
+- число вызовов LLM на 1000 сообщений и вызовы Bot API по методам;
+- сколько чатов SQLitePersistence записала во временную базу (если ни
+  одного — тест падает: значит, сброс persistence сломан).
+
+Формат реплея — по объекту на строку:
+    {"chat_id": -100, "user_id": 7, "username": "vasya", "text": "...", "reply_to_bot": false}
+
+Запуск из корня репозитория:
+    python -m benchmarks.loadtest [--messages 5000] [--chats 50] [--rate 200]
+    python -m benchmarks.loadtest --replay chat.jsonl --llm-latency 800 --llm-error-rate 0.02
+    python -m benchmarks.loadtest --llm-error-rate 0.3 --backup-latency 300
+
+С --backup-latency поднимается вторая заглушка (без ошибок) на порту
+--port + 1 и подключается вторым бэкендом LLMRouter — так проверяется
+выбор бэкенда по задержке и переключение при сбоях основного.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterator, List, Optional
+
+from telegram import Update
+from telegram.ext import ExtBot
+
+BOT_ID = 1
+BOT_USERNAME = "robert_loadtest_bot"
+WORDS = [
+    "привет", "как", "дела", "ну", "да", "нет", "жесть", "топ", "лол", "ок", "сегодня", "погода",
+    "работа", "смешно", "ужас", "спасибо", "го", "пиво", "кто", "где", "завтра", "ахах",
+]
+STUB_REPLY = "ну такое себе братан жиза ваще кринж но топ".split()
+
+
+# --- заглушка LLM ---
+
+def _stub_main(port: int, latency: float, sigma: float, error_rate: float, rate_limit_rate: float,
+               no_response_rate: float, chunk_delay: float, calls, errors, ready) -> None:
+    import tornado.web
+
+    class CompletionsHandler(tornado.web.RequestHandler):
+        async def post(self) -> None:
+            with calls.get_lock():
+                calls.value += 1
+            data = json.loads(self.request.body)
+            await asyncio.sleep(random.lognormvariate(math.log(latency), sigma) if latency > 0 else 0)
+            roll = random.random()
+            if roll < error_rate + rate_limit_rate:
+                with errors.get_lock():
+                    errors.value += 1
+                self.set_status(500 if roll < error_rate else 429)
+                return
+            if random.random() < no_response_rate:
+                words = ["NO_RESPONSE"]
+            else:
+                words = random.sample(STUB_REPLY, random.randint(2, len(STUB_REPLY)))
+            usage = {"prompt_tokens": 100, "prompt_cache_hit_tokens": 60, "prompt_cache_miss_tokens": 40,
+                     "completion_tokens": len(words)}
+            if not data.get("stream"):
+                self.write({"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}],
+                            "usage": usage})
+                return
+            self.set_header("Content-Type", "text/event-stream")
+            for i, word in enumerate(words):
+                delta = {"content": (" " if i else "") + word}
+                self.write(f"data: {json.dumps({'choices': [{'delta': delta}]})}\n\n")
+                await self.flush()
+                await asyncio.sleep(chunk_delay)
+            self.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+            self.write("data: [DONE]\n\n")
+
+    async def serve() -> None:
+        tornado.web.Application([(r"/v1/chat/completions", CompletionsHandler)]).listen(port, "127.0.0.1")
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+# --- фейковый Telegram ---
+
+class FakeBot(ExtBot):
+    """ExtBot that records Bot API calls instead of sending them."""
+
+    def __init__(self, *args, latency: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loadtest = {"latency": latency, "calls": Counter(), "sent": [], "next_id": defaultdict(int)}
+
+    def new_message_id(self, chat_id: int) -> int:
+        self._loadtest["next_id"][chat_id] += 1
+        return self._loadtest["next_id"][chat_id]
+
+    @property
+    def calls(self) -> Counter:
+        return self._loadtest["calls"]
+
+    @property
+    def sent(self) -> list:
+        """(время, chat_id, message_id бота, message_id, на который ответили)."""
+        return self._loadtest["sent"]
+
+    def _message(self, chat_id: int, message_id: int, text: str) -> dict:
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Роберт", "username": BOT_USERNAME},
+            "text": text,
+        }
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs):
+        self._loadtest["calls"][endpoint] += 1
+        if self._loadtest["latency"]:
+            await asyncio.sleep(self._loadtest["latency"])
+        if endpoint == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Роберт", "username": BOT_USERNAME}
+        if endpoint == "sendMessage":
+            chat_id = int(data["chat_id"])
+            message_id = self.new_message_id(chat_id)
+            reply = data.get("reply_parameters")
+            reply_to = None
+            if reply is not None:
+                reply_to = reply["message_id"] if isinstance(reply, dict) else reply.message_id
+            self.sent.append((time.perf_counter(), chat_id, message_id, reply_to))
+            return self._message(chat_id, message_id, data.get("text", ""))
+        if endpoint == "editMessageText":
+            return self._message(int(data["chat_id"]), int(data["message_id"]), data.get("text", ""))
+        return True
+
+
+# --- источники сообщений ---
+
+def synthetic_messages(n: int, chats: int, users: int, seed: int) -> Iterator[dict]:
+    rnd = random.Random(seed)
+    for _ in range(n):
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(1, 12))]
+        roll = rnd.random()
+        if roll < 0.05:
+            words.insert(0, "роберт")
+        elif roll < 0.07:
+            words = ["хахахаха"]
+        yield {
+            "chat_id": -1000 - rnd.randrange(chats),
+            "user_id": 100 + rnd.randrange(users),
+            "text": " ".join(words),
+            "reply_to_bot": rnd.random() < 0.03,
+        }
+
+
+def replay_messages(path: str) -> Iterator[dict]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def make_update(update_id: int, item: dict, bot: FakeBot, bot_messages: Dict[int, List[int]]) -> Update:
+    chat_id = int(item["chat_id"])
+    user_id = int(item["user_id"])
+    message = {
+        "message_id": bot.new_message_id(chat_id),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private", "title": "loadtest"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "user",
+                 "username": item.get("username") or f"user{user_id}"},
+        "text": item["text"],
+    }
+    if item.get("reply_to_bot") and bot_messages.get(chat_id):
+        message["reply_to_message"] = bot._message(chat_id, bot_messages[chat_id][-1], "...")
+    return Update.de_json({"update_id": update_id, "message": message}, bot)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- прогон ---
+
+async def run(args, stub_port: int, llm_calls, llm_errors) -> None:
+    from main import build_application
+    from metrics import UPDATE_SECONDS
+    from services import SERVICES
+
+    # main настраивает INFO-логи; на тысячах сообщений они забивают вывод и сам замер
+    logging.getLogger().setLevel(args.log_level)
+
+    bot = FakeBot("123456:LOADTEST", latency=args.tg_latency / 1000)
+    application = build_application(updater=False, bot=bot)
+    await application.initialize()
+    await application.post_init(application)
+    # Праздничная рассылка по всем чатам исказила бы замер
+    for name in ("holiday_broadcast", "holiday_broadcast_startup"):
+        for job in application.job_queue.get_jobs_by_name(name):
+            job.schedule_removal()
+    await application.start()
+    messenger = SERVICES["messenger"]
+
+    source = (
+        replay_messages(args.replay) if args.replay
+        else synthetic_messages(args.messages, args.chats, args.users, args.seed)
+    )
+    injected_at: Dict[tuple, float] = {}
+    chats = set()
+    bot_messages: Dict[int, List[int]] = defaultdict(list)
+    handled_before = UPDATE_SECONDS.count
+    n = 0
+    start = time.perf_counter()
+    seen = 0
+    for n, item in enumerate(source, 1):
+        # Сообщения бота, на которые синтетика может ответить реплаем
+        for _, chat_id, message_id, _ in bot.sent[seen:]:
+            bot_messages[chat_id].append(message_id)
+        seen = len(bot.sent)
+        update = make_update(n, item, bot, bot_messages)
+        chats.add(update.message.chat_id)
+        injected_at[(update.message.chat_id, update.message.message_id)] = time.perf_counter()
+        await application.update_queue.put(update)
+        if args.rate:
+            delay = start + n / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif n % 100 == 0:
+            await asyncio.sleep(0)
+    while UPDATE_SECONDS.count - handled_before < n:
+        await asyncio.sleep(0.01)
+    handled = time.perf_counter() - start
+
+    # Дождаться ответов, которые ещё в пути (склейка, очередь LLM, очередь отправки)
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline and (
+        messenger._pending_batches or messenger.dispatcher.active or messenger.dispatcher.depth()
+        or messenger.sender.depth()
+    ):
+        await asyncio.sleep(0.05)
+    pending_jobs = [job for job in application.job_queue.jobs() if not (job.name or "").startswith("holiday")]
+
+    latencies = [
+        sent_at - injected_at[(chat_id, reply_to)]
+        for sent_at, chat_id, _, reply_to in bot.sent
+        if (chat_id, reply_to) in injected_at
+    ]
+    tiering = SERVICES.get("tiering")
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    with sqlite3.connect(os.environ["PERSISTENCE_PATH"]) as conn:
+        persisted = conn.execute("SELECT COUNT(*) FROM chat_data").fetchone()[0]
+        bot_keys = [key for key, in conn.execute("SELECT key FROM bot_data")]
+
+    print(f"messages:            {n}")
+    print(f"handled in:          {handled:.2f} s  ({n / handled:,.0f} updates/s)")
+    print(f"replies:             {len(latencies)}")
+    if latencies:
+        print(
+            "reply latency:       "
+            + ", ".join(f"p{int(q * 100)} {percentile(latencies, q) * 1000:.0f} ms" for q in (0.5, 0.95, 0.99))
+        )
+    print(f"LLM calls:           {llm_calls.value} ({llm_calls.value * 1000 / max(n, 1):.1f} per 1k messages), "
+          f"errors {llm_errors.value}")
+    print(f"Bot API calls:       {dict(bot.calls)}")
+    print(f"send queue:          {messenger.sender.stats}")
+    print(f"LLM dispatcher:      dropped {messenger.dispatcher.dropped}, completed {messenger.dispatcher.completed}")
+    for line in messenger.llm.summary():
+        print(f"  {line}")
+    print(f"delayed replies:     {messenger.delayed_stats}")
+    if tiering is not None:
+        print(f"cold chats:          {tiering.summary()}")
+    print(f"jobs still pending:  {len(pending_jobs)} (delayed replies, autoposts)")
+    print(f"persisted:           {persisted}/{len(chats)} chats, bot_data keys {bot_keys}")
+    if chats and not persisted:
+        raise RuntimeError("Persistence flushed no chats")
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000, help="синтетических сообщений")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=20, help="пользователей на весь прогон")
+    parser.add_argument("--replay", help="JSONL с сообщениями вместо синтетики")
+    parser.add_argument("--rate", type=float, default=0, help="сообщений в секунду (0 — как можно быстрее)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency", type=float, default=500, help="медиана задержки LLM, мс")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="разброс логнормальной задержки")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--llm-429-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--llm-no-response-rate", type=float, default=0.1)
+    parser.add_argument("--llm-chunk-delay", type=float, default=0.02, help="пауза между чанками стрима, с")
+    parser.add_argument("--tg-latency", type=float, default=30, help="задержка фейкового Bot API, мс")
+    parser.add_argument("--tg-global-rate", type=float, default=30, help="общий лимит Bot API в секунду")
+    parser.add_argument("--tg-group-rate", type=float, default=20, help="лимит сообщений в группу в минуту")
+    parser.add_argument("--drain", type=float, default=30, help="сколько ждать ответы после обработки, с")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--port", type=int, default=18080, help="порт заглушки LLM")
+    parser.add_argument("--backup-latency", type=float, help="медиана задержки второго бэкенда, мс")
+    args = parser.parse_args(argv)
+
+    os.environ.update({
+        "LLM_URL": f"http://127.0.0.1:{args.port}/v1/chat/completions",
+        "DEEPSEEK_API_KEY": "loadtest",
+        "LLM_HTTP2": "0",
+        "PERSISTENCE_PATH": os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "bot_data.sqlite3"),
+        "TG_GROUP_RATE_PER_MIN": str(args.tg_group_rate),
+        "TG_GLOBAL_RATE": str(args.tg_global_rate),
+    })
+    if args.backup_latency is not None:
+        os.environ.update({
+            "LLM_BACKENDS": "deepseek,backup",
+            "LLM_BACKUP_URL": f"http://127.0.0.1:{args.port + 1}/v1/chat/completions",
+        })
+    else:
+        os.environ.pop("LLM_BACKENDS", None)
+    os.environ.pop("METRICS_PORT", None)
+    os.environ.pop("RESPONSE_CACHE_PATH", None)
+
+    llm_calls = multiprocessing.Value("q", 0)
+    llm_errors = multiprocessing.Value("q", 0)
+    ready = multiprocessing.Event()
+    stub = multiprocessing.Process(
+        target=_stub_main,
+        args=(args.port, args.llm_latency / 1000, args.llm_sigma, args.llm_error_rate, args.llm_429_rate,
+              args.llm_no_response_rate, args.llm_chunk_delay, llm_calls, llm_errors, ready),
+        daemon=True,
+    )
+    stubs = [stub]
+    if args.backup_latency is not None:
+        backup_ready = multiprocessing.Event()
+        stubs.append(multiprocessing.Process(
+            target=_stub_main,
+            args=(args.port + 1, args.backup_latency / 1000, args.llm_sigma, 0.0, 0.0,
+                  args.llm_no_response_rate, args.llm_chunk_delay, llm_calls, llm_errors, backup_ready),
+            daemon=True,
+        ))
+        stubs[-1].start()
+        backup_ready.wait(10)
+    stub.start()
+    ready.wait(10)
+    try:
+        asyncio.run(run(args, args.port, llm_calls, llm_errors))
+    finally:
+        for process in stubs:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
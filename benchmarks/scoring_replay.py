@@ -0,0 +1,260 @@
+# scoring_replay.py
+"""
+Офлайн-реплей политики Scorer.evaluate по истории чатов.
+
+Лог (экспорт Telegram Desktop result.json или JSONL) один раз разбирается
+в колоночные массивы NumPy: чат, автор, время, признаки «смех»,
+«упоминание», «реплай боту». Признаки считаются тем же TextMatcher, что и
+в боте, и их можно сохранить в .npz (--save), чтобы следующие прогоны
+стартовали сразу с массивов.
+
+Дальше политика считается пачкой для каждой точки сетки параметров:
+- стрики — векторно: сортировка по (чат, автор, время) делается один раз,
+  для каждого окна остаются diff и cumsum;
+- номер сообщения в чате (проверка count % N) — тоже векторно;
+- кулдаун отложенных ответов последовательный по природе, поэтому цикл
+  идёт только по принятым ответам: следующий кандидат ищется через
+  searchsorted, а не перебором всех сообщений.
+
+Для каждой точки печатается, сколько было бы немедленных ответов (вызов
+LLM), отложенных ответов (вызов LLM), ответов на смех (без LLM) и
+контекстных проверок.
+
+Счётчики ответов/реакций на сообщение (reply_counts >= 2, реплай +
+реакция) в реплее не участвуют: evaluate смотрит на них в момент прихода
+самого сообщения, когда ответов на него ещё нет. Задержка отложенного
+ответа (60 с) на число вызовов не влияет.
+
+Нужен numpy (в зависимости бота не входит, лежит в benchmarks/requirements.txt):
+    pip install -r benchmarks/requirements.txt
+
+Запуск из корня репозитория:
+    python -m benchmarks.scoring_replay result.json --bot-username robert_bot --bot-id 123
+    python -m benchmarks.scoring_replay chats.jsonl --save chats.npz
+    python -m benchmarks.scoring_replay chats.npz --window 60 120 300 --min-streak 2 3 4 --cooldown 60 180 600
+    python -m benchmarks.scoring_replay --synthetic 2000000
+
+Формат JSONL — по сообщению на строку:
+    {"chat_id": -100, "message_id": 5, "user_id": 7, "ts": 1700000000, "text": "...", "reply_to": 3}
+"""
+import argparse
+import itertools
+import json
+import re
+import time
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+
+from text_matcher import LAUGHTER, MENTION, matcher_for
+
+COLUMNS = ("chat", "user", "ts", "laughter", "mention", "direct_reply")
+
+
+def _telegram_export_messages(data: dict) -> Iterator[Tuple[int, dict]]:
+    """(chat_id, message) из экспорта одного чата или всего аккаунта."""
+    chats = data["chats"]["list"] if "chats" in data else [data]
+    for chat in chats:
+        for message in chat.get("messages", ()):
+            if message.get("type") == "message":
+                yield chat.get("id", 0), message
+
+
+def _export_text(text) -> str:
+    if isinstance(text, str):
+        return text
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+
+
+def _export_user(from_id) -> int:
+    digits = re.sub(r"\D", "", str(from_id or ""))
+    return int(digits) if digits else 0
+
+
+def load_log(path: str, bot_username: str, bot_id: int) -> Dict[str, np.ndarray]:
+    """Читает лог в колонки COLUMNS, сообщения бота отбрасываются."""
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        rows = (
+            {
+                "chat_id": chat_id,
+                "message_id": message["id"],
+                "user_id": _export_user(message.get("from_id")),
+                "ts": float(message.get("date_unixtime") or 0),
+                "text": _export_text(message.get("text", "")),
+                "reply_to": message.get("reply_to_message_id"),
+            }
+            for chat_id, message in _telegram_export_messages(data)
+        )
+    else:
+        f = open(path, encoding="utf-8")
+        rows = (json.loads(line) for line in f if line.strip())
+
+    matcher = matcher_for(bot_username)
+    authors: Dict[Tuple[int, int], int] = {}
+    columns = {name: [] for name in COLUMNS}
+    for row in rows:
+        chat_id = int(row["chat_id"])
+        user_id = int(row["user_id"])
+        authors[(chat_id, int(row.get("message_id", 0)))] = user_id
+        if user_id == bot_id:
+            continue  # свои сообщения бот не оценивает
+        features = matcher.scan(row.get("text") or "")
+        reply_to = row.get("reply_to")
+        direct = bool(row.get("reply_to_bot")) or (
+            reply_to is not None and authors.get((chat_id, int(reply_to))) == bot_id
+        )
+        columns["chat"].append(chat_id)
+        columns["user"].append(user_id)
+        columns["ts"].append(float(row["ts"]))
+        columns["laughter"].append(LAUGHTER in features)
+        columns["mention"].append(MENTION in features)
+        columns["direct_reply"].append(direct)
+    if not path.endswith(".json"):
+        f.close()
+    return {
+        "chat": np.asarray(columns["chat"], dtype=np.int64),
+        "user": np.asarray(columns["user"], dtype=np.int64),
+        "ts": np.asarray(columns["ts"], dtype=np.float64),
+        "laughter": np.asarray(columns["laughter"], dtype=bool),
+        "mention": np.asarray(columns["mention"], dtype=bool),
+        "direct_reply": np.asarray(columns["direct_reply"], dtype=bool),
+    }
+
+
+def synthetic_log(n: int, chats: int = 500, users: int = 20, seed: int = 0) -> Dict[str, np.ndarray]:
+    """Случайный лог для проверки скорости: всплески сообщений от одних и тех же авторов."""
+    rng = np.random.default_rng(seed)
+    chat = rng.integers(0, chats, n)
+    ts = np.sort(rng.uniform(0, 30 * 86400, n))
+    # Половина сообщений — продолжение «очереди» предыдущего автора
+    user = rng.integers(0, users, n)
+    repeat = rng.random(n) < 0.5
+    user[1:][repeat[1:]] = user[:-1][repeat[1:]]
+    return {
+        "chat": chat.astype(np.int64),
+        "user": (chat * users + user).astype(np.int64),
+        "ts": ts,
+        "laughter": rng.random(n) < 0.03,
+        "mention": rng.random(n) < 0.02,
+        "direct_reply": rng.random(n) < 0.01,
+    }
+
+
+class Replay:
+    """Scoring policy evaluated over columnar message arrays."""
+
+    def __init__(self, log: Dict[str, np.ndarray]):
+        # Порядок обработки — по времени внутри чата
+        order = np.lexsort((log["ts"], log["chat"]))
+        self.log = {name: values[order] for name, values in log.items()}
+        self.n = len(order)
+        chat = self.log["chat"]
+        new_chat = np.ones(self.n, dtype=bool)
+        new_chat[1:] = chat[1:] != chat[:-1]
+        self.chat_starts = np.flatnonzero(new_chat)
+        # Номер сообщения в чате, начиная с 1 (message_counter)
+        chat_start_of = self.chat_starts[np.cumsum(new_chat) - 1]
+        self.count = np.arange(self.n) - chat_start_of + 1
+        # Порядок (чат, автор, время) для стриков — не зависит от параметров
+        self._by_user = np.lexsort((self.log["ts"], self.log["user"], chat))
+        user_sorted = self.log["user"][self._by_user]
+        chat_sorted = chat[self._by_user]
+        self._new_author = np.ones(self.n, dtype=bool)
+        self._new_author[1:] = (user_sorted[1:] != user_sorted[:-1]) | (chat_sorted[1:] != chat_sorted[:-1])
+        self._gaps = np.empty(self.n)
+        self._gaps[0] = np.inf
+        self._gaps[1:] = np.diff(self.log["ts"][self._by_user])
+
+    def streaks(self, window: float) -> np.ndarray:
+        """Стрик автора на каждом сообщении (как Scorer.update_user_streak)."""
+        new_run = self._new_author | (self._gaps >= window)
+        run_start = np.maximum.accumulate(np.where(new_run, np.arange(self.n), 0))
+        streak_sorted = np.arange(self.n) - run_start + 1
+        streak = np.empty(self.n, dtype=np.int64)
+        streak[self._by_user] = streak_sorted
+        return streak
+
+    def _cooldown(self, candidates: np.ndarray, cooldown: float) -> np.ndarray:
+        """Маска кандидатов на отложенный ответ, которые пройдут кулдаун чата."""
+        accepted = np.zeros(self.n, dtype=bool)
+        idx = np.flatnonzero(candidates)
+        if not len(idx):
+            return accepted
+        cand_chat = self.log["chat"][idx]
+        bounds = np.flatnonzero(np.r_[True, cand_chat[1:] != cand_chat[:-1], True])
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            times = self.log["ts"][idx[lo:hi]]
+            # last_streak_response_time стартует с 0, как в Scorer
+            i = int(np.searchsorted(times, cooldown, side="left"))
+            while i < len(times):
+                accepted[idx[lo + i]] = True
+                i = int(np.searchsorted(times, times[i] + cooldown, side="left"))
+        return accepted
+
+    def evaluate(self, window: float, min_streak: int, cooldown: float, context_every: int) -> dict:
+        laughter = self.log["laughter"]
+        immediate = ~laughter & (self.log["direct_reply"] | self.log["mention"])
+        candidates = ~laughter & ~immediate & (self.streaks(window) >= min_streak)
+        delayed = self._cooldown(candidates, cooldown)
+        # Контекстная проверка — только если на сообщение не ответили
+        answered = laughter | immediate | delayed
+        context_checks = int(np.count_nonzero(~answered & (self.count % context_every == 0)))
+        n_immediate = int(np.count_nonzero(immediate))
+        n_delayed = int(np.count_nonzero(delayed))
+        return {
+            "immediate": n_immediate,
+            "delayed": n_delayed,
+            "laughter": int(np.count_nonzero(laughter)),
+            "context_checks": context_checks,
+            "llm_calls": n_immediate + n_delayed,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", nargs="?", help="result.json, .jsonl или сохранённый .npz")
+    parser.add_argument("--synthetic", type=int, help="вместо лога — случайные N сообщений")
+    parser.add_argument("--bot-username", default="robert_bot")
+    parser.add_argument("--bot-id", type=int, default=0)
+    parser.add_argument("--save", help="сохранить колонки в .npz")
+    parser.add_argument("--window", type=float, nargs="+", default=[120], help="окно стрика, с")
+    parser.add_argument("--min-streak", type=int, nargs="+", default=[3])
+    parser.add_argument("--cooldown", type=float, nargs="+", default=[180], help="кулдаун отложенных, с")
+    parser.add_argument("--context-every", type=int, nargs="+", default=[10])
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.synthetic:
+        log = synthetic_log(args.synthetic)
+    elif args.log and args.log.endswith(".npz"):
+        with np.load(args.log) as data:
+            log = {name: data[name] for name in COLUMNS}
+    elif args.log:
+        log = load_log(args.log, args.bot_username, args.bot_id)
+    else:
+        parser.error("укажите лог или --synthetic N")
+    if args.save:
+        np.savez_compressed(args.save, **log)
+    replay = Replay(log)
+    print(f"{replay.n:,} messages, {len(replay.chat_starts):,} chats, loaded in {time.perf_counter() - start:.2f} s")
+
+    header = f"{'window':>7} {'streak':>6} {'cooldown':>8} {'ctx':>4} | {'immediate':>9} {'delayed':>8} " \
+             f"{'laughter':>8} {'ctx chk':>8} {'LLM calls':>9} {'per 1k':>7}"
+    print(header)
+    print("-" * len(header))
+    start = time.perf_counter()
+    grid = list(itertools.product(args.window, args.min_streak, args.cooldown, args.context_every))
+    for window, min_streak, cooldown, context_every in grid:
+        result = replay.evaluate(window, min_streak, cooldown, context_every)
+        print(
+            f"{window:7g} {min_streak:6d} {cooldown:8g} {context_every:4d} | {result['immediate']:9,d} "
+            f"{result['delayed']:8,d} {result['laughter']:8,d} {result['context_checks']:8,d} "
+            f"{result['llm_calls']:9,d} {result['llm_calls'] * 1000 / max(replay.n, 1):7.1f}"
+        )
+    print(f"{len(grid)} settings in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
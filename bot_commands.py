@@ -6,6 +6,11 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 from holiday_evaluator import HolidayEvaluator
+from history import TRIM_MODES, get_history
+from llm_client import LLMUsage
+from metrics import REGISTRY
+from scoring import Scorer
+from services import SERVICES
 
 
 class BotCommands:
@@ -19,6 +24,11 @@ class BotCommands:
         # Messenger instance is created in post_init and passed here
         self.messenger = messenger
 
+    def _reschedule_autopost(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Пересчитать срок чата в общем планировщике после смены настроек
+        if self.messenger.autopost is not None:
+            self.messenger.autopost.touch(update.effective_chat.id, context.chat_data)
+
     async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         text = (
             "Доступные команды:\n"
@@ -27,6 +37,9 @@ class BotCommands:
             "/get_prompt — показать текущий системный промпт.\n"
             "/reset_prompt — сбросить промпт к значению по умолчанию.\n"
             "/set_history_limit <число> — установить лимит хранимых сообщений (сейчас 50).\n"
+            "/set_token_budget <число> — бюджет токенов на запрос вместе с промптом (сейчас 6000).\n"
+            "/set_coalesce_window <сек> — окно склейки упоминаний в один ответ (0 — выключить).\n"
+            "/set_trim_mode <block|sliding> — обрезать историю блоками (кэш префикса у DeepSeek) или по одному.\n"
             "/set_autopost_interval <сек> — интервал автосообщений (сейчас 3600).\n"
             "/enable_autopost — включить автосообщения.\n"
             "/disable_autopost — выключить автосообщения.\n"
@@ -50,7 +63,7 @@ class BotCommands:
             return
         self.messenger.set_system_prompt(new_prompt)
         # Очистить историю при изменении промпта
-        context.chat_data["history"] = []
+        get_history(context.chat_data).clear()
         await update.message.reply_text("Системный промпт обновлён. История сообщений очищена.")
 
     async def get_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -61,11 +74,11 @@ class BotCommands:
     async def reset_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         self.messenger.set_system_prompt(None)
         # Очистить историю при сбросе промпта
-        context.chat_data["history"] = []
+        get_history(context.chat_data).clear()
         await update.message.reply_text("Промпт сброшен. История сообщений очищена.")
 
     async def clear_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        context.chat_data["history"] = []
+        get_history(context.chat_data).clear()
         await update.message.reply_text("История сообщений очищена.")
 
     async def mute(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -81,12 +94,16 @@ class BotCommands:
             return
         until = datetime.utcnow() + timedelta(minutes=minutes)
         context.chat_data["muted_until"] = until
+        self._reschedule_autopost(update, context)
+        bot_username = context.bot_data.get("bot_username", "bot")
+        self.messenger.cancel_delayed(update.effective_chat.id, context.chat_data, bot_username)
         await update.message.reply_text(
             f"Бот замьючен на {minutes} мин. До {until.strftime('%H:%M:%S %d.%m.%Y UTC')}"
         )
 
     async def unmute(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         context.chat_data.pop("muted_until", None)
+        self._reschedule_autopost(update, context)
         await update.message.reply_text("Бот размьючен.")
 
     async def set_history_limit(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -102,11 +119,51 @@ class BotCommands:
             return
         context.chat_data["history_limit"] = limit
         # Подрезать текущую историю, если надо
-        history = context.chat_data.get("history", [])
-        if len(history) > limit:
-            history[:] = history[-limit:]
+        bot_username = context.bot_data.get("bot_username", "bot")
+        self.messenger.trim_history(context.chat_data, bot_username)
         await update.message.reply_text(f"Лимит истории установлен: {limit}")
 
+    async def set_token_budget(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not context.args:
+            await update.message.reply_text("Укажите число: /set_token_budget <число>")
+            return
+        try:
+            budget = int(context.args[0])
+            if budget <= 0:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("Некорректное число. Укажите положительное целое.")
+            return
+        context.chat_data["token_budget"] = budget
+        bot_username = context.bot_data.get("bot_username", "bot")
+        self.messenger.trim_history(context.chat_data, bot_username)
+        await update.message.reply_text(f"Бюджет токенов установлен: {budget}")
+
+    async def set_trim_mode(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        mode = context.args[0].lower() if context.args else ""
+        if mode not in TRIM_MODES:
+            await update.message.reply_text(f"Укажите режим: /set_trim_mode <{'|'.join(TRIM_MODES)}>")
+            return
+        context.chat_data["trim_mode"] = mode
+        await update.message.reply_text(f"Режим обрезки истории: {mode}")
+
+    async def set_coalesce_window(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not context.args:
+            await update.message.reply_text("Укажите число секунд: /set_coalesce_window <сек>")
+            return
+        try:
+            window = float(context.args[0])
+            if window < 0:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("Некорректное число. Укажите неотрицательное число секунд.")
+            return
+        context.chat_data["coalesce_window"] = window
+        if window:
+            await update.message.reply_text(f"Окно склейки ответов: {window:g} сек")
+        else:
+            await update.message.reply_text("Склейка ответов выключена.")
+
     async def set_autopost_interval(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if not context.args:
             await update.message.reply_text("Укажите число секунд: /set_autopost_interval <сек>")
@@ -119,47 +176,17 @@ class BotCommands:
             await update.message.reply_text("Некорректное число. Укажите положительное целое.")
             return
         context.chat_data["autopost_interval"] = interval
-        if context.chat_data.get("autopost_enabled"):
-            # Перезапустить задачу
-            job = context.chat_data.get("background_job")
-            if job is not None:
-                try:
-                    job.schedule_removal()
-                except Exception:
-                    logging.exception("Failed to remove previous background job")
-                context.chat_data.pop("background_job", None)
-            job = context.job_queue.run_repeating(
-                self.messenger.check_scheduled,
-                interval=interval,
-                first=interval,
-                chat_id=update.effective_chat.id,
-            )
-            context.chat_data["background_job"] = job
+        self._reschedule_autopost(update, context)
         await update.message.reply_text(f"Интервал автосообщений: {interval} сек")
 
     async def enable_autopost(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         context.chat_data["autopost_enabled"] = True
-        interval = context.chat_data.get("autopost_interval", 3600)
-        job = context.chat_data.get("background_job")
-        if job is None:
-            job = context.job_queue.run_repeating(
-                self.messenger.check_scheduled,
-                interval=interval,
-                first=interval,
-                chat_id=update.effective_chat.id,
-            )
-            context.chat_data["background_job"] = job
+        self._reschedule_autopost(update, context)
         await update.message.reply_text("Автосообщения включены.")
 
     async def disable_autopost(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         context.chat_data["autopost_enabled"] = False
-        job = context.chat_data.get("background_job")
-        if job is not None:
-            try:
-                job.schedule_removal()
-            except Exception:
-                logging.exception("Failed to remove background job")
-            context.chat_data.pop("background_job", None)
+        self._reschedule_autopost(update, context)
         await update.message.reply_text("Автосообщения выключены.")
 
     async def enable_reactions(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -174,11 +201,16 @@ class BotCommands:
         bot_username = context.bot_data.get("bot_username", "bot")
         prompt = self.messenger.get_current_system_prompt(bot_username)
         is_custom = self.messenger.system_prompt_override is not None
-        history = context.chat_data.get("history", [])
+        history = get_history(context.chat_data)
         history_limit = context.chat_data.get("history_limit", getattr(self.messenger, "MAX_HISTORY", 50))
+        token_budget = context.chat_data.get("token_budget", self.messenger.TOKEN_BUDGET)
+        used_tokens = history.total_tokens + self.messenger.system_prompt_tokens(bot_username)
         autopost_enabled = bool(context.chat_data.get("autopost_enabled", True))
         autopost_interval = context.chat_data.get("autopost_interval", 3600)
         reactions_enabled = bool(context.chat_data.get("reactions_enabled", True))
+        dispatcher = self.messenger.dispatcher
+        sender = self.messenger.sender
+        coalesce_window = context.chat_data.get("coalesce_window", self.messenger.COALESCE_WINDOW)
         muted_until = context.chat_data.get("muted_until")
         now = datetime.utcnow()
         muted_str = (
@@ -189,19 +221,33 @@ class BotCommands:
             f"Промпт: {'кастомный' if is_custom else 'по умолчанию'}",
             f"Длина промпта: {len(prompt)} символов",
             f"История: {len(history)}/{history_limit}",
+            f"Токены: ~{used_tokens}/{token_budget} (с промптом)",
+            f"Обрезка истории: {context.chat_data.get('trim_mode', self.messenger.trim_mode)}",
             f"Автосообщения: {'включены' if autopost_enabled else 'выключены'} (интервал {autopost_interval} сек)",
             f"Реакции: {'включены' if reactions_enabled else 'выключены'}",
+            f"Окно склейки ответов: {f'{coalesce_window:g} сек' if coalesce_window else 'выключено'}",
             f"Мьют: {muted_str}",
+            f"Очередь LLM: {dispatcher.depth()} в ожидании, {dispatcher.active}/{dispatcher.max_concurrency} в работе, "
+            f"отброшено {dispatcher.dropped}",
+            f"Очередь отправки: {sender.depth()} в ожидании, отправлено {sender.stats['sent']}, "
+            f"отброшено {sender.stats['dropped']}, повторов после flood control {sender.stats['retried']}",
         ]
+        if "shard" in context.bot_data:
+            shard_id, shards = context.bot_data["shard"]
+            parts.append(f"Шард: {shard_id + 1}/{shards}")
         await update.message.reply_text("\n".join(parts))
 
     async def metrics(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        scoring = context.chat_data.get("scoring", {})
-        message_counter = scoring.get("message_counter", 0)
-        user_streaks = scoring.get("user_streaks", {})
-        responded = scoring.get("responded", set())
-        reply_counts = scoring.get("reply_counts", {})
-        reaction_counts = scoring.get("reaction_counts", {})
+        bot_username = context.bot_data.get("bot_username", "bot")
+        scorer = Scorer.for_chat(context.chat_data, bot_username, context.bot.id)
+        message_counter = scorer.message_counter
+        user_streaks = scorer.user_streaks
+        responded = scorer.responded
+        reply_counts = scorer.reply_counts
+        reaction_counts = scorer.reaction_counts
+
+        for bounded in (user_streaks, responded, reply_counts, reaction_counts):
+            bounded.expire()
 
         top_streak = 0
         if user_streaks:
@@ -217,7 +263,40 @@ class BotCommands:
             f"Ответов на сообщения (уникальные): {len(responded)}",
             f"Сообщений с ответами других пользователей: {len(reply_counts)}",
             f"Сообщений с реакциями: {len(reaction_counts)}",
+            "Вытеснено из памяти: "
+            f"стрики {user_streaks.evicted}, "
+            f"ответы бота {responded.evicted}, "
+            f"ответы пользователей {reply_counts.evicted}, "
+            f"реакции {reaction_counts.evicted}",
         ]
+        lines.append(f"LLM в чате: {LLMUsage.for_chat(context.chat_data).summary()}")
+        lines.append(f"LLM всего: {self.messenger.llm.usage.summary()}")
+        lines.extend(self.messenger.llm.summary())
+        delayed = self.messenger.delayed_stats
+        lines.append(
+            f"Отложенные ответы: выполнено {delayed['executed']}, заменено новыми {delayed['superseded']}, "
+            f"отменено {delayed['cancelled']}, пропущено при проверке {delayed['skipped']}, "
+            f"ждут {len(self.messenger._delayed)}"
+        )
+        tiering = SERVICES.get("tiering")
+        if tiering is not None:
+            lines.append(f"Холодные чаты: {tiering.summary()}")
+        topics = self.messenger.topics
+        lines.append(
+            f"Темы автосообщений: {len(topics)} в запасе, взято {topics.stats['hits']}, "
+            f"не хватило {topics.stats['misses']}, истекло {topics.stats['expired']}"
+        )
+        cache = self.messenger.cache
+        if cache is not None:
+            lines.append(f"Кэш ответов: {cache.hits} попаданий, {cache.misses} промахов, {len(cache)}/{cache.maxsize} записей")
+        persistence_stats = getattr(context.application.persistence, "stats", None)
+        if persistence_stats:
+            lines.append(
+                f"Сохранение: {persistence_stats['flushes']} сбросов, {persistence_stats['chats_written']} чатов, "
+                f"последний {persistence_stats['last_flush_ms']:.1f} мс, макс {persistence_stats['max_flush_ms']:.1f} мс"
+            )
+        # Задержки и текущие значения по процессу: p50/p95/p99
+        lines.extend(REGISTRY.summary())
         await update.message.reply_text("\n".join(lines))
 
     async def send_test(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -227,7 +306,9 @@ class BotCommands:
             return
         bot_username = context.bot_data.get("bot_username", "bot")
         try:
-            reply = self.messenger._call_deepseek([{"role": "user", "content": query}], bot_username).strip()
+            reply = (await self.messenger._call_deepseek(
+                [{"role": "user", "content": query}], bot_username, use_cache=True
+            )).strip()
         except Exception:
             logging.exception("DeepSeek test call failed")
             await update.message.reply_text("Ошибка при обращении к DeepSeek")
@@ -244,7 +325,9 @@ class BotCommands:
         holiday_names = ", ".join(holidays)
         prompt = f"Сегодня {today.strftime('%d.%m.%Y')} {holiday_names}. Поздравь чат от своего имени, сохраняя стиль."
         try:
-            reply = self.messenger._call_deepseek([{"role": "user", "content": prompt}], bot_username).strip()
+            reply = (await self.messenger._call_deepseek(
+                [{"role": "user", "content": prompt}], bot_username, use_cache=True
+            )).strip()
         except Exception:
             logging.exception("DeepSeek holiday_check call failed")
             await update.message.reply_text("Ошибка DeepSeek при генерации поздравления")
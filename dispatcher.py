@@ -0,0 +1,107 @@
+# dispatcher.py
+"""
+Общая очередь перед вызовами LLM.
+
+Все обращения к DeepSeek (прямые ответы, отложенные ответы по стрикам,
+автосообщения, праздники, админские команды) проходят через LLMDispatcher:
+- одновременно выполняется не больше max_concurrency запросов;
+- свободный слот достаётся запросу с самым высоким приоритетом
+  (REPLY > DELAYED > BACKGROUND), внутри приоритета — по порядку;
+- запрос, который не дождался слота за max_wait своего приоритета,
+  выбрасывается с DispatchDropped (устаревший отложенный ответ никому не нужен);
+- при переполнении очереди фоновые запросы сразу отбрасываются.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Dict, Optional
+
+
+class Priority(IntEnum):
+    REPLY = 0
+    DELAYED = 1
+    BACKGROUND = 2
+
+
+class DispatchDropped(Exception):
+    """Запрос к LLM отброшен диспетчером (устарел или очередь переполнена)."""
+
+
+class LLMDispatcher:
+    """Bounded-concurrency priority gate in front of the LLM client."""
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        max_queue: int = 500,
+        max_wait: Optional[Dict[Priority, Optional[float]]] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = {Priority.REPLY: None, Priority.DELAYED: 30.0, Priority.BACKGROUND: 600.0}
+        if max_wait:
+            self.max_wait.update(max_wait)
+        self.active = 0
+        self.dropped = 0
+        self.completed = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+    @classmethod
+    def from_env(cls) -> "LLMDispatcher":
+        return cls(
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+            max_queue=int(os.getenv("LLM_MAX_QUEUE", "500")),
+            max_wait={
+                Priority.DELAYED: float(os.getenv("LLM_MAX_WAIT_DELAYED", "30")),
+                Priority.BACKGROUND: float(os.getenv("LLM_MAX_WAIT_BACKGROUND", "600")),
+            },
+        )
+
+    def depth(self, priority: Optional[Priority] = None) -> int:
+        """Число запросов, ожидающих слота (опционально — одного приоритета)."""
+        return sum(
+            1 for p, _, fut in self._waiters
+            if not fut.done() and (priority is None or p == priority)
+        )
+
+    async def _acquire(self, priority: Priority) -> None:
+        if self.active < self.max_concurrency and not self.depth():
+            self.active += 1
+            return
+        if priority == Priority.BACKGROUND and self.depth() >= self.max_queue:
+            self.dropped += 1
+            raise DispatchDropped("LLM queue is full")
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        try:
+            await asyncio.wait_for(fut, self.max_wait.get(priority))
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            raise DispatchDropped(f"No LLM slot within {self.max_wait[priority]} s") from None
+        except asyncio.CancelledError:
+            # Слот мог быть выдан в момент отмены — вернуть его
+            if fut.done() and not fut.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                # Слот переходит следующему ожидающему, active не меняется
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = Priority.REPLY):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self.completed += 1
+            self._release()
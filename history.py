@@ -0,0 +1,99 @@
+# history.py
+"""
+История сообщений чата с учётом токенов.
+
+Каждая запись хранит оценку числа токенов, посчитанную один раз при
+добавлении; общий счётчик обновляется на append/popleft, поэтому обрезка
+окна до бюджета стоит O(1) амортизированно. Сообщения отдаются в LLM
+в том же формате, что и раньше: [{"role": ..., "content": ...}, ...].
+
+Обрезка бывает двух видов: скользящая (по одному сообщению, окно всегда
+у самого лимита) и блочная — при переполнении окно разом сжимается до
+low_watermark от лимитов. Блочная держит префикс запроса (системный
+промпт + начало истории) неизменным между вызовами, и провайдер может
+отдавать его из своего кэша префиксов.
+
+История лежит в chat_data["history"]; get_history() прозрачно
+переводит старые списки в ChatHistory.
+"""
+from collections import deque
+from typing import Iterable, Iterator, List, Optional
+
+# Служебные токены на одно сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Грубая оценка: для смеси кириллицы и латиницы ~3 символа на токен
+CHARS_PER_TOKEN = 3
+
+TRIM_SLIDING = "sliding"
+TRIM_BLOCK = "block"
+TRIM_MODES = (TRIM_SLIDING, TRIM_BLOCK)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+
+class ChatHistory:
+    """Message window with cached per-entry token estimates."""
+
+    __slots__ = ("_messages", "_tokens", "total_tokens")
+
+    def __init__(self, messages: Iterable[dict] = ()):
+        self._messages = deque()
+        self._tokens = deque()
+        self.total_tokens = 0
+        for message in messages:
+            self.append(message["role"], message["content"])
+
+    def append(self, role: str, content: str) -> None:
+        tokens = estimate_tokens(content)
+        self._messages.append({"role": role, "content": content})
+        self._tokens.append(tokens)
+        self.total_tokens += tokens
+
+    def popleft(self) -> dict:
+        self.total_tokens -= self._tokens.popleft()
+        return self._messages.popleft()
+
+    def trim(self, max_messages: int, token_budget: int, low_watermark: Optional[float] = None) -> int:
+        """Удаляет старые сообщения, пока окно не влезет в лимиты.
+
+        С low_watermark (доля от 0 до 1) окно при переполнении сжимается
+        сразу до этой доли лимитов, а не до самих лимитов. Последнее
+        сообщение не удаляется никогда, даже если оно одно больше
+        бюджета. Возвращает число удалённых сообщений.
+        """
+        if low_watermark is not None and (
+            len(self._messages) > max_messages or self.total_tokens > token_budget
+        ):
+            max_messages = int(max_messages * low_watermark)
+            token_budget = int(token_budget * low_watermark)
+        removed = 0
+        while len(self._messages) > 1 and (
+            len(self._messages) > max_messages or self.total_tokens > token_budget
+        ):
+            self.popleft()
+            removed += 1
+        return removed
+
+    def clear(self) -> None:
+        self._messages.clear()
+        self._tokens.clear()
+        self.total_tokens = 0
+
+    def messages(self) -> List[dict]:
+        return list(self._messages)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self._messages)
+
+
+def get_history(chat_data: dict) -> ChatHistory:
+    history = chat_data.get("history")
+    if not isinstance(history, ChatHistory):
+        history = ChatHistory(history or ())
+        chat_data["history"] = history
+    return history
@@ -0,0 +1,142 @@
+# holiday_broadcast.py
+"""
+Рассылка праздничных поздравлений по всем чатам.
+
+Раньше каждый чат в праздник делал свой запрос к DeepSeek. Теперь раз в
+сутки (в полночь UTC и один раз после старта) HolidayBroadcast:
+1. собирает чаты, которые ещё не поздравлены сегодня, не отключили
+   автосообщения и не замьючены: загруженные проверяются в памяти,
+   сохранённые отбираются запросом к persistence по колонкам, и с диска
+   подтягиваются только отобранные;
+2. генерирует небольшой пул поздравлений с текущим системным промптом
+   (он общий для всех чатов) — pool_size запросов вместо запроса на чат;
+3. рассылает случайное поздравление из пула каждому чату через общую
+   очередь отправки (фоновый приоритет, лимиты Telegram соблюдает она);
+4. пачкой проставляет holiday_sent_date и отмечает чаты для persistence.
+"""
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from telegram.ext import CallbackContext, ContextTypes
+
+from dispatcher import Priority
+from holiday_evaluator import HolidayEvaluator
+from tiering import thaw_chat
+
+
+class HolidayBroadcast:
+    """Shared-generation holiday congratulations fan-out."""
+
+    def __init__(self, messenger, pool_size: int = 3):
+        self.messenger = messenger
+        self.pool_size = pool_size
+        self.stats = {"llm_calls": 0, "sent": 0, "failed": 0}
+
+    @classmethod
+    def from_env(cls, messenger) -> "HolidayBroadcast":
+        return cls(
+            messenger,
+            pool_size=int(os.getenv("HOLIDAY_POOL_SIZE", "3")),
+        )
+
+    @staticmethod
+    def _is_eligible(chat_data: dict, today, now: datetime) -> bool:
+        if not chat_data.get("autopost_enabled", True):
+            return False
+        if chat_data.get("holiday_sent_date") == today:
+            return False
+        muted_until = chat_data.get("muted_until")
+        return not (muted_until and now < muted_until)
+
+    async def _eligible_chats(self, context: ContextTypes.DEFAULT_TYPE, today) -> Dict[int, dict]:
+        application = context.application
+        now = datetime.utcnow()
+        # Чаты в памяти проверяем на месте — их данные свежее, чем в базе
+        candidates = set(application.chat_data)
+        eligible_holiday_chats = getattr(application.persistence, "eligible_holiday_chats", None)
+        if eligible_holiday_chats is not None:
+            candidates.update(await eligible_holiday_chats(today, now.replace(tzinfo=timezone.utc).timestamp()))
+        eligible = {}
+        for chat_id in candidates:
+            chat_context = CallbackContext(application, chat_id=chat_id)
+            # Подтянуть chat_data из persistence, если чат ещё не загружен
+            await chat_context.refresh_data()
+            chat_data = chat_context.chat_data
+            if self._is_eligible(chat_data, today, now):
+                eligible[chat_id] = chat_data
+        return eligible
+
+    async def _generate_pool(self, prompt: str, system_prompt: str, bot_username: str) -> List[str]:
+        async def generate():
+            self.stats["llm_calls"] += 1
+            try:
+                reply = await self.messenger._call_deepseek(
+                    [{"role": "user", "content": prompt}],
+                    bot_username,
+                    priority=Priority.BACKGROUND,
+                    system_prompt=system_prompt,
+                )
+            except Exception:
+                logging.exception("DeepSeek API failed")
+                return None
+            reply = reply.strip()
+            if not reply or reply.endswith(self.messenger.NO_RESPONSE):
+                return None
+            return reply
+
+        replies = await asyncio.gather(*(generate() for _ in range(self.pool_size)))
+        return [reply for reply in replies if reply]
+
+    async def run(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        today = datetime.utcnow().date()
+        holidays = HolidayEvaluator(today).evaluate()
+        if not holidays:
+            return
+        bot_username = context.bot_data["bot_username"]
+        eligible = await self._eligible_chats(context, today)
+        if not eligible:
+            return
+        holiday_names = ", ".join(holidays)
+        prompt = (
+            f"Сегодня {today.strftime('%d.%m.%Y')} {holiday_names}. Поздравь чат от своего имени, сохраняя стиль."
+        )
+        logging.info(f"[HOLIDAY] {holiday_names}: {len(eligible)} chats")
+        pool = await self._generate_pool(
+            prompt, self.messenger.get_current_system_prompt(bot_username), bot_username
+        )
+        if not pool:
+            return
+
+        sent = []
+
+        async def send(chat_id: int, text: str) -> None:
+            try:
+                await self.messenger.sender.send(
+                    chat_id,
+                    lambda: context.bot.send_message(chat_id=chat_id, text=text),
+                    Priority.BACKGROUND,
+                )
+            except Exception as e:
+                self.stats["failed"] += 1
+                logging.warning(f"[HOLIDAY] Failed to send to {chat_id}: {e}")
+                return
+            self.stats["sent"] += 1
+            sent.append((chat_id, text))
+
+        tasks = [asyncio.create_task(send(chat_id, random.choice(pool))) for chat_id in eligible]
+        await asyncio.gather(*tasks)
+
+        # Отметить всех поздравленных разом
+        now = datetime.utcnow()
+        for chat_id, text in sent:
+            chat_data = eligible[chat_id]
+            await thaw_chat(chat_id, chat_data)
+            self.messenger._append_history(chat_data, bot_username, "assistant", text)
+            chat_data["holiday_sent_date"] = today
+            chat_data["last_message_time"] = now
+        context.application.mark_data_for_update_persistence(chat_ids=[chat_id for chat_id, _ in sent])
+        logging.info(f"[HOLIDAY] Sent {len(sent)}/{len(tasks)} congratulations")
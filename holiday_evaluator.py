@@ -1,74 +1,111 @@
 # holiday_evaluator.py
+"""
+Праздники на дату.
 
+Для каждого года один раз строится индекс дата -> список праздников
+(плавающие даты вычисляются по правилам из RUSSIAN_HOLIDAYS), после чего
+любой запрос — это поиск в словаре. Индексы кэшируются по годам, так что
+при смене года новый индекс строится сам при первом обращении.
+"""
 from datetime import datetime, timedelta, date
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
 from utils.constants import RUSSIAN_HOLIDAYS
 
 
+def orthodox_easter(year: int) -> date:
+    """Вычисляет дату православной Пасхи (алгоритм Meeus/Jones/Butcher)"""
+    a = year % 19
+    b = year % 7
+    c = year % 4
+    d = (19 * a + 15) % 30
+    e = (2 * c + 4 * b + 6 * d + 6) % 7
+    days = 22 + d + e
+    if days > 31:
+        return date(year, 5, days - 31)
+    else:
+        return date(year, 4, days)
+
+
+def _easter(year: int, rule: dict) -> date:
+    return orthodox_easter(year) + timedelta(days=rule["offset"])
+
+
+def _day_of_year(year: int, rule: dict) -> date:
+    return date(year, 1, 1) + timedelta(days=rule["day"] - 1)
+
+
+def _nth_weekday(year: int, rule: dict) -> date:
+    first = date(year, rule["month"], 1)
+    shift = (rule["weekday"] - first.weekday()) % 7
+    return first + timedelta(days=shift, weeks=rule["n"] - 1)
+
+
+def _last_weekday(year: int, rule: dict) -> date:
+    month = rule["month"]
+    next_month = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    last = next_month - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - rule["weekday"]) % 7)
+
+
+# Типы правил для плавающих праздников (поле "rule" в RUSSIAN_HOLIDAYS)
+RULES = {
+    "easter": _easter,
+    "day_of_year": _day_of_year,
+    "nth_weekday": _nth_weekday,
+    "last_weekday": _last_weekday,
+}
+
+
+def holiday_date(holiday: dict, year: int) -> Optional[date]:
+    """Дата праздника в указанном году (None для неизвестного правила)."""
+    if holiday['float_date']:
+        rule = holiday.get('rule')
+        compute = RULES.get(rule['type']) if rule else None
+        return compute(year, rule) if compute else None
+    day, month = map(int, holiday['date'].split('-'))
+    return date(year, month, day)
+
+
+@lru_cache(maxsize=4)
+def holiday_index(year: int) -> Dict[date, Tuple[str, ...]]:
+    """Индекс дата -> праздники за год, в порядке RUSSIAN_HOLIDAYS."""
+    index: Dict[date, List[str]] = {}
+    for holiday in RUSSIAN_HOLIDAYS:
+        day = holiday_date(holiday, year)
+        if day is not None:
+            index.setdefault(day, []).append(holiday['name'])
+    return {day: tuple(names) for day, names in index.items()}
+
+
 class HolidayEvaluator:
-    def __init__(self):
-        self.today = datetime.today().date()
-        self.today_str = self.today.strftime("%d-%m")
+    def __init__(self, today: Optional[date] = None):
+        self.today = today or datetime.today().date()
         self.year = self.today.year
 
-    def evaluate(self):
-        holidays_today = []
+    def evaluate(self, day: Optional[date] = None) -> List[str]:
+        """Праздники на дату (по умолчанию — на сегодня)."""
+        day = day or self.today
+        return list(holiday_index(day.year).get(day, ()))
 
-        for holiday in RUSSIAN_HOLIDAYS:
-            if holiday['float_date']:
-                float_date = self.get_floating_holiday_date(holiday['name'])
-                if float_date == self.today:
-                    holidays_today.append(holiday['name'])
-            else:
-                if holiday['date'] == self.today_str:
-                    holidays_today.append(holiday['name'])
-
-        return holidays_today
+    def upcoming(self, days: int, start: Optional[date] = None) -> List[Tuple[date, List[str]]]:
+        """Праздники в ближайшие days дней, начиная со start (включительно)."""
+        start = start or self.today
+        result = []
+        for offset in range(days):
+            day = start + timedelta(days=offset)
+            names = holiday_index(day.year).get(day)
+            if names:
+                result.append((day, list(names)))
+        return result
 
     def get_floating_holiday_date(self, name):
         """Определяет точную дату для плавающего праздника"""
-        if name == "День программиста":
-            return self.get_programmer_day()
-        elif name == "Пасха (православная)":
-            return self.orthodox_easter()
-        elif name == "Масленица":
-            return self.orthodox_easter() - timedelta(days=49)
-        elif name == "Радоница":
-            return self.orthodox_easter() + timedelta(days=9)
-        elif name == "Троица (Пятидесятница)":
-            return self.orthodox_easter() + timedelta(days=49)
-        elif name == "День ПВО":
-            return self.second_sunday_of_april()
-        elif name == "День матери":
-            return self.last_sunday_of_november()
-        else:
-            return None  # Неизвестный плавающий праздник
-
-    def get_programmer_day(self):
-        # 256-й день года (13 сентября или 12 в високосный год)
-        day_of_year = 256
-        return date(self.year, 1, 1) + timedelta(days=day_of_year - 1)
+        for holiday in RUSSIAN_HOLIDAYS:
+            if holiday['name'] == name and holiday['float_date']:
+                return holiday_date(holiday, self.year)
+        return None  # Неизвестный плавающий праздник
 
     def orthodox_easter(self):
-        """Вычисляет дату православной Пасхи (алгоритм Meeus/Jones/Butcher)"""
-        a = self.year % 19
-        b = self.year % 7
-        c = self.year % 4
-        d = (19 * a + 15) % 30
-        e = (2 * c + 4 * b + 6 * d + 6) % 7
-        days = 22 + d + e
-        if days > 31:
-            return date(self.year, 5, days - 31)
-        else:
-            return date(self.year, 4, days)
-
-    def second_sunday_of_april(self):
-        d = date(self.year, 4, 1)
-        while d.weekday() != 6:
-            d += timedelta(days=1)
-        return d + timedelta(weeks=1)
-
-    def last_sunday_of_november(self):
-        d = date(self.year, 11, 30)
-        while d.weekday() != 6:
-            d -= timedelta(days=1)
-        return d
+        return orthodox_easter(self.year)
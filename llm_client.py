@@ -0,0 +1,442 @@
+# llm_client.py
+"""
+Асинхронный клиент к OpenAI-совместимому API (DeepSeek).
+
+Держит один httpx.AsyncClient с постоянным пулом keep-alive соединений,
+поэтому запросы к LLM не блокируют event loop бота и не тратят время на
+повторные TLS-рукопожатия. HTTP/2 включается, если установлен пакет h2.
+
+Блок usage из каждого ответа (в том числе из последнего чанка стрима)
+складывается в LLMUsage: общий счётчик клиента и, если передан, счётчик
+чата. DeepSeek отдаёт prompt_cache_hit_tokens / prompt_cache_miss_tokens —
+по ним видно, насколько часто префикс запроса попадает в кэш провайдера.
+
+Задержки (установка соединения, время до заголовков ответа, запрос
+целиком) пишутся в гистограммы metrics.py через trace-расширение httpx.
+
+Устойчивость к деградации провайдера (см. resilience.py):
+- таймаут запроса — p99 последних задержек, умноженный на timeout_factor,
+  в пределах [min_timeout, timeout]; запрос, упавший по таймауту, тоже
+  попадает в окно задержек, поэтому при общем замедлении API таймаут
+  растёт, а не режет все запросы подряд;
+- с hedge=True обычный запрос, не ответивший к p95, дублируется вторым,
+  используется первый ответ (хеджей не больше hedge_budget от запросов);
+- 429/5xx и сетевые ошибки повторяются до max_retries раз с паузой с
+  джиттером (на 429 — по Retry-After); стрим повторяется, только пока
+  из него ничего не отдано;
+- при серии ошибок CircuitBreaker размыкается, и запросы сразу падают с
+  CircuitOpen — вызывающий код отвечает FALLBACK_REPLY.
+
+Клиент создаётся в post_init и закрывается в post_shutdown (см. main.py).
+"""
+import asyncio
+import os
+import json
+import logging
+import time
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from metrics import LLM_CONNECT_SECONDS, LLM_REQUEST_SECONDS, LLM_TTFB_SECONDS
+from resilience import CLOSED, OPEN, CircuitBreaker, LatencyWindow, backoff_delay
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+DEEPSEEK_URL = "https://api.deepseek.com/v1/chat/completions"
+DEFAULT_MODEL = "deepseek-chat"
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUSES
+    return isinstance(error, httpx.TransportError)
+
+
+class _RequestTrace:
+    """httpx trace callback: connect time and time to response headers."""
+
+    __slots__ = ("start", "connect_start")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.connect_start = None
+
+    async def __call__(self, event: str, info: dict) -> None:
+        if event == "connection.connect_tcp.started":
+            self.connect_start = time.perf_counter()
+        elif event.endswith("send_request_headers.started") and self.connect_start is not None:
+            # Новое соединение (TCP + TLS) готово, начинается отправка запроса
+            LLM_CONNECT_SECONDS.observe(time.perf_counter() - self.connect_start)
+            self.connect_start = None
+        elif event.endswith("receive_response_headers.complete"):
+            LLM_TTFB_SECONDS.observe(time.perf_counter() - self.start)
+
+    @property
+    def extensions(self) -> dict:
+        return {"trace": self}
+
+
+class LLMUsage:
+    """Accumulated token counters from API usage blocks."""
+
+    __slots__ = ("requests", "prompt_tokens", "cache_hit_tokens", "cache_miss_tokens", "completion_tokens")
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cache_hit_tokens = 0
+        self.cache_miss_tokens = 0
+        self.completion_tokens = 0
+
+    @classmethod
+    def for_chat(cls, chat_data: dict) -> "LLMUsage":
+        usage = chat_data.get("llm_usage")
+        if not isinstance(usage, cls):
+            usage = cls()
+            chat_data["llm_usage"] = usage
+        return usage
+
+    def add(self, usage: dict) -> None:
+        prompt = usage.get("prompt_tokens") or 0
+        hit = usage.get("prompt_cache_hit_tokens")
+        if hit is None:
+            # OpenAI-совместимый формат без полей DeepSeek
+            hit = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        miss = usage.get("prompt_cache_miss_tokens")
+        if miss is None:
+            miss = max(prompt - hit, 0)
+        self.requests += 1
+        self.prompt_tokens += prompt
+        self.cache_hit_tokens += hit
+        self.cache_miss_tokens += miss
+        self.completion_tokens += usage.get("completion_tokens") or 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.cache_hit_tokens + self.cache_miss_tokens
+        return self.cache_hit_tokens / total if total else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"{self.requests} запросов, промпт {self.prompt_tokens} "
+            f"(кэш {self.cache_hit_tokens}/{self.cache_hit_tokens + self.cache_miss_tokens}, {self.hit_ratio:.0%}), "
+            f"ответ {self.completion_tokens}"
+        )
+
+
+class LLMClient:
+    """Pooled async client for chat completions."""
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        url: str = DEEPSEEK_URL,
+        model: str = DEFAULT_MODEL,
+        pool_size: int = 20,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        http2: bool = True,
+        min_timeout: float = 5.0,
+        timeout_factor: float = 2.0,
+        max_retries: int = 2,
+        hedge: bool = False,
+        hedge_budget: float = 0.1,
+        breaker: Optional[CircuitBreaker] = None,
+        cheap_model: Optional[str] = None,
+        name: str = "deepseek",
+    ):
+        self.name = name
+        self.api_key = api_key
+        self.url = url
+        self.model = model
+        # Модель для фоновых задач, где качество не так важно (темы автосообщений)
+        self.cheap_model = cheap_model or model
+        # timeout — верхняя граница, фактический таймаут считается по задержкам
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.min_timeout = min_timeout
+        self.timeout_factor = timeout_factor
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.hedge_budget = hedge_budget
+        self.breaker = breaker or CircuitBreaker()
+        self.usage = LLMUsage()
+        self.stats = {"requests": 0, "retried": 0, "timeouts": 0, "hedged": 0, "hedge_wins": 0, "failed": 0}
+        # Полный запрос для chat, время до заголовков для stream_chat
+        self._latency = LatencyWindow()
+        self._ttfb = LatencyWindow()
+        self._client = httpx.AsyncClient(
+            http2=http2 and HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            # Локальным серверам ключ обычно не нужен
+            headers={"Authorization": f"Bearer {api_key}"} if api_key else {},
+        )
+
+    @classmethod
+    def from_env(cls, name: Optional[str] = None) -> "LLMClient":
+        """Клиент из переменных окружения.
+
+        Для именованного бэкенда (см. llm_router.py) сначала читаются
+        LLM_<NAME>_URL, LLM_<NAME>_API_KEY, LLM_<NAME>_MODEL и т. д., общие
+        LLM_* служат значениями по умолчанию. Бэкенд deepseek (и клиент без
+        имени) берёт ключ из DEEPSEEK_API_KEY и адрес из LLM_URL.
+        """
+        prefix = f"LLM_{name.upper()}_" if name else "LLM_"
+        default = not name or name == "deepseek"
+
+        def env(key: str, fallback: str) -> str:
+            return os.getenv(prefix + key) or os.getenv("LLM_" + key) or fallback
+
+        url = os.getenv(prefix + "URL") or (os.getenv("LLM_URL", DEEPSEEK_URL) if default else None)
+        if not url:
+            raise ValueError(f"{prefix}URL is not set")
+        api_key = os.getenv(prefix + "API_KEY") or (os.getenv("DEEPSEEK_API_KEY") if default else None)
+        model = env("MODEL", DEFAULT_MODEL)
+        return cls(
+            api_key=api_key,
+            url=url,
+            model=model,
+            cheap_model=env("CHEAP_MODEL", model),
+            name=name or "deepseek",
+            pool_size=int(env("POOL_SIZE", "20")),
+            timeout=float(env("TIMEOUT", "30")),
+            connect_timeout=float(env("CONNECT_TIMEOUT", "5")),
+            http2=env("HTTP2", "1") == "1",
+            min_timeout=float(env("MIN_TIMEOUT", "5")),
+            timeout_factor=float(env("TIMEOUT_FACTOR", "2")),
+            max_retries=int(env("RETRIES", "2")),
+            hedge=env("HEDGE", "0") == "1",
+            hedge_budget=float(env("HEDGE_BUDGET", "0.1")),
+            breaker=CircuitBreaker(
+                failure_threshold=int(env("BREAKER_FAILURES", "5")),
+                reset_timeout=float(env("BREAKER_RESET", "30")),
+            ),
+        )
+
+    def latency(self, q: float, stream: bool = False) -> Optional[float]:
+        """Перцентиль недавних задержек (для стрима — до заголовков ответа)."""
+        return (self._ttfb if stream else self._latency).quantile(q)
+
+    def _timeout(self, timeout: Optional[float], window: LatencyWindow) -> float:
+        """Таймаут попытки: p99 окна * timeout_factor, не больше заданного."""
+        limit = timeout or self.timeout
+        p99 = window.quantile(0.99)
+        if p99 is None:
+            return limit
+        return min(limit, max(self.min_timeout, p99 * self.timeout_factor))
+
+    def _hedge_after(self) -> Optional[float]:
+        """Через сколько секунд дублировать запрос или None, если не нужно."""
+        if not self.hedge or self.breaker.state != CLOSED:
+            return None
+        if self.stats["hedged"] >= self.hedge_budget * self.stats["requests"]:
+            return None
+        return self._latency.quantile(0.95)
+
+    @staticmethod
+    def _retry_delay(error: Exception, attempt: int) -> float:
+        if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429:
+            try:
+                return min(float(error.response.headers.get("Retry-After", "")), 10.0)
+            except ValueError:
+                pass
+        return backoff_delay(attempt)
+
+    def _on_error(self, error: Exception, attempt: int) -> Optional[float]:
+        """Учитывает ошибку попытки; возвращает паузу перед повтором или None."""
+        if not _retryable(error):
+            # Ответ 4xx — API живо, ошибка в самом запросе
+            self.breaker.release()
+            return None
+        self.breaker.record_failure()
+        if attempt >= self.max_retries or self.breaker.state == OPEN:
+            self.stats["failed"] += 1
+            return None
+        self.stats["retried"] += 1
+        delay = self._retry_delay(error, attempt)
+        reason = (
+            f"HTTP {error.response.status_code}" if isinstance(error, httpx.HTTPStatusError)
+            else type(error).__name__
+        )
+        logging.warning(f"[LLM] {reason}, retry {attempt + 1} in {delay:.1f} s")
+        return delay
+
+    def _record_usage(self, usage: Optional[dict], chat_usage: Optional[LLMUsage]) -> None:
+        if not usage:
+            return
+        self.usage.add(usage)
+        if chat_usage is not None:
+            chat_usage.add(usage)
+
+    async def chat(
+        self,
+        messages: list,
+        timeout: Optional[float] = None,
+        usage: Optional[LLMUsage] = None,
+        **params,
+    ) -> str:
+        """Выполняет запрос chat/completions и возвращает текст ответа."""
+        data = {"model": params.pop("model", None) or self.model, "messages": messages, **params}
+        self.stats["requests"] += 1
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                body = await self._post_hedged(data, self._timeout(timeout, self._latency))
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                delay = self._on_error(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            self._record_usage(body.get("usage"), usage)
+            return body["choices"][0]["message"]["content"]
+
+    async def _post(self, data: dict, timeout: float) -> dict:
+        start = time.perf_counter()
+        try:
+            with LLM_REQUEST_SECONDS.time():
+                response = await self._client.post(
+                    self.url,
+                    json=data,
+                    timeout=httpx.Timeout(timeout, connect=self.connect_timeout),
+                    extensions=_RequestTrace().extensions,
+                )
+                response.raise_for_status()
+                body = response.json()
+        except httpx.TimeoutException:
+            self.stats["timeouts"] += 1
+            # Задержка не меньше таймаута — без этого окно не узнает о замедлении
+            self._latency.observe(time.perf_counter() - start)
+            raise
+        self._latency.observe(time.perf_counter() - start)
+        return body
+
+    async def _post_hedged(self, data: dict, timeout: float) -> dict:
+        """_post, который дублируется, если ответа нет дольше p95."""
+        hedge_after = self._hedge_after()
+        if hedge_after is None or hedge_after >= timeout:
+            return await self._post(data, timeout)
+        primary = asyncio.ensure_future(self._post(data, timeout))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                self.stats["hedged"] += 1
+                hedge = asyncio.ensure_future(self._post(data, timeout))
+                tasks.add(hedge)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                    else:
+                        error = task.exception()
+                if winner is not None:
+                    if winner is not primary:
+                        self.stats["hedge_wins"] += 1
+                    return winner.result()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream_chat(
+        self,
+        messages: list,
+        timeout: Optional[float] = None,
+        usage: Optional[LLMUsage] = None,
+        **params,
+    ) -> AsyncIterator[str]:
+        """Запрос с stream=true: по мере прихода SSE-событий отдаёт куски текста."""
+        data = {
+            "model": params.pop("model", None) or self.model,
+            "messages": messages,
+            "stream": True,
+            # usage приходит отдельным чанком перед [DONE]
+            "stream_options": {"include_usage": True},
+            **params,
+        }
+        self.stats["requests"] += 1
+        start = time.perf_counter()
+        attempt = 0
+        try:
+            while True:
+                self.breaker.before_call()
+                trace = _RequestTrace()
+                timeout_s = self._timeout(timeout, self._ttfb)
+                headers = False
+                yielded = False
+                try:
+                    async with self._client.stream(
+                        "POST",
+                        self.url,
+                        json=data,
+                        timeout=httpx.Timeout(timeout_s, connect=self.connect_timeout),
+                        extensions=trace.extensions,
+                    ) as response:
+                        response.raise_for_status()
+                        headers = True
+                        self._ttfb.observe(time.perf_counter() - trace.start)
+                        self.breaker.record_success()
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            payload = line[5:].strip()
+                            if payload == "[DONE]":
+                                break
+                            chunk = json.loads(payload)
+                            self._record_usage(chunk.get("usage"), usage)
+                            choices = chunk.get("choices") or []
+                            if not choices:
+                                continue
+                            delta = choices[0].get("delta", {}).get("content")
+                            if delta:
+                                yielded = True
+                                yield delta
+                    return
+                except asyncio.CancelledError:
+                    if not headers:
+                        self.breaker.release()
+                    raise
+                except Exception as e:
+                    if isinstance(e, httpx.TimeoutException):
+                        self.stats["timeouts"] += 1
+                        if not headers:
+                            self._ttfb.observe(time.perf_counter() - trace.start)
+                    if headers:
+                        # Ответ уже начался: повторять можно, только если ничего не отдано
+                        if yielded or not _retryable(e) or attempt >= self.max_retries:
+                            raise
+                        self.stats["retried"] += 1
+                        delay = backoff_delay(attempt)
+                    else:
+                        delay = self._on_error(e, attempt)
+                        if delay is None:
+                            raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+        finally:
+            LLM_REQUEST_SECONDS.observe(time.perf_counter() - start)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+        logging.info(f"LLM client {self.name} closed")
@@ -0,0 +1,199 @@
+# llm_router.py
+"""
+Маршрутизация запросов к LLM между несколькими OpenAI-совместимыми API.
+
+Бэкенды перечисляются в LLM_BACKENDS через запятую в порядке
+предпочтения (по умолчанию — один deepseek), каждый настраивается своими
+переменными LLM_<NAME>_URL, LLM_<NAME>_API_KEY, LLM_<NAME>_MODEL,
+LLM_<NAME>_CHEAP_MODEL и т. д. (см. LLMClient.from_env):
+
+    LLM_BACKENDS=deepseek,local
+    LLM_LOCAL_URL=http://127.0.0.1:8000/v1/chat/completions
+    LLM_LOCAL_MODEL=qwen2.5-7b-instruct
+
+Перед каждым запросом бэкенды упорядочиваются по оценке
+    медиана недавних задержек * (1 + error_penalty * доля ошибок)
+по последним window запросам; бэкенды с разомкнутой цепью пропускаются.
+При ошибке запрос уходит на следующий бэкенд (стрим — только пока из него
+ничего не отдано). С вероятностью explore первым берётся случайный
+бэкенд, чтобы оценки редко используемых не устаревали.
+
+Роль запроса выбирает модель бэкенда: MAIN — ответы в чат, CHEAP —
+фоновые задачи вроде тем автосообщений. LLMRouter повторяет интерфейс
+LLMClient (chat, stream_chat, model, usage, aclose), поэтому Messenger не
+знает, сколько бэкендов за ним стоит.
+"""
+import logging
+import os
+import random
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional
+
+from llm_client import LLMClient, LLMUsage
+from resilience import OPEN, CircuitOpen
+
+MAIN = "main"
+CHEAP = "cheap"
+
+
+class LLMRouter:
+    """Picks the healthiest, fastest backend per request and fails over."""
+
+    def __init__(
+        self,
+        backends: List[LLMClient],
+        error_penalty: float = 4.0,
+        explore: float = 0.05,
+        window: int = 50,
+    ):
+        if not backends:
+            raise ValueError("At least one LLM backend is required")
+        self.backends = backends
+        self.error_penalty = error_penalty
+        self.explore = explore
+        # Общий счётчик токенов по всем бэкендам
+        self.usage = LLMUsage()
+        for backend in backends:
+            backend.usage = self.usage
+        self.stats = {backend.name: {"requests": 0, "errors": 0, "fallbacks": 0} for backend in backends}
+        self._outcomes = {backend.name: deque(maxlen=window) for backend in backends}
+
+    @classmethod
+    def from_env(cls) -> "LLMRouter":
+        names = [name.strip().lower() for name in os.getenv("LLM_BACKENDS", "deepseek").split(",") if name.strip()]
+        return cls(
+            [LLMClient.from_env(name) for name in names],
+            error_penalty=float(os.getenv("LLM_ROUTER_ERROR_PENALTY", "4")),
+            explore=float(os.getenv("LLM_ROUTER_EXPLORE", "0.05")),
+        )
+
+    @property
+    def model(self) -> str:
+        return self.backends[0].model
+
+    def error_rate(self, name: str) -> float:
+        outcomes = self._outcomes[name]
+        return outcomes.count(False) / len(outcomes) if outcomes else 0.0
+
+    def _record(self, backend: LLMClient, ok: bool) -> None:
+        self._outcomes[backend.name].append(ok)
+        self.stats[backend.name]["requests"] += 1
+        if not ok:
+            self.stats[backend.name]["errors"] += 1
+
+    def _ranked(self, stream: bool) -> List[LLMClient]:
+        available = [
+            backend for backend in self.backends
+            if backend.breaker.state != OPEN or not backend.breaker.retry_in()
+        ]
+        if not available:
+            raise CircuitOpen("All LLM backends are unavailable")
+        latencies = {backend.name: backend.latency(0.5, stream) for backend in available}
+        measured = [latency for latency in latencies.values() if latency is not None]
+        fastest = min(measured) if measured else 0.0
+
+        def score(backend: LLMClient) -> float:
+            latency = latencies[backend.name]
+            errors = self.error_rate(backend.name)
+            if latency is None:
+                # Не измеренный бэкенд получает запросы первым, пока не начнёт ошибаться
+                latency = fastest if errors else 0.0
+            return latency * (1 + self.error_penalty * errors)
+
+        # Равные оценки (например, пока замеров нет) — в порядке LLM_BACKENDS
+        ranked = sorted(available, key=score)
+        if len(ranked) > 1 and random.random() < self.explore:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    @staticmethod
+    def _model(backend: LLMClient, role: str, model: Optional[str]) -> str:
+        return model or (backend.cheap_model if role == CHEAP else backend.model)
+
+    def _failed(self, backend: LLMClient, error: Exception) -> None:
+        if not isinstance(error, CircuitOpen):
+            # CircuitOpen — бэкенд пропущен без запроса, это не его ошибка
+            self._record(backend, False)
+        logging.warning(f"[LLM ROUTER] {backend.name} failed: {type(error).__name__}")
+
+    async def chat(
+        self,
+        messages: list,
+        timeout: Optional[float] = None,
+        usage: Optional[LLMUsage] = None,
+        role: str = MAIN,
+        **params,
+    ) -> str:
+        model = params.pop("model", None)
+        error = None
+        for i, backend in enumerate(self._ranked(stream=False)):
+            if i:
+                self.stats[backend.name]["fallbacks"] += 1
+            try:
+                reply = await backend.chat(
+                    messages, timeout=timeout, usage=usage, model=self._model(backend, role, model), **params
+                )
+            except Exception as e:
+                self._failed(backend, e)
+                error = e
+                continue
+            self._record(backend, True)
+            return reply
+        raise error
+
+    async def stream_chat(
+        self,
+        messages: list,
+        timeout: Optional[float] = None,
+        usage: Optional[LLMUsage] = None,
+        role: str = MAIN,
+        **params,
+    ) -> AsyncIterator[str]:
+        model = params.pop("model", None)
+        error = None
+        for i, backend in enumerate(self._ranked(stream=True)):
+            if i:
+                self.stats[backend.name]["fallbacks"] += 1
+            yielded = False
+            try:
+                async with aclosing(backend.stream_chat(
+                    messages, timeout=timeout, usage=usage, model=self._model(backend, role, model), **params
+                )) as stream:
+                    async for delta in stream:
+                        yielded = True
+                        yield delta
+            except Exception as e:
+                self._failed(backend, e)
+                if yielded:
+                    # Часть ответа уже в чате, склеивать с другим бэкендом нельзя
+                    raise
+                error = e
+                continue
+            self._record(backend, True)
+            return
+        raise error
+
+    def summary(self) -> List[str]:
+        """Строки для /metrics по каждому бэкенду."""
+        lines = []
+        for backend in self.backends:
+            stats = self.stats[backend.name]
+            client = backend.stats
+            latency = ", ".join(
+                f"{label} p50 {p50 * 1000:.0f} мс"
+                for label, p50 in (("ответ", backend.latency(0.5)), ("стрим", backend.latency(0.5, stream=True)))
+                if p50 is not None
+            ) or "задержки не измерены"
+            lines.append(
+                f"LLM {backend.name} ({backend.model}): {stats['requests']} запросов, "
+                f"ошибок {self.error_rate(backend.name):.0%} недавно / {stats['errors']} всего, "
+                f"подхватил {stats['fallbacks']}, {latency}, повторов {client['retried']}, "
+                f"таймаутов {client['timeouts']}, хеджей {client['hedged']} (выиграли {client['hedge_wins']}), "
+                f"цепь {backend.breaker.state} (размыканий {backend.breaker.opened}, отклонено {backend.breaker.rejected})"
+            )
+        return lines
+
+    async def aclose(self) -> None:
+        for backend in self.backends:
+            await backend.aclose()
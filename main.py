@@ -1,17 +1,38 @@
 import os
+import asyncio
 import logging
+import signal
+from datetime import time as dtime, timezone
+from typing import Optional
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 
 from message import Messenger
 from bot_commands import BotCommands
+from llm_router import LLMRouter
+from dispatcher import LLMDispatcher
+from update_processor import PerChatUpdateProcessor
+from timed_job_queue import TimedJobQueue
+from persistence import SQLitePersistence
+from webhook import BadUpdate, WebhookServer
+from sharding import run_sharded
+from autopost import AutopostScheduler
+from holiday_broadcast import HolidayBroadcast
+from response_cache import ResponseCache
+from outbound import OutboundSender
+from topic_pool import TopicPool
+from tiering import ChatTiering
+from metrics import REGISTRY, MetricsServer
+from resilience import CLOSED
+from services import SERVICES
 
 # Загрузка переменных из .env
 load_dotenv()
@@ -28,89 +49,191 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Ебать, здарова 2!")
 
 
+async def thaw_chat_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tiering = SERVICES.get("tiering")
+    if tiering is not None:
+        await tiering.on_update(update, context)
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    messenger: Messenger = context.bot_data["messenger"]
+    messenger: Messenger = SERVICES["messenger"]
     await messenger.handle_message(update, context)
 
 
 async def post_init(application):
     bot = await application.bot.get_me()
     application.bot_data["bot_username"] = bot.username
-    messenger = Messenger()
-    application.bot_data["messenger"] = messenger
-    application.bot_data["commands"] = BotCommands(messenger)
+    llm = LLMRouter.from_env()
+    SERVICES["llm"] = llm
+    autopost = AutopostScheduler(
+        application.job_queue, startup_spread=float(os.getenv("AUTOPOST_STARTUP_SPREAD", "1800"))
+    )
+    SERVICES["autopost"] = autopost
+    shard = application.bot_data.get("shard")
+    messenger = Messenger(
+        llm,
+        LLMDispatcher.from_env(),
+        streaming=os.getenv("LLM_STREAMING", "1") == "1",
+        stream_edit_interval=float(os.getenv("STREAM_EDIT_INTERVAL", "1.5")),
+        autopost=autopost,
+        cache=ResponseCache.from_env(),
+        trim_mode=os.getenv("HISTORY_TRIM_MODE", "block"),
+        sender=OutboundSender.from_env(shards=shard[1] if shard else 1),
+        topics=TopicPool.from_env(),
+    )
+    SERVICES["messenger"] = messenger
+    REGISTRY.gauge("bot_llm_in_flight", "LLM: запросов в работе", lambda: messenger.dispatcher.active)
+    REGISTRY.gauge("bot_llm_queue_depth", "LLM: очередь", messenger.dispatcher.depth)
+    REGISTRY.gauge("bot_send_queue_depth", "Telegram: очередь отправки", messenger.sender.depth)
+    REGISTRY.gauge(
+        "bot_llm_circuit_open", "LLM: бэкендов с разомкнутой цепью",
+        lambda: sum(backend.breaker.state != CLOSED for backend in llm.backends),
+    )
+    metrics_server = MetricsServer.from_env(shard[0] if shard else None)
+    tiering = ChatTiering.from_env(suffix=f".shard{shard[0]}" if shard else "")
+    if tiering is not None:
+        SERVICES["tiering"] = tiering
+        REGISTRY.gauge("bot_frozen_chats", "Замороженных чатов", tiering.__len__)
+        interval = float(os.getenv("TIERING_SWEEP_INTERVAL", "600"))
+        application.job_queue.run_repeating(tiering.sweep, interval, first=interval, name="tiering_sweep")
+    if metrics_server is not None:
+        metrics_server.start()
+        SERVICES["metrics_server"] = metrics_server
+    SERVICES["commands"] = BotCommands(messenger)
+    # Чаты из persistence ставим в расписание сразу, не загружая их данные
+    if isinstance(application.persistence, SQLitePersistence):
+        for chat_id, last_active, autopost_enabled, muted_until in application.persistence.known_chats():
+            autopost.seed(chat_id, last_active, autopost_enabled, muted_until)
+    autopost.start(messenger.check_scheduled)
+    messenger.prefetch_topics(bot.username)
+    broadcast = HolidayBroadcast.from_env(messenger)
+    SERVICES["holiday_broadcast"] = broadcast
+    application.job_queue.run_daily(broadcast.run, time=dtime(0, 0, tzinfo=timezone.utc), name="holiday_broadcast")
+    # Догнать сегодняшнюю рассылку, если бот перезапускался
+    application.job_queue.run_once(broadcast.run, 30, name="holiday_broadcast_startup")
     logging.info(f"Bot username: {bot.username}")
 
 
-# Wrapper callbacks that delegate to BotCommands stored in bot_data
+async def post_shutdown(application):
+    metrics_server = SERVICES.get("metrics_server")
+    if metrics_server is not None:
+        await metrics_server.stop()
+    autopost = SERVICES.get("autopost")
+    if autopost is not None:
+        await autopost.stop()
+    messenger = SERVICES.get("messenger")
+    if messenger is not None:
+        await messenger.topics.close()
+    llm = SERVICES.get("llm")
+    if llm is not None:
+        await llm.aclose()
+    if messenger is not None and messenger.cache is not None:
+        messenger.cache.close()
+    tiering = SERVICES.get("tiering")
+    if tiering is not None:
+        tiering.close()
+    SERVICES.clear()
+
+
+# Wrapper callbacks that delegate to BotCommands stored in SERVICES
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].help(update, context)
+    await SERVICES["commands"].help(update, context)
 
 
 async def cmd_set_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].set_prompt(update, context)
+    await SERVICES["commands"].set_prompt(update, context)
 
 
 async def cmd_get_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].get_prompt(update, context)
+    await SERVICES["commands"].get_prompt(update, context)
 
 
 async def cmd_reset_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].reset_prompt(update, context)
+    await SERVICES["commands"].reset_prompt(update, context)
 
 
 async def cmd_set_history_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].set_history_limit(update, context)
+    await SERVICES["commands"].set_history_limit(update, context)
+
+
+async def cmd_set_token_budget(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await SERVICES["commands"].set_token_budget(update, context)
+
+
+async def cmd_set_coalesce_window(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await SERVICES["commands"].set_coalesce_window(update, context)
+
+
+async def cmd_set_trim_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await SERVICES["commands"].set_trim_mode(update, context)
 
 
 async def cmd_set_autopost_interval(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].set_autopost_interval(update, context)
+    await SERVICES["commands"].set_autopost_interval(update, context)
 
 
 async def cmd_enable_autopost(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].enable_autopost(update, context)
+    await SERVICES["commands"].enable_autopost(update, context)
 
 
 async def cmd_disable_autopost(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].disable_autopost(update, context)
+    await SERVICES["commands"].disable_autopost(update, context)
 
 
 async def cmd_enable_reactions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].enable_reactions(update, context)
+    await SERVICES["commands"].enable_reactions(update, context)
 
 
 async def cmd_disable_reactions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].disable_reactions(update, context)
+    await SERVICES["commands"].disable_reactions(update, context)
 
 
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].status(update, context)
+    await SERVICES["commands"].status(update, context)
 
 
 async def cmd_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].metrics(update, context)
+    await SERVICES["commands"].metrics(update, context)
 
 
 async def cmd_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].send_test(update, context)
+    await SERVICES["commands"].send_test(update, context)
 
 
 async def cmd_holiday_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot_data["commands"].holiday_check(update, context)
-
-
-def main():
-    if not TELEGRAM_TOKEN:
-        raise RuntimeError("TELEGRAM_TOKEN must be set")
-
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(post_init).build()
-
+    await SERVICES["commands"].holiday_check(update, context)
+
+
+def build_application(shard_id: Optional[int] = None, updater: bool = True, bot=None):
+    builder = ApplicationBuilder()
+    # bot — готовый ExtBot вместо токена (нагрузочный тест подставляет фейковый)
+    builder = builder.bot(bot) if bot is not None else builder.token(TELEGRAM_TOKEN)
+    builder = (
+        builder
+        .concurrent_updates(PerChatUpdateProcessor(int(os.getenv("MAX_CONCURRENT_UPDATES", "256"))))
+        .job_queue(TimedJobQueue())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not updater:
+        # Апдейты приходят извне (webhook-фронт или шардирование)
+        builder = builder.updater(None)
+    persistence = SQLitePersistence.from_env(suffix=f".shard{shard_id}" if shard_id is not None else "")
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
+
+    # Холодные чаты размораживаются раньше всех остальных хендлеров
+    application.add_handler(TypeHandler(Update, thaw_chat_data), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", cmd_help))
     application.add_handler(CommandHandler("set_prompt", cmd_set_prompt))
     application.add_handler(CommandHandler("get_prompt", cmd_get_prompt))
     application.add_handler(CommandHandler("reset_prompt", cmd_reset_prompt))
     application.add_handler(CommandHandler("set_history_limit", cmd_set_history_limit))
+    application.add_handler(CommandHandler("set_token_budget", cmd_set_token_budget))
+    application.add_handler(CommandHandler("set_coalesce_window", cmd_set_coalesce_window))
+    application.add_handler(CommandHandler("set_trim_mode", cmd_set_trim_mode))
     application.add_handler(CommandHandler("set_autopost_interval", cmd_set_autopost_interval))
     application.add_handler(CommandHandler("enable_autopost", cmd_enable_autopost))
     application.add_handler(CommandHandler("disable_autopost", cmd_disable_autopost))
@@ -120,11 +243,76 @@ def main():
     application.add_handler(CommandHandler("metrics", cmd_metrics))
     application.add_handler(CommandHandler("send_test", cmd_send_test))
     application.add_handler(CommandHandler("holiday_check", cmd_holiday_check))
-    application.add_handler(CommandHandler("clear_history", lambda u, c: c.bot_data["commands"].clear_history(u, c)))
-    application.add_handler(CommandHandler("mute", lambda u, c: c.bot_data["commands"].mute(u, c)))
-    application.add_handler(CommandHandler("unmute", lambda u, c: c.bot_data["commands"].unmute(u, c)))
+    application.add_handler(CommandHandler("clear_history", lambda u, c: SERVICES["commands"].clear_history(u, c)))
+    application.add_handler(CommandHandler("mute", lambda u, c: SERVICES["commands"].mute(u, c)))
+    application.add_handler(CommandHandler("unmute", lambda u, c: SERVICES["commands"].unmute(u, c)))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+
+async def run_webhook(application) -> None:
+    """Запуск в режиме webhook: свой HTTP-сервер вместо run_polling."""
+
+    async def put_update(data: dict) -> None:
+        try:
+            update = Update.de_json(data, application.bot)
+        except Exception as exc:
+            raise BadUpdate(f"{type(exc).__name__}: {exc}") from exc
+        await application.update_queue.put(update)
+
+    def is_ready() -> bool:
+        return application.running and "messenger" in SERVICES
+
+    server = WebhookServer.from_env(put_update, is_ready)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    server.start()
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        # WEBHOOK_URL — публичный адрес, под которым Telegram видит сервер
+        certificate = open(server.cert, "rb") if server.cert else None
+        try:
+            await application.bot.set_webhook(
+                url=webhook_url.rstrip("/") + server.url_path,
+                secret_token=server.secret_token,
+                certificate=certificate,
+            )
+        finally:
+            if certificate is not None:
+                certificate.close()
+    logging.info("Бот запущен (webhook)...")
+    try:
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def main():
+    if not TELEGRAM_TOKEN:
+        raise RuntimeError("TELEGRAM_TOKEN must be set")
 
+    shards = int(os.getenv("SHARDS", "1"))
+    SQLitePersistence.check_shards(shards)
+    if shards > 1:
+        run_sharded(build_application, TELEGRAM_TOKEN, shards)
+        return
+    application = build_application()
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        asyncio.run(run_webhook(application))
+        return
     logging.info("Бот запущен...")
     application.run_polling()
 
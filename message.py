@@ -1,24 +1,83 @@
-import os
+import asyncio
 import logging
 import random
+from contextlib import aclosing
 from datetime import datetime, timedelta
-from typing import Optional
-import requests
-from telegram import ReactionTypeEmoji, Update
+from typing import Dict, FrozenSet, Optional, Set
+from telegram import Message, ReactionTypeEmoji, Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
 
 from scoring import Scorer
+from metrics import SCORER_SECONDS
+from text_matcher import BOT_TAG, HELP, REACT_FUNNY, REACT_LOVE, REACT_SHOCK, matcher_for
 from holiday_evaluator import HolidayEvaluator
+from llm_client import LLMUsage
+from llm_router import CHEAP, LLMRouter
+from history import TRIM_BLOCK, ChatHistory, estimate_tokens, get_history
+from dispatcher import DispatchDropped, LLMDispatcher, Priority
+from autopost import AutopostScheduler
+from response_cache import ResponseCache
+from outbound import OutboundSender, SendDropped
+from resilience import CircuitOpen
+from topic_pool import CONTENT_TYPES, TopicPool
+from services import SERVICES
+from tiering import thaw_chat
 
 
 class Messenger:
     """Handle bot reactions and messages."""
 
     MAX_HISTORY = 50
+    # Бюджет токенов на запрос (системный промпт + история), меняется /set_token_budget
+    TOKEN_BUDGET = 6000
+    NO_RESPONSE = "NO_RESPONSE"
+    FALLBACK_REPLY = "Бля в мозгу ошибка"
+    # Окно (сек), в течение которого immediate-сообщения чата склеиваются в один ответ.
+    # Каждый прямой ответ ждёт его целиком, поэтому оно меньше секунды
+    COALESCE_WINDOW = 0.5
+    # При блочной обрезке история при переполнении сжимается до этой доли лимитов
+    TRIM_LOW_WATERMARK = 0.5
+    # Отложенный ответ не отправляется, если с момента планирования в чате было больше сообщений
+    DELAYED_MAX_BACKLOG = 20
 
-    def __init__(self):
-        self.api_key = os.getenv("DEEPSEEK_API_KEY")
+    def __init__(
+        self,
+        llm: LLMRouter,
+        dispatcher: Optional[LLMDispatcher] = None,
+        streaming: bool = True,
+        stream_edit_interval: float = 1.5,
+        autopost: Optional[AutopostScheduler] = None,
+        cache: Optional[ResponseCache] = None,
+        trim_mode: str = TRIM_BLOCK,
+        sender: Optional[OutboundSender] = None,
+        topics: Optional[TopicPool] = None,
+    ):
+        self.llm = llm
+        # Кэш ответов на запросы без истории (одно user-сообщение)
+        self.cache = cache
+        # Режим обрезки истории по умолчанию, чат может сменить /set_trim_mode
+        self.trim_mode = trim_mode
+        self.dispatcher = dispatcher or LLMDispatcher()
+        # Все вызовы Bot API в чаты идут через общую очередь с лимитами Telegram
+        self.sender = sender or OutboundSender()
+        # Темы автосообщений готовятся заранее, пока очередь LLM пуста
+        self.topics = topics or TopicPool()
+        if self.topics.idle is None:
+            self.topics.idle = lambda: not self.dispatcher.depth()
+        self.autopost = autopost
         self.system_prompt_override = None
+        # Стриминг ответов: первое сообщение сразу, дальше правки не чаще stream_edit_interval
+        self.streaming = streaming
+        self.stream_edit_interval = stream_edit_interval
+        # chat_id -> накопленная пачка immediate-сообщений, ожидающая ответа
+        self._pending_batches: Dict[int, dict] = {}
+        # chat_id -> запланированный отложенный ответ (не больше одного на чат)
+        self._delayed: Dict[int, dict] = {}
+        self.delayed_stats = {"executed": 0, "superseded": 0, "cancelled": 0, "skipped": 0}
+        self._prompt_tokens = (None, 0)
+        # Отправки без ожидания в хендлере (смех, реакции); ссылки держим, пока задача идёт
+        self._background: Set[asyncio.Task] = set()
 
     def _default_system_prompt(self, bot_username: str) -> str:
         return f"""\
@@ -45,46 +104,253 @@ class Messenger:
             return self.system_prompt_override
         return self._default_system_prompt(bot_username)
 
-    def _call_deepseek(self, messages, bot_username: str) -> str:
-        url = "https://api.deepseek.com/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
+    def system_prompt_tokens(self, bot_username: str) -> int:
+        prompt = self.get_current_system_prompt(bot_username)
+        if self._prompt_tokens[0] != prompt:
+            self._prompt_tokens = (prompt, estimate_tokens(prompt))
+        return self._prompt_tokens[1]
+
+    def history_token_budget(self, chat_data: dict, bot_username: str) -> int:
+        """Сколько токенов остаётся на историю после системного промпта."""
+        budget = chat_data.get("token_budget", self.TOKEN_BUDGET)
+        return max(budget - self.system_prompt_tokens(bot_username), 0)
+
+    def trim_history(self, chat_data: dict, bot_username: str) -> int:
+        """Подрезает историю чата под его лимиты и режим обрезки."""
+        block = chat_data.get("trim_mode", self.trim_mode) == TRIM_BLOCK
+        return get_history(chat_data).trim(
+            chat_data.get("history_limit", self.MAX_HISTORY),
+            self.history_token_budget(chat_data, bot_username),
+            self.TRIM_LOW_WATERMARK if block else None,
+        )
+
+    def _append_history(self, chat_data: dict, bot_username: str, role: str, content: str) -> ChatHistory:
+        history = get_history(chat_data)
+        history.append(role, content)
+        self.trim_history(chat_data, bot_username)
+        return history
+
+    async def _call_deepseek(
+        self,
+        messages,
+        bot_username: str,
+        timeout: Optional[float] = None,
+        priority: Priority = Priority.REPLY,
+        system_prompt: Optional[str] = None,
+        use_cache: bool = False,
+        usage: Optional[LLMUsage] = None,
+        **params,
+    ) -> str:
+        system_prompt = system_prompt or self.get_current_system_prompt(bot_username)
+        key = None
+        # Кэш — только по явному запросу: ответ в чат с одним сообщением в
+        # истории тоже выглядит как запрос без контекста, но кэшировать его нельзя
+        if use_cache and self.cache is not None and len(messages) == 1:
+            key = self.cache.make_key(self.llm.model, system_prompt, messages, params)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        async with self.dispatcher.slot(priority):
+            reply = await self.llm.chat(
+                [{"role": "system", "content": system_prompt}] + messages,
+                timeout=timeout,
+                usage=usage,
+                **params,
+            )
+        if key is not None and reply.strip():
+            self.cache.put(key, reply)
+        return reply
+
+    def _stream_deepseek(self, messages, bot_username: str, usage: Optional[LLMUsage] = None):
         system_prompt = self.get_current_system_prompt(bot_username)
-        data = {
-            "model": "deepseek-chat",
-            "messages": [{"role": "system", "content": system_prompt}] + messages,
-        }
-        response = requests.post(url, headers=headers, json=data, timeout=30)
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-
-    async def _maybe_add_reaction(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return self.llm.stream_chat([{"role": "system", "content": system_prompt}] + messages, usage=usage)
+
+    def _visible_text(self, text: str) -> str:
+        """Отрезает хвост, который может оказаться началом NO_RESPONSE."""
+        for k in range(min(len(self.NO_RESPONSE) - 1, len(text)), 0, -1):
+            if text.endswith(self.NO_RESPONSE[:k]):
+                return text[:-k]
+        return text
+
+    async def _edit_streamed(
+        self, sent: Message, text: str, priority: Priority = Priority.REPLY, final: bool = False
+    ) -> float:
+        """Правит сообщение; возвращает паузу, если правка не прошла.
+
+        Промежуточные правки при упоре в лимиты отбрасываются, финальная
+        ждёт своей очереди.
+        """
+        try:
+            await self.sender.send(
+                sent.chat_id,
+                lambda: sent.edit_text(text),
+                priority,
+                droppable=not final,
+                retries=None if final else 0,
+            )
+        except SendDropped:
+            return self.stream_edit_interval
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logging.warning(f"[STREAM EDIT ERROR] {e}")
+        return 0.0
+
+    async def _stream_reply(
+        self,
+        msg: Message,
+        messages,
+        bot_username: str,
+        priority: Priority = Priority.REPLY,
+        usage: Optional[LLMUsage] = None,
+    ) -> Optional[str]:
+        """Отправляет ответ по мере генерации и возвращает итоговый текст.
+
+        Первый непустой кусок уходит сразу, дальше сообщение редактируется
+        пачками не чаще stream_edit_interval. Если в тексте появился
+        NO_RESPONSE, генерация прерывается, а уже отправленное удаляется.
+        """
+        loop = asyncio.get_running_loop()
+        text = ""
+        shown = ""
+        sent = None
+        next_edit = 0.0
+        try:
+            async with self.dispatcher.slot(priority), aclosing(
+                self._stream_deepseek(messages, bot_username, usage)
+            ) as stream:
+                async for delta in stream:
+                    text += delta
+                    if self.NO_RESPONSE in text:
+                        if sent is not None:
+                            try:
+                                await self.sender.send(sent.chat_id, sent.delete, priority)
+                            except Exception:
+                                logging.exception("Failed to delete streamed message")
+                        return None
+                    visible = self._visible_text(text).strip()
+                    if not visible or visible == shown:
+                        continue
+                    now = loop.time()
+                    if sent is None:
+                        sent = await self.sender.send(msg.chat_id, lambda: msg.reply_text(visible), priority)
+                        shown = visible
+                        next_edit = now + self.stream_edit_interval
+                    elif now >= next_edit:
+                        pause = await self._edit_streamed(sent, visible, priority)
+                        if not pause:
+                            shown = visible
+                        next_edit = now + max(pause, self.stream_edit_interval)
+        except DispatchDropped as e:
+            logging.info(f"[DROPPED] Reply to {msg.message_id}: {e}")
+            return None
+        except CircuitOpen as e:
+            # Стрим не начался: API недоступно, отвечаем заглушкой сразу
+            logging.warning(f"[CIRCUIT OPEN] Reply to {msg.message_id}: {e}")
+            await self.sender.send(msg.chat_id, lambda: msg.reply_text(self.FALLBACK_REPLY), priority)
+            return self.FALLBACK_REPLY
+        except Exception:
+            logging.exception("DeepSeek streaming failed")
+            if sent is None:
+                await self.sender.send(msg.chat_id, lambda: msg.reply_text(self.FALLBACK_REPLY), priority)
+                return self.FALLBACK_REPLY
+            return shown
+        final = text.strip()
+        if not final:
+            return None
+        if sent is None:
+            await self.sender.send(msg.chat_id, lambda: msg.reply_text(final), priority)
+        elif final != shown:
+            await self._edit_streamed(sent, final, priority, final=True)
+        return final
+
+    async def _reply_with_deepseek(
+        self,
+        msg: Message,
+        chat_data: dict,
+        bot_username: str,
+        extra: Optional[list] = None,
+        priority: Priority = Priority.REPLY,
+    ) -> None:
+        username = msg.from_user.username or "unknown"
+        # extra — служебные сообщения только для этого запроса, в историю не попадают
+        messages = get_history(chat_data).messages() + (extra or [])
+        usage = LLMUsage.for_chat(chat_data)
+        if self.streaming:
+            reply = await self._stream_reply(msg, messages, bot_username, priority, usage)
+            if not reply:
+                return
+        else:
+            try:
+                reply = (await self._call_deepseek(messages, bot_username, priority=priority, usage=usage)).strip()
+            except DispatchDropped as e:
+                logging.info(f"[DROPPED] Reply to {msg.message_id}: {e}")
+                return
+            except CircuitOpen as e:
+                logging.warning(f"[CIRCUIT OPEN] Reply to {msg.message_id}: {e}")
+                reply = self.FALLBACK_REPLY
+            except Exception:
+                logging.exception("DeepSeek API failed")
+                reply = self.FALLBACK_REPLY
+            if not reply or reply.endswith(self.NO_RESPONSE):
+                return
+            await self.sender.send(msg.chat_id, lambda: msg.reply_text(reply), priority)
+        logging.info(f"[REPLY] To {username}: {reply}")
+        self._append_history(chat_data, bot_username, "assistant", reply)
+
+    async def _maybe_add_reaction(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE, features: FrozenSet[str] = frozenset()
+    ):
         reactions_enabled = context.chat_data.get("reactions_enabled", True)
         if not reactions_enabled:
             return
         if random.random() > 0.05:
             return
-        text = update.message.text.lower()
-        if any(word in text for word in ["ахах", "хаха", "смешно", "рж", "лол"]):
+        if REACT_FUNNY in features:
             emoji = "😂"
-        elif any(word in text for word in ["спасибо", "красава", "огонь", "топ"]):
+        elif REACT_LOVE in features:
             emoji = "❤️"
-        elif any(word in text for word in ["жесть", "пиздец", "капец", "ужас"]):
+        elif REACT_SHOCK in features:
             emoji = random.choice(["😭", "😱"])
         else:
             emoji = random.choice(["👍", "🔥", "👎", "😐", "🤔"])
+        chat_id = update.effective_chat.id
         try:
-            await context.bot.set_message_reaction(
-                chat_id=update.effective_chat.id,
-                message_id=update.message.message_id,
-                reaction=ReactionTypeEmoji(emoji),
+            # Реакции — первое, чем жертвуем при упоре в лимиты Telegram
+            await self.sender.send(
+                chat_id,
+                lambda: context.bot.set_message_reaction(
+                    chat_id=chat_id,
+                    message_id=update.message.message_id,
+                    reaction=ReactionTypeEmoji(emoji),
+                ),
+                Priority.BACKGROUND,
+                droppable=True,
+                retries=0,
             )
             logging.info(f"[REACTION] Sent {emoji}  to message {update.message.message_id}")
+        except SendDropped as e:
+            logging.info(f"[REACTION DROPPED] {e}")
         except Exception as e:
             logging.warning(f"[REACTION ERROR] {e}")
 
+    def _spawn(self, coroutine) -> None:
+        """Запускает отправку, не задерживая обработку апдейтов чата лимитами Telegram."""
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _send_laughter(self, msg: Message, reply: str) -> None:
+        try:
+            # Смех ценен только сразу: при упоре в лимиты чата его не жалко
+            await self.sender.send(msg.chat_id, lambda: msg.reply_text(reply), droppable=True)
+        except SendDropped as e:
+            logging.info(f"[LAUGHTER DROPPED] {e}")
+        except Exception as e:
+            logging.warning(f"[LAUGHTER ERROR] {e}")
+
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         msg = update.message
         user = msg.from_user
@@ -100,49 +366,26 @@ class Messenger:
                     return
             except Exception:
                 pass
+        # Все текстовые признаки (тег, помощь, смех, слова для реакций) — за один проход
+        features = matcher_for(context.bot_data["bot_username"]).scan(user_text)
         # Mention-based help: '@bot помощь' / '@bot команды'
         try:
-            bot_username = context.bot_data.get("bot_username", "").lower()
-            lower_text = user_text.lower()
-            if bot_username and (f"@{bot_username}" in lower_text):
-                if any(k in lower_text for k in ["помощь", "команды", "help", "команда"]):
-                    await context.bot_data["commands"].handle_mention_help(update, context)
-                    return
+            if BOT_TAG in features and HELP in features:
+                await SERVICES["commands"].handle_mention_help(update, context)
+                return
         except Exception:
             logging.exception("Mention help handling failed")
-        # Lazy-init background job (enabled by default unless disabled explicitly)
-        if context.chat_data.get("autopost_enabled", True):
-            interval = context.chat_data.get("autopost_interval", 3600)
-            if "background_job" not in context.chat_data:
-                context.chat_data["background_job"] = context.job_queue.run_repeating(
-                    self.check_scheduled,
-                    interval=interval,
-                    first=interval,
-                    chat_id=update.effective_chat.id,
-                )
-        scorer = Scorer(context.chat_data, context.bot_data["bot_username"], context.bot.id)
-        decision = scorer.evaluate(update)
-        await self._maybe_add_reaction(update, context)
+        # Сдвинуть срок автосообщения (enabled by default unless disabled explicitly)
+        if self.autopost is not None:
+            self.autopost.touch(update.effective_chat.id, context.chat_data)
+        scorer = Scorer.for_chat(context.chat_data, context.bot_data["bot_username"], context.bot.id)
+        with SCORER_SECONDS.time():
+            decision = scorer.evaluate(update, features)
+        self._spawn(self._maybe_add_reaction(update, context, features))
         if not decision.get("respond"):
             return
         mode = decision["mode"]
         bot_username = context.bot_data["bot_username"]
-        history = context.chat_data.setdefault("history", [])
-        history_limit = context.chat_data.get("history_limit", self.MAX_HISTORY)
-
-        async def reply_with_deepseek():
-            try:
-                reply = self._call_deepseek(history, bot_username).strip()
-            except Exception:
-                logging.exception("DeepSeek API failed")
-                reply = "Бля в мозгу ошибка"
-            if not reply or reply.endswith("NO_RESPONSE"):
-                return
-            await msg.reply_text(reply)
-            logging.info(f"[REPLY] To {username}: {reply}")
-            history.append({"role": "assistant", "content": reply})
-            if len(history) > history_limit:
-                history[:] = history[-history_limit:]
 
         if mode == "laughter":
             reply = random.choice([
@@ -153,40 +396,122 @@ class Messenger:
                 "asfsaasfsafsafasfas",
                 "смешно бля",
             ])
-            await msg.reply_text(reply)
+            self._spawn(self._send_laughter(msg, reply))
             return
         elif mode == "immediate":
-            history.append({"role": "user", "content": user_text})
-            if len(history) > history_limit:
-                history[:] = history[-history_limit:]
-            await reply_with_deepseek()
+            # Сейчас ответим и так, отложенный ответ в этом чате больше не нужен
+            self.cancel_delayed(update.effective_chat.id, context.chat_data, bot_username)
+            self._append_history(context.chat_data, bot_username, "user", user_text)
+            window = context.chat_data.get("coalesce_window", self.COALESCE_WINDOW)
+            if window <= 0:
+                await self._reply_with_deepseek(msg, context.chat_data, bot_username)
+                return
+            chat_id = update.effective_chat.id
+            batch = self._pending_batches.get(chat_id)
+            if batch is not None:
+                # Ответ уже запланирован: просто отвечаем на самое свежее сообщение
+                batch["msg"] = msg
+                batch["users"].append(username)
+                return
+            self._pending_batches[chat_id] = {"msg": msg, "users": [username]}
+            context.job_queue.run_once(self._flush_batch, window, chat_id=chat_id)
             return
         elif mode == "delayed":
             delay = decision.get("delay", 60)
-
-            async def delayed_reply(context: ContextTypes.DEFAULT_TYPE):
-                history.append({"role": "user", "content": user_text})
-                if len(history) > history_limit:
-                    history[:] = history[-history_limit:]
-                await reply_with_deepseek()
-
-            context.job_queue.run_once(delayed_reply, delay)
+            chat_id = update.effective_chat.id
+            texts = []
+            pending = self._delayed.pop(chat_id, None)
+            if pending is not None:
+                # Новый отложенный ответ заменяет старый, текст старого сохраняется для истории
+                pending["job"].schedule_removal()
+                texts = pending["texts"]
+                self.delayed_stats["superseded"] += 1
+            texts.append(user_text)
+            self._delayed[chat_id] = {
+                "msg": msg,
+                "texts": texts,
+                "counter": scorer.message_counter,
+                "job": context.job_queue.run_once(self._fire_delayed, delay, chat_id=chat_id),
+            }
             logging.info(f"[DELAYED] Scheduled reply in {delay} seconds")
             return
 
-    async def send_self_message(self, context: ContextTypes.DEFAULT_TYPE):
-        now = datetime.utcnow()
-        # Do not send autoposts when muted
+    def cancel_delayed(self, chat_id: int, chat_data: dict, bot_username: str) -> bool:
+        """Снимает отложенный ответ чата; его сообщения уходят в историю без ответа."""
+        pending = self._delayed.pop(chat_id, None)
+        if pending is None:
+            return False
+        pending["job"].schedule_removal()
+        for text in pending["texts"]:
+            self._append_history(chat_data, bot_username, "user", text)
+        self.delayed_stats["cancelled"] += 1
+        logging.info(f"[DELAYED] Cancelled reply in chat {chat_id}")
+        return True
+
+    async def _fire_delayed(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat_id = context.job.chat_id
+        pending = self._delayed.get(chat_id)
+        if pending is None or pending["job"] is not context.job:
+            return
+        del self._delayed[chat_id]
+        bot_username = context.bot_data["bot_username"]
+        for text in pending["texts"]:
+            self._append_history(context.chat_data, bot_username, "user", text)
+        # Перепроверка: за время ожидания чат могли замьютить или разговор ушёл далеко
         muted_until = context.chat_data.get("muted_until")
-        if muted_until and now < muted_until:
+        backlog = Scorer.for_chat(context.chat_data, bot_username, context.bot.id).message_counter - pending["counter"]
+        if (muted_until and datetime.utcnow() < muted_until) or backlog > self.DELAYED_MAX_BACKLOG:
+            self.delayed_stats["skipped"] += 1
+            logging.info(f"[DELAYED] Skipped stale reply in chat {chat_id} ({backlog} messages since)")
             return
-        last = context.chat_data.get("last_message_time")
-        if last and now - last <= timedelta(days=1):
+        self.delayed_stats["executed"] += 1
+        await self._reply_with_deepseek(pending["msg"], context.chat_data, bot_username, priority=Priority.DELAYED)
+
+    async def _flush_batch(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Один ответ LLM на все immediate-сообщения, накопившиеся за окно."""
+        batch = self._pending_batches.pop(context.job.chat_id, None)
+        if batch is None:
+            return
+        # За время окна чат могли замьютить
+        muted_until = context.chat_data.get("muted_until")
+        if muted_until and datetime.utcnow() < muted_until:
+            logging.info(f"[COALESCE] Chat {context.job.chat_id} muted, {len(batch['users'])} messages left unanswered")
             return
         bot_username = context.bot_data["bot_username"]
-        history = context.chat_data.setdefault("history", [])
-        history_limit = context.chat_data.get("history_limit", self.MAX_HISTORY)
-        content_type = random.choice(["шутку", "анекдот", "ситуацию"])
+        users = list(dict.fromkeys(batch["users"]))
+        extra = None
+        if len(users) > 1:
+            names = ", ".join(f"@{u}" for u in users)
+            extra = [{
+                "role": "user",
+                "content": f"(Тебе только что написали несколько человек: {names}. Ответь всем одним сообщением.)",
+            }]
+        if len(batch["users"]) > 1:
+            logging.info(f"[COALESCE] {len(batch['users'])} messages -> 1 reply in chat {context.job.chat_id}")
+        await self._reply_with_deepseek(batch["msg"], context.chat_data, bot_username, extra)
+
+    def prefetch_topics(self, bot_username: str) -> None:
+        """Заполняет пул тем для текущего промпта (при старте бота)."""
+        system_prompt = self.get_current_system_prompt(bot_username)
+        for content_type in CONTENT_TYPES:
+            self.topics.refill(
+                TopicPool.key(system_prompt, content_type),
+                lambda content_type=content_type: self._generate_topic(bot_username, content_type),
+            )
+
+    async def _generate_topic(
+        self,
+        bot_username: str,
+        content_type: str,
+        usage: Optional[LLMUsage] = None,
+        use_cache: bool = False,
+    ) -> Optional[str]:
+        """Тема для автосообщения (дешёвая модель).
+
+        Фоновое пополнение пула идёт мимо кэша ответов — пулу нужны разные
+        темы; кэш используется, когда тему приходится придумывать на месте.
+        """
+        now = datetime.utcnow()
         system_prompt = self.get_current_system_prompt(bot_username)
         topic_prompt = (
             f"Придумай ОДНУ тему на которую можно сделать {content_type}, учитывая роль которую отыгрывает бот: {system_prompt}"
@@ -195,62 +520,74 @@ class Messenger:
             holidays = HolidayEvaluator().evaluate()
             holiday_str = f" Праздник сегодня: {', '.join(holidays)}." if holidays else ""
             topic_prompt += f" Время и дата: {now.strftime('%d.%m.%Y %H:%M')}.{holiday_str}"
-        try:
-            topic = self._call_deepseek([{"role": "user", "content": topic_prompt}], bot_username).strip()
-        except Exception:
-            logging.exception("DeepSeek API failed")
+        topic = (await self._call_deepseek(
+            [{"role": "user", "content": topic_prompt}],
+            bot_username,
+            priority=Priority.BACKGROUND,
+            use_cache=use_cache,
+            usage=usage,
+            role=CHEAP,
+        )).strip()
+        if not topic or topic.endswith(self.NO_RESPONSE):
+            return None
+        return topic
+
+    async def send_self_message(self, context: ContextTypes.DEFAULT_TYPE):
+        now = datetime.utcnow()
+        # Do not send autoposts when muted
+        muted_until = context.chat_data.get("muted_until")
+        if muted_until and now < muted_until:
             return
-        if not topic or topic.endswith("NO_RESPONSE"):
+        last = context.chat_data.get("last_message_time")
+        if last and now - last <= timedelta(days=1):
             return
+        # Молчащий сутки чат почти наверняка заморожен; размораживаем, только когда пишем
+        await thaw_chat(context.job.chat_id, context.chat_data)
+        bot_username = context.bot_data["bot_username"]
+        history = get_history(context.chat_data)
+        content_type = random.choice(CONTENT_TYPES)
+        key = TopicPool.key(self.get_current_system_prompt(bot_username), content_type)
+        topic = self.topics.take(key)
+        # Взятую тему сразу заменяем новой в фоне
+        self.topics.refill(key, lambda: self._generate_topic(bot_username, content_type))
+        if topic is None:
+            try:
+                topic = await self._generate_topic(
+                    bot_username, content_type, LLMUsage.for_chat(context.chat_data), use_cache=True
+                )
+            except DispatchDropped as e:
+                logging.info(f"[DROPPED] Self message topic for chat {context.job.chat_id}: {e}")
+                return
+            except Exception:
+                logging.exception("DeepSeek API failed")
+                return
+            if not topic:
+                return
         prompt = (
             f"Сейчас {now.strftime('%d.%m.%Y %H:%M')}. Напиши {content_type} в чат без обращения к кому-то конкретно, будь в своей роли."
             f" Тема: {topic}"
         )
-        messages = history + [{"role": "user", "content": prompt}]
+        messages = history.messages() + [{"role": "user", "content": prompt}]
         try:
-            reply = self._call_deepseek(messages, bot_username).strip()
+            reply = (await self._call_deepseek(
+                messages, bot_username, priority=Priority.BACKGROUND, usage=LLMUsage.for_chat(context.chat_data)
+            )).strip()
+        except DispatchDropped as e:
+            logging.info(f"[DROPPED] Self message for chat {context.job.chat_id}: {e}")
+            return
         except Exception:
             logging.exception("DeepSeek API failed")
             return
         if not reply or reply.endswith("NO_RESPONSE"):
             return
-        await context.bot.send_message(chat_id=context.job.chat_id, text=reply)
-        history.append({"role": "assistant", "content": reply})
-        if len(history) > history_limit:
-            history[:] = history[-history_limit:]
+        chat_id = context.job.chat_id
+        await self.sender.send(
+            chat_id, lambda: context.bot.send_message(chat_id=chat_id, text=reply), Priority.BACKGROUND
+        )
+        self._append_history(context.chat_data, bot_username, "assistant", reply)
         context.chat_data["last_message_time"] = now
         logging.info(f"[SELF MESSAGE] {reply}")
 
-    async def send_holiday_congrats(self, context: ContextTypes.DEFAULT_TYPE):
-        today = datetime.utcnow().date()
-        if context.chat_data.get("holiday_sent_date") == today:
-            return
-        holidays = HolidayEvaluator().evaluate()
-        if not holidays:
-            return
-        bot_username = context.bot_data["bot_username"]
-        history = context.chat_data.setdefault("history", [])
-        history_limit = context.chat_data.get("history_limit", self.MAX_HISTORY)
-        holiday_names = ", ".join(holidays)
-        prompt = (
-            f"Сегодня {today.strftime('%d.%m.%Y')} {holiday_names}. Поздравь чат от своего имени, сохраняя стиль."
-        )
-        messages = history + [{"role": "user", "content": prompt}]
-        try:
-            reply = self._call_deepseek(messages, bot_username).strip()
-        except Exception:
-            logging.exception("DeepSeek API failed")
-            return
-        if not reply or reply.endswith("NO_RESPONSE"):
-            return
-        await context.bot.send_message(chat_id=context.job.chat_id, text=reply)
-        history.append({"role": "assistant", "content": reply})
-        if len(history) > history_limit:
-            history[:] = history[-history_limit:]
-        context.chat_data["holiday_sent_date"] = today
-        context.chat_data["last_message_time"] = datetime.utcnow()
-        logging.info(f"[HOLIDAY MESSAGE] {reply}")
-
     async def check_scheduled(self, context: ContextTypes.DEFAULT_TYPE):
+        # Праздники рассылает HolidayBroadcast для всех чатов разом
         await self.send_self_message(context)
-        await self.send_holiday_congrats(context)
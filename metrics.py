@@ -0,0 +1,202 @@
+# metrics.py
+"""
+Метрики процесса: гистограммы задержек и текущие значения (gauges).
+
+Все метрики живут в одном реестре REGISTRY и заводятся здесь же, чтобы
+имена и описания были в одном месте. Их можно отдать:
+- по HTTP в формате Prometheus (MetricsServer, порт METRICS_PORT; у
+  шардов — METRICS_PORT + номер шарда);
+- коротким текстом с p50/p95/p99 в команде /metrics (REGISTRY.summary()).
+
+Гистограммы хранят только счётчики по корзинам, поэтому память не растёт;
+перцентили оцениваются линейной интерполяцией внутри корзины, как это
+делает histogram_quantile в Prometheus.
+"""
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence
+
+import tornado.httpserver
+import tornado.web
+
+# Границы корзин (сек): от миллисекунды до минуты
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Histogram:
+    """Bucketed latency histogram in seconds."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # последняя — +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= target and count:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (target - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum:.6f}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Gauge:
+    """Current value: set/inc/dec by hand or read from a callback at scrape time."""
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def get(self) -> float:
+        if self.fn is not None:
+            try:
+                return float(self.fn())
+            except Exception:
+                logging.exception(f"Gauge {self.name} callback failed")
+                return float("nan")
+        return self.value
+
+    def expose(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.get():g}"]
+
+
+class Registry:
+    """Named metrics of this process."""
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Histogram(name, help, buckets)
+        return metric
+
+    def gauge(self, name: str, help: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Gauge(name, help, fn)
+        elif fn is not None:
+            metric.fn = fn
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Строки для /metrics: перцентили гистограмм и текущие значения."""
+        lines = []
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                if not metric.count:
+                    continue
+                p50, p95, p99 = (metric.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+                lines.append(f"{metric.help}: n={metric.count}, p50 {p50:.0f} мс, p95 {p95:.0f} мс, p99 {p99:.0f} мс")
+            else:
+                lines.append(f"{metric.help}: {metric.get():g}")
+        return lines
+
+
+REGISTRY = Registry()
+
+UPDATE_SECONDS = REGISTRY.histogram("bot_update_seconds", "Обработка апдейта")
+SCORER_SECONDS = REGISTRY.histogram("bot_scorer_evaluate_seconds", "Scorer.evaluate")
+LLM_CONNECT_SECONDS = REGISTRY.histogram("bot_llm_connect_seconds", "LLM: соединение")
+LLM_TTFB_SECONDS = REGISTRY.histogram("bot_llm_ttfb_seconds", "LLM: до заголовков ответа")
+LLM_REQUEST_SECONDS = REGISTRY.histogram("bot_llm_request_seconds", "LLM: запрос целиком")
+TELEGRAM_SEND_SECONDS = REGISTRY.histogram("bot_telegram_send_seconds", "Telegram: вызов API")
+JOB_LAG_SECONDS = REGISTRY.histogram("bot_job_lag_seconds", "Опоздание джоб job queue")
+AUTOPOST_LAG_SECONDS = REGISTRY.histogram("bot_autopost_lag_seconds", "Опоздание автосообщений от срока чата")
+REHYDRATE_SECONDS = REGISTRY.histogram("bot_chat_rehydrate_seconds", "Разморозка чата")
+UPDATES_IN_FLIGHT = REGISTRY.gauge("bot_updates_in_flight", "Апдейтов в обработке")
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, registry: Registry) -> None:
+        self.registry = registry
+
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.registry.expose())
+
+
+class MetricsServer:
+    """Local HTTP endpoint with metrics in Prometheus text format."""
+
+    def __init__(self, port: int, listen: str = "127.0.0.1", registry: Registry = REGISTRY):
+        self.port = port
+        self.listen = listen
+        self._app = tornado.web.Application([(r"/metrics", MetricsHandler, {"registry": registry})])
+        self._server: Optional[tornado.httpserver.HTTPServer] = None
+
+    @classmethod
+    def from_env(cls, shard_id: Optional[int] = None) -> Optional["MetricsServer"]:
+        """None, если METRICS_PORT не задан."""
+        port = os.getenv("METRICS_PORT")
+        if not port:
+            return None
+        return cls(int(port) + (shard_id or 0), listen=os.getenv("METRICS_LISTEN", "127.0.0.1"))
+
+    def start(self) -> None:
+        self._server = tornado.httpserver.HTTPServer(self._app)
+        self._server.listen(self.port, address=self.listen)
+        logging.info(f"Metrics endpoint on http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
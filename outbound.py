@@ -0,0 +1,248 @@
+# outbound.py
+"""
+Общая очередь исходящих вызовов Bot API.
+
+Telegram ограничивает бота примерно 30 сообщениями в секунду суммарно,
+1 сообщением в секунду в личный чат и 20 в минуту в группу. Всё, что бот
+отправляет в чаты (ответы, правки стрима, реакции, автосообщения,
+праздничные рассылки), проходит через OutboundSender:
+- у каждого чата свой token bucket, вызов ждёт своей очереди в чате,
+  не задерживая другие чаты;
+- и в чате, и глобально слоты раздаются по приоритету
+  (REPLY > DELAYED > BACKGROUND), внутри приоритета — по порядку, так что
+  прямой ответ обгоняет уже ждущую реакцию;
+- на RetryAfter чат ставится на паузу на указанное время, и вызов
+  повторяется (не больше max_retries раз);
+- малоценные вызовы (droppable: реакции, промежуточные правки стрима)
+  отбрасываются с SendDropped, если ждать пришлось бы дольше drop_wait
+  или очередь длиннее drop_depth.
+
+Лимит Telegram — на бота, а не на процесс: при шардировании (SHARDS=N)
+каждый воркер получает TG_GLOBAL_RATE / N. Чаты разложены по шардам
+неравномерно, поэтому суммарно бот может упереться в лимит раньше, но не
+превысит его.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from telegram.error import RetryAfter
+
+from dispatcher import Priority
+from metrics import TELEGRAM_SEND_SECONDS
+
+T = TypeVar("T")
+
+
+class SendDropped(Exception):
+    """Вызов Bot API отброшен очередью отправки."""
+
+
+class TokenBucket:
+    """Token bucket; tokens may go negative to hold reservations."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Через сколько секунд освободится токен."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def reserve(self) -> float:
+        """Занимает токен и возвращает, сколько ждать до его наступления."""
+        delay = self.delay()
+        self.tokens -= 1
+        return delay
+
+    def refund(self) -> None:
+        """Возвращает токен, занятый reserve(), если вызов так и не состоялся."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены ближайшие seconds секунд."""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class PriorityGate:
+    """Token bucket whose slots are handed out to waiters by priority."""
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self._waiters = []
+        self._seq = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+
+    def depth(self, priority: Optional[Priority] = None) -> int:
+        """Число ожидающих слота."""
+        return sum(
+            1 for p, _, fut in self._waiters
+            if not fut.done() and (priority is None or p == priority)
+        )
+
+    def delay(self) -> float:
+        """Примерно через сколько секунд слот получит новый вызов (без учёта приоритета)."""
+        return self.bucket.delay() + self.depth() / self.bucket.rate
+
+    @property
+    def idle(self) -> bool:
+        return not self._waiters and self.bucket.idle
+
+    async def acquire(self, priority: Priority, max_wait: Optional[float]) -> None:
+        if not self.depth() and not self.bucket.delay():
+            self.bucket.reserve()
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.get_running_loop().create_task(self._pump())
+        try:
+            await asyncio.wait_for(fut, max_wait)
+        except asyncio.TimeoutError:
+            raise SendDropped(f"No send slot within {max_wait} s") from None
+
+    async def _pump(self) -> None:
+        """Выдаёт слоты ожидающим по мере пополнения bucket."""
+        while self._waiters:
+            delay = self.bucket.delay()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                self.bucket.reserve()
+                fut.set_result(None)
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class OutboundSender:
+    """Rate-limited, prioritized gate in front of Bot API calls."""
+
+    # Сколько отправок между чистками простаивающих buckets чатов
+    PRUNE_EVERY = 1000
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        private_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        chat_burst: float = 3.0,
+        max_retries: int = 3,
+        drop_wait: float = 5.0,
+        drop_depth: int = 100,
+    ):
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.drop_wait = drop_wait
+        self.drop_depth = drop_depth
+        self.stats = {"sent": 0, "dropped": 0, "retried": 0, "failed": 0}
+        self._global = PriorityGate(TokenBucket(global_rate, global_rate))
+        self._chats: Dict[int, PriorityGate] = {}
+
+    @classmethod
+    def from_env(cls, shards: int = 1) -> "OutboundSender":
+        # shards — число процессов, делящих общий лимит бота
+        return cls(
+            global_rate=float(os.getenv("TG_GLOBAL_RATE", "30")) / shards,
+            private_rate=float(os.getenv("TG_PRIVATE_RATE", "1")),
+            group_rate=float(os.getenv("TG_GROUP_RATE_PER_MIN", "20")) / 60,
+            chat_burst=float(os.getenv("TG_CHAT_BURST", "3")),
+            max_retries=int(os.getenv("TG_SEND_RETRIES", "3")),
+            drop_wait=float(os.getenv("TG_DROP_WAIT", "5")),
+            drop_depth=int(os.getenv("TG_DROP_DEPTH", "100")),
+        )
+
+    def depth(self, priority: Optional[Priority] = None) -> int:
+        """Число вызовов, ожидающих глобального слота."""
+        return self._global.depth(priority)
+
+    def _chat_gate(self, chat_id: int) -> PriorityGate:
+        gate = self._chats.get(chat_id)
+        if gate is None:
+            # Отрицательный id — группа или канал
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            gate = self._chats[chat_id] = PriorityGate(TokenBucket(rate, self.chat_burst))
+        return gate
+
+    def _prune(self) -> None:
+        for chat_id in [chat_id for chat_id, gate in self._chats.items() if gate.idle]:
+            del self._chats[chat_id]
+
+    async def send(
+        self,
+        chat_id: int,
+        call: Callable[[], Awaitable[T]],
+        priority: Priority = Priority.REPLY,
+        droppable: bool = False,
+        retries: Optional[int] = None,
+    ) -> T:
+        """Выполняет call() с учётом лимитов чата и бота.
+
+        call вызывается заново при каждой попытке. Для droppable-вызовов
+        вместо долгого ожидания поднимается SendDropped.
+        """
+        gate = self._chat_gate(chat_id)
+        retries = self.max_retries if retries is None else retries
+        max_wait = self.drop_wait if droppable else None
+        attempt = 0
+        while True:
+            if droppable and (gate.delay() > self.drop_wait or self.depth() >= self.drop_depth):
+                self.stats["dropped"] += 1
+                raise SendDropped(f"Chat {chat_id} is rate limited")
+            try:
+                await gate.acquire(priority, max_wait)
+            except SendDropped:
+                self.stats["dropped"] += 1
+                raise
+            try:
+                await self._global.acquire(priority, max_wait)
+            except SendDropped:
+                # Отправки не было — токен чата не должен пропасть
+                gate.bucket.refund()
+                self.stats["dropped"] += 1
+                raise
+            try:
+                with TELEGRAM_SEND_SECONDS.time():
+                    result = await call()
+            except RetryAfter as e:
+                pause = _retry_seconds(e)
+                gate.bucket.pause(pause)
+                if attempt >= retries:
+                    self.stats["failed"] += 1
+                    raise
+                attempt += 1
+                self.stats["retried"] += 1
+                logging.warning(f"[OUTBOUND] Flood control in chat {chat_id}: retry in {pause:g} s")
+                continue
+            self.stats["sent"] += 1
+            if self.stats["sent"] % self.PRUNE_EVERY == 0:
+                self._prune()
+            return result
@@ -0,0 +1,358 @@
+# persistence.py
+"""
+Хранение chat_data и bot_data в SQLite (WAL), без внешних сервисов.
+
+- Чтение ленивое: при старте ничего не загружается, данные чата
+  подтягиваются из базы при первом обращении к нему (refresh_chat_data
+  вызывается PTB перед каждым хендлером и джобой чата).
+- Запись write-behind: PTB отмечает изменённые чаты, а мы копим их и
+  пишем одной транзакцией; сериализуется только то, что изменилось.
+- Время последнего сброса и число записанных чатов доступны в stats.
+- Рядом с blob хранятся колонки, по которым фоновые задачи выбирают
+  чаты, не распаковывая их (eligible_holiday_chats).
+
+Рантайм-объекты (клиенты, блокировки, задачи) в chat_data и bot_data не
+кладутся: они живут в services.SERVICES. Если в данных всё же окажется
+что-то несериализуемое, этот ключ пропускается, а остальное сохраняется.
+"""
+import asyncio
+import glob
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_data (
+    chat_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    last_active REAL,
+    autopost_enabled INTEGER,
+    muted_until REAL,
+    holiday_sent_date TEXT
+);
+CREATE TABLE IF NOT EXISTS bot_data (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+# Колонки, добавленные после первой версии схемы: старые базы дополняются при открытии
+CHAT_COLUMNS = {"autopost_enabled": "INTEGER", "muted_until": "REAL", "holiday_sent_date": "TEXT"}
+
+
+class SQLitePersistence(BasePersistence):
+    """Lazy-loading, write-behind SQLite persistence for chat_data and bot_data."""
+
+    def __init__(self, path: str, update_interval: float = 60, write_delay: float = 1.0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.write_delay = write_delay
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(chat_data)")}
+        for column, kind in CHAT_COLUMNS.items():
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE chat_data ADD COLUMN {column} {kind}")
+        # Одно соединение используется из event loop (чтение) и из потока (запись)
+        self._db_lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._loaded = set()
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._dirty_chats: Dict[int, dict] = {}
+        self._dirty_bot: Optional[dict] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self.stats = {"flushes": 0, "chats_written": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0, "loaded": 0}
+
+    @classmethod
+    def from_env(cls, suffix: str = "") -> Optional["SQLitePersistence"]:
+        # suffix позволяет каждому шарду писать в свой файл
+        path = os.getenv("PERSISTENCE_PATH", "bot_data.sqlite3")
+        if not path:
+            return None
+        root, ext = os.path.splitext(path)
+        return cls(
+            root + suffix + ext,
+            update_interval=float(os.getenv("PERSISTENCE_INTERVAL", "60")),
+            write_delay=float(os.getenv("PERSISTENCE_WRITE_DELAY", "1")),
+        )
+
+    @staticmethod
+    def check_shards(shards: int) -> None:
+        """Не даёт запуститься с другим числом шардов, чем у файлов на диске.
+
+        Каждый шард хранит свои чаты в своём файле (chat_id % SHARDS), и
+        после смены SHARDS (или перехода между шардированным и обычным
+        режимом) чаты оказались бы не в том файле — их история и настройки
+        молча пропали бы. Перераспределения нет: файлы нужно перенести
+        вручную или вернуть прежнее SHARDS.
+        """
+        path = os.getenv("PERSISTENCE_PATH", "bot_data.sqlite3")
+        if not path:
+            return
+        root, ext = os.path.splitext(path)
+        shard_files = glob.glob(glob.escape(root) + ".shard*" + glob.escape(ext))
+        layouts = set()
+        if shard_files:
+            layouts.add(len(shard_files))
+        if os.path.exists(path):
+            layouts.add(1)
+        if layouts and layouts != {shards}:
+            found = " and ".join(f"{n} shards" if n > 1 else "unsharded" for n in sorted(layouts))
+            raise RuntimeError(
+                f"Persistence {path} was written for a different layout ({found}), SHARDS={shards}; "
+                "move or merge the files before changing SHARDS"
+            )
+
+    # --- сериализация ---
+
+    @staticmethod
+    def _dumps(data: dict) -> bytes:
+        try:
+            return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Что-то несериализуемое: сохраняем всё остальное
+            picklable = {}
+            for key, value in data.items():
+                try:
+                    pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    logging.debug(f"[PERSISTENCE] Skipping unpicklable key {key!r}")
+                    continue
+                picklable[key] = value
+            return pickle.dumps(picklable, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _last_active(data: dict) -> Optional[float]:
+        last = data.get("last_message_time")
+        # В chat_data время хранится как naive UTC
+        return last.replace(tzinfo=timezone.utc).timestamp() if isinstance(last, datetime) else None
+
+    @classmethod
+    def _chat_row(cls, chat_id: int, data: dict) -> tuple:
+        muted_until = data.get("muted_until")
+        holiday_sent = data.get("holiday_sent_date")
+        return (
+            chat_id,
+            cls._dumps(data),
+            cls._last_active(data),
+            int(bool(data.get("autopost_enabled", True))),
+            muted_until.replace(tzinfo=timezone.utc).timestamp() if isinstance(muted_until, datetime) else None,
+            holiday_sent.isoformat() if isinstance(holiday_sent, date) else None,
+        )
+
+    # --- chat_data ---
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        # Ничего не грузим заранее: чаты восстанавливаются в refresh_chat_data
+        return {}
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        if chat_id in self._loaded:
+            loading = self._loading.get(chat_id)
+            if loading is not None:
+                # Чат грузится для другого хендлера или джобы — ждём ту же загрузку
+                await asyncio.shield(loading)
+            return
+        self._loaded.add(chat_id)
+        loading = self._loading[chat_id] = asyncio.get_running_loop().create_future()
+        try:
+            # Чтение — в потоке: пока идёт сброс, _db_lock может быть занят надолго
+            row = await asyncio.to_thread(self._read_chat, chat_id)
+        except BaseException:
+            self._loaded.discard(chat_id)
+            raise
+        finally:
+            del self._loading[chat_id]
+            # Ждущие продолжат не раньше, чем данные ниже будут влиты в chat_data
+            loading.set_result(None)
+        if row is None:
+            return
+        try:
+            stored = pickle.loads(row[0])
+        except Exception:
+            logging.exception(f"[PERSISTENCE] Failed to restore chat {chat_id}")
+            return
+        # То, что уже успели записать в память, важнее сохранённого
+        for key, value in stored.items():
+            chat_data.setdefault(key, value)
+        self.stats["loaded"] += 1
+
+    def _read_chat(self, chat_id: int) -> Optional[tuple]:
+        with self._db_lock:
+            return self._conn.execute("SELECT data FROM chat_data WHERE chat_id = ?", (chat_id,)).fetchone()
+
+    def known_chats(self) -> list:
+        """Все сохранённые чаты без распаковки данных:
+        [(chat_id, last_active, autopost_enabled, muted_until), ...]."""
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT chat_id, last_active, autopost_enabled, muted_until FROM chat_data"
+            ).fetchall()
+
+    async def eligible_holiday_chats(self, today: date, now: float) -> List[int]:
+        """Сохранённые чаты, которым можно слать поздравление, без распаковки данных.
+
+        Это предварительный отбор по колонкам последнего сброса: у строк,
+        записанных до появления колонок, там NULL, и они попадают в выборку.
+        Окончательно решает проверка самого chat_data.
+        """
+        def select() -> List[int]:
+            with self._db_lock:
+                rows = self._conn.execute(
+                    "SELECT chat_id FROM chat_data "
+                    "WHERE COALESCE(autopost_enabled, 1) != 0 "
+                    "AND (holiday_sent_date IS NULL OR holiday_sent_date != ?) "
+                    "AND (muted_until IS NULL OR muted_until <= ?)",
+                    (today.isoformat(), now),
+                ).fetchall()
+            return [chat_id for chat_id, in rows]
+
+        return await asyncio.to_thread(select)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._loaded.add(chat_id)
+        self._dirty_chats[chat_id] = data
+        self._schedule_flush()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._dirty_chats.pop(chat_id, None)
+        self._loaded.discard(chat_id)
+        await asyncio.to_thread(self._delete_chat, chat_id)
+
+    def _delete_chat(self, chat_id: int) -> None:
+        with self._db_lock:
+            self._conn.execute("DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
+
+    # --- bot_data ---
+
+    def _read_bot_data(self) -> list:
+        with self._db_lock:
+            return self._conn.execute("SELECT key, data FROM bot_data").fetchall()
+
+    async def get_bot_data(self) -> dict:
+        rows = await asyncio.to_thread(self._read_bot_data)
+        bot_data = {}
+        for key, blob in rows:
+            try:
+                bot_data[key] = pickle.loads(blob)
+            except Exception:
+                logging.exception(f"[PERSISTENCE] Failed to restore bot_data[{key!r}]")
+        return bot_data
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._dirty_bot = data
+        self._schedule_flush()
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    # --- не используется: user_data, callback_data, conversations ---
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        pass
+
+    # --- запись ---
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_behind())
+
+    async def _write_behind(self) -> None:
+        # Небольшая задержка, чтобы все чаты одного цикла PTB попали в одну транзакцию
+        await asyncio.sleep(self.write_delay)
+        await self._flush_dirty()
+
+    def _bot_rows(self, data: dict) -> list:
+        rows = []
+        for key, value in data.items():
+            try:
+                rows.append((str(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+            except Exception:
+                logging.debug(f"[PERSISTENCE] Skipping unpicklable bot_data key {key!r}")
+        return rows
+
+    def _write(self, chat_rows: list, bot_rows: Optional[list]) -> None:
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO chat_data "
+                    "(chat_id, data, last_active, autopost_enabled, muted_until, holiday_sent_date) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, last_active = excluded.last_active, "
+                    "autopost_enabled = excluded.autopost_enabled, muted_until = excluded.muted_until, "
+                    "holiday_sent_date = excluded.holiday_sent_date",
+                    chat_rows,
+                )
+                if bot_rows is not None:
+                    self._conn.execute("DELETE FROM bot_data")
+                    self._conn.executemany("INSERT INTO bot_data (key, data) VALUES (?, ?)", bot_rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def _flush_dirty(self) -> None:
+        async with self._flush_lock:
+            dirty, self._dirty_chats = self._dirty_chats, {}
+            dirty_bot, self._dirty_bot = self._dirty_bot, None
+            if not dirty and dirty_bot is None:
+                return
+            start = time.perf_counter()
+            # Сериализуем в event loop, чтобы снимок был согласованным
+            chat_rows = [self._chat_row(chat_id, data) for chat_id, data in dirty.items()]
+            bot_rows = self._bot_rows(dirty_bot) if dirty_bot is not None else None
+            try:
+                await asyncio.to_thread(self._write, chat_rows, bot_rows)
+            except Exception:
+                logging.exception("[PERSISTENCE] Flush failed, will retry")
+                for chat_id, data in dirty.items():
+                    self._dirty_chats.setdefault(chat_id, data)
+                if dirty_bot is not None and self._dirty_bot is None:
+                    self._dirty_bot = dirty_bot
+                return
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.stats["flushes"] += 1
+            self.stats["chats_written"] += len(chat_rows)
+            self.stats["last_flush_ms"] = elapsed_ms
+            self.stats["max_flush_ms"] = max(self.stats["max_flush_ms"], elapsed_ms)
+            logging.info(f"[PERSISTENCE] Flushed {len(chat_rows)} chats in {elapsed_ms:.1f} ms")
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_dirty()
+        with self._db_lock:
+            self._conn.close()
@@ -0,0 +1,107 @@
+# resilience.py
+"""
+Защита вызовов LLM от деградации провайдера.
+
+- LatencyWindow — скользящее окно последних задержек. По его p95/p99
+  LLMClient выставляет таймауты и момент хеджирования, вместо того чтобы
+  всегда ждать фиксированные 30 секунд.
+- CircuitBreaker — после failure_threshold ошибок подряд цепь
+  размыкается, и вызовы сразу падают с CircuitOpen (вызывающий код
+  отвечает FALLBACK_REPLY), не нагружая лежащий API. Через reset_timeout
+  цепь переходит в half-open и пропускает пробные запросы: успех замыкает
+  её, ошибка размыкает снова.
+- backoff_delay — пауза перед повтором: экспоненциальная с полным
+  джиттером, чтобы чаты не повторяли запросы синхронно.
+"""
+import random
+import time
+from collections import deque
+from typing import Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Цепь разомкнута: запрос к LLM не отправлялся."""
+
+
+class LatencyWindow:
+    """Last N latencies in seconds with percentile lookup."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._sorted = None
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self._sorted = None
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Перцентиль окна или None, пока замеров меньше min_samples."""
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        return self._sorted[min(int(q * len(self._sorted)), len(self._sorted) - 1)]
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with half-open probes."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max: int = 1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probes = 0
+
+    def before_call(self) -> None:
+        """Поднимает CircuitOpen, если запрос пропускать нельзя."""
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpen(f"LLM circuit is open for {self.retry_in():.0f} s more")
+            self.state = HALF_OPEN
+            self._probes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_max:
+                self.rejected += 1
+                raise CircuitOpen("LLM circuit is half-open, probe in flight")
+            self._probes += 1
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.state = CLOSED
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opened += 1
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Запрос завершился без вердикта (отменён) — освобождает слот пробы."""
+        if self.state == HALF_OPEN and self._probes:
+            self._probes -= 1
+
+    def retry_in(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    """Full jitter: случайная пауза от 0 до base * 2**attempt (не больше cap)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,107 @@
+# response_cache.py
+"""
+Кэш ответов LLM для запросов без истории чата.
+
+/send_test, /holiday_check и генерация темы автосообщения отправляют одно
+и то же без контекста, поэтому ответ можно переиспользовать. Ключ —
+хэш от (модель, хэш системного промпта, хэш сообщений, параметры
+сэмплинга). Память ограничена LRU по числу записей, у каждой записи есть
+TTL; опционально записи дублируются в SQLite-файл и переживают рестарт.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def _sha256(value) -> str:
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL cache of completions with optional on-disk backing."""
+
+    def __init__(self, maxsize: int = 512, ttl: float = 600, path: Optional[str] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._conn.commit()
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        return cls(
+            maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", "512")),
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL", "600")),
+            path=os.getenv("RESPONSE_CACHE_PATH") or None,
+        )
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, messages: list, params: dict) -> str:
+        return _sha256({
+            "model": model,
+            "system": _sha256(system_prompt),
+            "messages": _sha256(messages),
+            "params": params,
+        })
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        item = self._data.get(key)
+        if item is not None:
+            if item[1] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            del self._data[key]
+        if self._conn is not None:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                return row[0]
+        self.misses += 1
+        return None
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def put(self, key: str, value: str) -> None:
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self._conn is not None:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, expires_at),
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                logging.exception("Response cache write failed")
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
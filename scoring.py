@@ -5,42 +5,150 @@
     from scoring import Scorer
 
 Пример использования в handle_message:
-    scorer = Scorer(context.chat_data, context.bot_data['bot_username'], context.bot.id)
-    decision = scorer.evaluate(update)
+    scorer = Scorer.for_chat(context.chat_data, context.bot_data['bot_username'], context.bot.id)
+    decision = scorer.evaluate(update, features)  # features — из TextMatcher.scan
     if decision.get('respond'):
         # в зависимости от decision['mode']:
         # - 'immediate' или 'laughter' => отвечаем сразу
         # - 'delayed' => планируем ответ через decision['delay'] секунд
         pass
 
-Данный модуль хранит в chat_data структуры:
+Scorer создаётся один раз на чат и лежит в chat_data['scoring'];
+все счётчики (включая message_counter и время последнего ответа по стрику)
+обновляются прямо в нём и сохраняются между сообщениями.
+
+Состояние Scorer:
 - scoring.reply_counts: число ответов других пользователей на каждое сообщение
 - scoring.reaction_counts: число реакций на каждое сообщение (вы должны обновлять извне)
 - scoring.responded: множество message_id, на которые бот уже отвечал
 - scoring.user_streaks: для каждого пользователя (user_id) пара (текущий стрик, время последнего сообщения)
 - scoring.message_counter: общее число полученных сообщений в чате
+
+reply_counts, reaction_counts, responded и user_streaks — ограниченные
+ExpiringMap: записи старше горизонта актуальности (стрики — старше окна
+стрика) удаляются, а размер ограничен сверху, так что память на чат
+пропорциональна активному окну, а не всей истории чата.
 """
-import re
+import os
 import time
+from collections import OrderedDict
+from typing import FrozenSet, Optional
 from telegram import Update
 
-# Регулярка для определения смеха (пример: "ахах", "ха-ха", "ахахах")
-LAUGHTER_PATTERN = re.compile(r"\b(ха|хах|ахах)+\b", re.IGNORECASE)
+from text_matcher import LAUGHTER, MENTION, matcher_for
+
+# Окно стрика (сек): сообщения одного автора ближе этого интервала продолжают стрик
+STREAK_WINDOW = 120
+# Сколько секунд помним ответы/реакции на сообщение и факт нашего ответа
+SCORING_HORIZON = int(os.getenv("SCORING_HORIZON", "3600"))
+# Максимум отслеживаемых сообщений и пользователей на чат
+SCORING_MAX_MESSAGES = int(os.getenv("SCORING_MAX_MESSAGES", "2000"))
+SCORING_MAX_USERS = int(os.getenv("SCORING_MAX_USERS", "1000"))
+
+
+class ExpiringMap:
+    """Словарь с ограничением по размеру и времени жизни записей.
+
+    Записи упорядочены по времени последней записи, поэтому устаревшие
+    всегда лежат в начале и удаляются за O(числа удалённых).
+    """
+
+    __slots__ = ("ttl", "maxsize", "evicted", "_data")
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.evicted = 0
+        self._data = OrderedDict()  # key -> (value, время записи)
+
+    def expire(self, now: float = None) -> None:
+        now = time.time() if now is None else now
+        data = self._data
+        while data:
+            key, (_, stamp) = next(iter(data.items()))
+            if now - stamp <= self.ttl:
+                break
+            del data[key]
+            self.evicted += 1
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or time.time() - item[1] > self.ttl:
+            return default
+        return item[0]
+
+    def __setitem__(self, key, value) -> None:
+        now = time.time()
+        self._data[key] = (value, now)
+        self._data.move_to_end(key)
+        self.expire(now)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+    def add(self, key) -> None:
+        self[key] = True
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def values(self):
+        return [value for value, _ in self._data.values()]
+
+
+def _bounded(scoring: dict, key: str, ttl: float, maxsize: int) -> ExpiringMap:
+    """Достаёт ExpiringMap из scoring, переводя старые dict/set без потери данных."""
+    current = scoring.get(key)
+    if isinstance(current, ExpiringMap):
+        return current
+    bounded = ExpiringMap(ttl, maxsize)
+    if isinstance(current, dict):
+        for k, v in current.items():
+            bounded[k] = v
+    elif current:
+        for k in current:
+            bounded.add(k)
+    scoring[key] = bounded
+    return bounded
+
 
 class Scorer:
-    def __init__(self, chat_data: dict, bot_username: str, bot_id: int):
-        # Инициализация структур в chat_data
-        scoring = chat_data.setdefault('scoring', {})
-        self.reply_counts = scoring.setdefault('reply_counts', {})
-        self.reaction_counts = scoring.setdefault('reaction_counts', {})
-        self.responded = scoring.setdefault('responded', set())
-        self.user_streaks = scoring.setdefault('user_streaks', {})
-        self.message_counter = scoring.setdefault('message_counter', 0)
-        self.last_streak_response_time = scoring.setdefault('last_streak_response_time', 0)
+    __slots__ = (
+        'reply_counts',
+        'reaction_counts',
+        'responded',
+        'user_streaks',
+        'message_counter',
+        'last_streak_response_time',
+        'bot_username',
+        'bot_id',
+    )
+
+    def __init__(self, bot_username: str, bot_id: int, state: dict = None):
+        # state — старое dict-состояние из chat_data['scoring'], если есть
+        state = state if state is not None else {}
+        self.reply_counts = _bounded(state, 'reply_counts', SCORING_HORIZON, SCORING_MAX_MESSAGES)
+        self.reaction_counts = _bounded(state, 'reaction_counts', SCORING_HORIZON, SCORING_MAX_MESSAGES)
+        self.responded = _bounded(state, 'responded', SCORING_HORIZON, SCORING_MAX_MESSAGES)
+        self.user_streaks = _bounded(state, 'user_streaks', STREAK_WINDOW, SCORING_MAX_USERS)
+        self.message_counter = state.get('message_counter', 0)
+        self.last_streak_response_time = state.get('last_streak_response_time', 0)
 
         self.bot_username = bot_username.lower()
         self.bot_id = bot_id
 
+    @classmethod
+    def for_chat(cls, chat_data: dict, bot_username: str, bot_id: int) -> 'Scorer':
+        """Возвращает Scorer чата, создавая его при первом обращении."""
+        scorer = chat_data.get('scoring')
+        if not isinstance(scorer, cls):
+            scorer = cls(bot_username, bot_id, scorer)
+            chat_data['scoring'] = scorer
+        return scorer
+
     def record_reply(self, update: Update):
         msg = update.message
         # Если кто-то отвечает на чужое сообщение (не бот), считаем
@@ -57,7 +165,7 @@ class Scorer:
         now = time.time()
         streak, last_time = self.user_streaks.get(user_id, (0, 0))
         # Если в пределах 2 минут — продолжаем стрик, иначе сбрасываем
-        if now - last_time < 120:
+        if now - last_time < STREAK_WINDOW:
             streak += 1
         else:
             streak = 1
@@ -68,9 +176,10 @@ class Scorer:
         self.message_counter += 1
         return self.message_counter
 
-    def evaluate(self, update: Update) -> dict:
+    def evaluate(self, update: Update, features: Optional[FrozenSet[str]] = None) -> dict:
         """
-        Оценивает сообщение. Возвращает словарь с ключами:
+        Оценивает сообщение. features — признаки текста из TextMatcher.scan,
+        если вызывающий их уже посчитал. Возвращает словарь с ключами:
           - respond: bool
           - mode: 'immediate', 'delayed', 'laughter', 'context_check'
           - delay: int (секунды) для режима 'delayed'
@@ -95,10 +204,12 @@ class Scorer:
 
         # 4) Извлекаем признаки
         direct_reply = bool(msg.reply_to_message and msg.reply_to_message.from_user.id == self.bot_id)
-        mention = ('@' + self.bot_username) in text.lower() or 'роберт' in text.lower()
+        if features is None:
+            features = matcher_for(self.bot_username).scan(text)
+        mention = MENTION in features
         many_replies = self.reply_counts.get(msg_id, 0) >= 2
         reaction_and_reply = (self.reply_counts.get(msg_id, 0) >= 1 and self.reaction_counts.get(msg_id, 0) >= 1)
-        laughter = bool(LAUGHTER_PATTERN.search(text))
+        laughter = LAUGHTER in features
 
         # 5) Логика принятия решения
         # 5.1 Смех — всегда коротко ответить/посмеяться
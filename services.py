@@ -0,0 +1,15 @@
+# services.py
+"""
+Рантайм-объекты бота: LLM-клиент, Messenger, команды, автопостер,
+праздничная рассылка, сервер метрик, тиринг.
+
+Раньше они лежали в bot_data, но PTB перед каждым сохранением делает
+deepcopy(bot_data), а эти объекты держат блокировки, HTTP-клиенты и
+задачи — копирование падало, и persistence не записывала ничего. Теперь
+в bot_data только сериализуемые значения (bot_username, shard), а
+объекты живут здесь, по одному набору на процесс (шард — отдельный
+процесс). Заполняется в post_init, очищается в post_shutdown.
+"""
+from typing import Any, Dict
+
+SERVICES: Dict[str, Any] = {}
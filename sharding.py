@@ -0,0 +1,218 @@
+# sharding.py
+"""
+Шардирование чатов по нескольким процессам на одной машине.
+
+Фронтовый процесс получает апдейты (long polling или webhook) и
+раскладывает их по воркерам по chat_id % SHARDS. Каждый воркер — отдельное
+Application без Updater со своими chat_data, Messenger, job queue и своим
+файлом persistence. Все апдейты одного чата попадают в один воркер через
+одну FIFO-очередь, поэтому порядок внутри чата сохраняется.
+
+Счётчики по шардам (отправлено фронтом / обработано воркером) лежат в
+разделяемой памяти; фронт периодически пишет их в лог, воркер показывает
+свой номер шарда в /status.
+
+Если воркер умер, фронт останавливается целиком (и в polling, и в
+webhook) с ненулевым кодом выхода, чтобы супервизор перезапустил бота:
+апдейты его чатов иначе копились бы в очереди, которую никто не читает.
+
+Чаты не перераспределяются между файлами persistence: при смене SHARDS
+бот откажется стартовать (SQLitePersistence.check_shards).
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from typing import Callable, Optional
+
+from telegram import Bot, Update
+from telegram.error import NetworkError
+
+from webhook import WebhookServer
+
+
+def shard_for(chat_id: int, shards: int) -> int:
+    return chat_id % shards
+
+
+def chat_id_of(data: dict) -> Optional[int]:
+    """Достаёт chat.id из сырого JSON апдейта любого типа."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        user = value.get("from")
+        if user and "id" in user:
+            return user["id"]
+    return None
+
+
+class ShardRouter:
+    """Routes raw update dicts to per-shard worker queues."""
+
+    def __init__(self, queues: list, routed):
+        self.queues = queues
+        self.routed = routed
+
+    async def route(self, data: dict) -> None:
+        chat_id = chat_id_of(data)
+        shard = shard_for(chat_id, len(self.queues)) if chat_id is not None else 0
+        self.queues[shard].put(data)
+        with self.routed.get_lock():
+            self.routed[shard] += 1
+
+
+# --- воркер ---
+
+def _worker_main(build_application: Callable, shard_id: int, shards: int, queue, processed) -> None:
+    # Сигналы обрабатывает фронт, воркер останавливается по None в очереди.
+    # SIGTERM от systemd/docker приходит всей группе процессов — без SIG_IGN
+    # воркер умер бы раньше, чем дочитал очередь и сбросил persistence.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_run_worker(build_application, shard_id, shards, queue, processed))
+
+
+async def _run_worker(build_application: Callable, shard_id: int, shards: int, queue, processed) -> None:
+    application = build_application(shard_id=shard_id, updater=False)
+    await application.initialize()
+    # После initialize: persistence подменяет bot_data сохранённым, а post_init уже читает shard
+    application.bot_data["shard"] = (shard_id, shards)
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logging.info(f"[SHARD {shard_id}] started")
+    try:
+        while True:
+            data = await asyncio.to_thread(queue.get)
+            if data is None:
+                break
+            try:
+                update = Update.de_json(data, application.bot)
+            except Exception as exc:
+                # Фронт апдейт не разбирает; битый словарь не должен ронять воркер
+                logging.warning(f"[SHARD {shard_id}] Отброшен битый апдейт: {type(exc).__name__}: {exc}")
+            else:
+                await application.update_queue.put(update)
+            with processed.get_lock():
+                processed[shard_id] += 1
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logging.info(f"[SHARD {shard_id}] stopped")
+
+
+# --- фронт ---
+
+async def _poll_updates(token: str, router: ShardRouter, stop_event: asyncio.Event) -> None:
+    offset = None
+    async with Bot(token) as bot:
+        await bot.delete_webhook()
+        try:
+            while not stop_event.is_set():
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+                except NetworkError as e:
+                    logging.warning(f"[SHARDS] getUpdates failed: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    await router.route(update.to_dict())
+        finally:
+            if offset is not None:
+                # Telegram считает апдейты полученными только по следующему offset:
+                # без этого вызова после перезапуска пришли бы последние ещё раз
+                try:
+                    await bot.get_updates(offset=offset, timeout=0, allowed_updates=Update.ALL_TYPES)
+                except Exception as e:
+                    logging.warning(f"[SHARDS] Failed to confirm offset {offset}: {e}")
+
+
+async def _log_stats(routed, processed, interval: float, stop_event: asyncio.Event) -> None:
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        stats = ", ".join(
+            f"#{i}: {routed[i]} routed / {processed[i]} done" for i in range(len(routed))
+        )
+        logging.info(f"[SHARDS] {stats}")
+
+
+async def _watch_workers(workers: list, interval: float, stop_event: asyncio.Event) -> bool:
+    """True, если какой-то воркер умер (тогда фронт останавливается)."""
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        dead = [worker.name for worker in workers if not worker.is_alive()]
+        if dead:
+            logging.error(f"[SHARDS] Workers died: {', '.join(dead)}, stopping")
+            stop_event.set()
+            return True
+    return False
+
+
+async def _run_front(token: str, router: ShardRouter, workers: list, routed, processed) -> bool:
+    """Работает до сигнала или смерти воркера; True во втором случае."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    stats_task = asyncio.create_task(
+        _log_stats(routed, processed, float(os.getenv("SHARD_STATS_INTERVAL", "60")), stop_event)
+    )
+    watch_task = asyncio.create_task(_watch_workers(workers, 1.0, stop_event))
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        server = WebhookServer.from_env(router.route, lambda: all(w.is_alive() for w in workers))
+        server.start()
+        webhook_url = os.getenv("WEBHOOK_URL")
+        if webhook_url:
+            async with Bot(token) as bot:
+                await bot.set_webhook(url=webhook_url.rstrip("/") + server.url_path, secret_token=server.secret_token)
+        await stop_event.wait()
+        await server.stop()
+    else:
+        poll_task = asyncio.create_task(_poll_updates(token, router, stop_event))
+        await stop_event.wait()
+        poll_task.cancel()
+        await asyncio.gather(poll_task, return_exceptions=True)
+    await stats_task
+    return await watch_task
+
+
+def run_sharded(build_application: Callable, token: str, shards: int) -> None:
+    """Запускает shards воркеров и фронт, который раскладывает им апдейты."""
+    routed = multiprocessing.Array("q", shards)
+    processed = multiprocessing.Array("q", shards)
+    queues = [multiprocessing.Queue() for _ in range(shards)]
+    workers = [
+        multiprocessing.Process(
+            target=_worker_main,
+            args=(build_application, shard_id, shards, queues[shard_id], processed),
+            name=f"shard-{shard_id}",
+        )
+        for shard_id in range(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    logging.info(f"Бот запущен ({shards} шардов)...")
+    try:
+        worker_died = asyncio.run(_run_front(token, ShardRouter(queues, routed), workers, routed, processed))
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+    if worker_died:
+        raise SystemExit(1)
@@ -0,0 +1,135 @@
+# text_matcher.py
+"""
+Поиск всех признаков сообщения за один проход по тексту.
+
+Раньше текст приводился к нижнему регистру в нескольких местах и
+просматривался заново под каждую проверку: упоминание и помощь в
+handle_message, смех и упоминание в Scorer.evaluate, три списка слов для
+реакций. TextMatcher строит один автомат Ахо–Корасик по словарям из
+utils/constants.py (TEXT_LEXICONS) и за один проход находит все признаки,
+поэтому стоимость сообщения не растёт с числом слов в словарях.
+
+Смех (бывший LAUGHTER_PATTERN, r"\b(ха|хах|ахах)+\b") ищется в том же
+проходе: отслеживаются слова только из букв «х» и «а», и лишь такие
+кандидаты проверяются регуляркой целиком.
+
+Пример:
+    features = matcher_for(bot_username).scan(text)
+    if MENTION in features: ...
+"""
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List
+
+from utils.constants import TEXT_LEXICONS
+
+# Признаки, которые возвращает scan()
+MENTION = "mention"          # обращение по имени или @тег
+BOT_TAG = "bot_tag"          # именно @тег бота
+HELP = "help"                # просьба о помощи / списке команд
+REACT_FUNNY = "react_funny"
+REACT_LOVE = "react_love"
+REACT_SHOCK = "react_shock"
+LAUGHTER = "laughter"
+
+LAUGHTER_WORD = re.compile(r"(ха|хах|ахах)+")
+_LAUGHTER_CHARS = frozenset("ха")
+
+# Состояние текущего слова при поиске смеха
+_OUTSIDE, _LAUGH_CANDIDATE, _OTHER_WORD = 0, 1, 2
+
+
+class TextMatcher:
+    """Aho-Corasick automaton over feature lexicons plus laughter detection."""
+
+    def __init__(self, lexicons: Dict[str, Iterable[str]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[FrozenSet[str]] = [frozenset()]
+        for feature, words in lexicons.items():
+            for word in words:
+                self._add(word.lower(), feature)
+        self._build_links()
+        self._alphabet = frozenset(ch for trans in self._goto for ch in trans)
+        # Переходы с уже учтёнными fail-ссылками, достраиваются по мере надобности
+        self._delta: List[Dict[str, int]] = [dict(trans) for trans in self._goto]
+
+    def _add(self, word: str, feature: str) -> None:
+        state = 0
+        for ch in word:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(frozenset())
+            state = nxt
+        self._out[state] = self._out[state] | {feature}
+
+    def _build_links(self) -> None:
+        # Обход в ширину; у узлов первого уровня fail-ссылка — корень
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] | self._out[self._fail[nxt]]
+
+    def _resolve(self, state: int, ch: str) -> int:
+        fail = state
+        while fail and ch not in self._goto[fail]:
+            fail = self._fail[fail]
+        nxt = self._goto[fail].get(ch, 0)
+        self._delta[state][ch] = nxt
+        return nxt
+
+    def scan(self, text: str) -> FrozenSet[str]:
+        """Все признаки, найденные в тексте (регистр не важен)."""
+        text = text.lower()
+        alphabet = self._alphabet
+        delta = self._delta
+        out = self._out
+        hits = set()
+        state = 0
+        word = _OUTSIDE
+        word_start = 0
+        laughter = False
+        for i, ch in enumerate(text):
+            if ch in alphabet:
+                nxt = delta[state].get(ch)
+                state = self._resolve(state, ch) if nxt is None else nxt
+                if out[state]:
+                    hits |= out[state]
+            else:
+                state = 0
+            if ch in _LAUGHTER_CHARS:
+                if word == _OUTSIDE:
+                    word = _LAUGH_CANDIDATE
+                    word_start = i
+            elif ch.isalnum() or ch == "_":
+                word = _OTHER_WORD
+            else:
+                if word == _LAUGH_CANDIDATE and not laughter:
+                    laughter = LAUGHTER_WORD.fullmatch(text, word_start, i) is not None
+                word = _OUTSIDE
+        if word == _LAUGH_CANDIDATE and not laughter:
+            laughter = LAUGHTER_WORD.fullmatch(text, word_start) is not None
+        if laughter:
+            hits.add(LAUGHTER)
+        return frozenset(hits)
+
+
+@lru_cache(maxsize=8)
+def matcher_for(bot_username: str) -> TextMatcher:
+    """Общий автомат для бота: словари из констант плюс @тег бота."""
+    tag = "@" + bot_username.lower()
+    lexicons = {feature: list(words) for feature, words in TEXT_LEXICONS.items()}
+    lexicons.setdefault(MENTION, []).append(tag)
+    lexicons.setdefault(BOT_TAG, []).append(tag)
+    return TextMatcher(lexicons)
@@ -0,0 +1,266 @@
+# tiering.py
+"""
+Холодное хранение данных давно молчащих чатов.
+
+История (до 50 сообщений) и состояние Scorer — самые тяжёлые ключи
+chat_data, и без этого модуля они лежат в памяти у каждого чата, где бот
+когда-либо был. ChatTiering раз в sweep_interval проходит по chat_data и
+у чатов, молчащих дольше idle_after, убирает COLD_KEYS:
+- mode "compress": pickle + zlib, сжатый блоб остаётся в chat_data;
+- mode "spill": блоб уходит в отдельный SQLite-файл, в chat_data остаётся
+  только метка.
+
+Настройки, мьют, счётчики и т. п. остаются как есть, поэтому /status и
+планировщики работают без разморозки. Разморозка прозрачная: TypeHandler
+в группе -1 возвращает ключи до любых хендлеров, автосообщение и праздничная
+рассылка размораживают чат сами (thaw_chat) и только когда действительно
+пишут в него. Чтение из файла (spill) идёт в потоке. Время разморозки
+пишется в гистограмму bot_chat_rehydrate_seconds.
+
+Множество замороженных чатов (gauge bot_frozen_chats) живёт в памяти.
+Чаты, замороженные до перезапуска, persistence отдаёт уже с меткой, и
+учитываются они на ближайшем проходе sweep — до него gauge занижен.
+"""
+import asyncio
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, Optional, Set
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from metrics import REHYDRATE_SECONDS
+from services import SERVICES
+
+# Ключи chat_data, которые уходят в холодное хранение
+COLD_KEYS = ("history", "scoring")
+FROZEN_KEY = "frozen"
+SPILLED = "spilled"
+TIER_COMPRESS = "compress"
+TIER_SPILL = "spill"
+TIER_MODES = (TIER_COMPRESS, TIER_SPILL)
+
+
+class ChatTiering:
+    """Freezes idle chats' history and scoring state, thaws them on demand."""
+
+    # Сколько чатов замораживать между уступками event loop
+    SWEEP_BATCH = 100
+
+    def __init__(
+        self,
+        idle_after: float = 6 * 3600,
+        mode: str = TIER_COMPRESS,
+        path: Optional[str] = None,
+        level: int = 6,
+    ):
+        if mode not in TIER_MODES:
+            raise ValueError(f"Unknown tiering mode {mode!r}")
+        if mode == TIER_SPILL and not path:
+            raise ValueError("Spill mode needs a path")
+        self.idle_after = idle_after
+        self.mode = mode
+        self.level = level
+        self.stats = {"frozen": 0, "thawed": 0, "raw_bytes": 0, "stored_bytes": 0, "failed": 0}
+        self._frozen: Set[int] = set()
+        # Когда чат последний раз размораживали или трогали апдейтом (monotonic)
+        self._touched: Dict[int, float] = {}
+        # Блобы, которые ещё не записаны в файл (spill)
+        self._unwritten: Dict[int, bytes] = {}
+        # Чаты, которые сейчас читаются из файла
+        self._thawing: Dict[int, asyncio.Future] = {}
+        self._conn = None
+        self._db_lock = threading.Lock()
+        if mode == TIER_SPILL:
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cold_chats (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+
+    @classmethod
+    def from_env(cls, suffix: str = "") -> Optional["ChatTiering"]:
+        """None, если TIERING_MODE=off."""
+        mode = os.getenv("TIERING_MODE", TIER_COMPRESS)
+        if mode == "off":
+            return None
+        root, ext = os.path.splitext(os.getenv("TIERING_PATH", "cold_chats.sqlite3"))
+        return cls(
+            idle_after=float(os.getenv("TIERING_IDLE_HOURS", "6")) * 3600,
+            mode=mode,
+            path=root + suffix + ext,
+        )
+
+    def __len__(self) -> int:
+        return len(self._frozen)
+
+    @staticmethod
+    def is_frozen(chat_data: dict) -> bool:
+        return FROZEN_KEY in chat_data
+
+    def _idle(self, chat_id: int, chat_data: dict, now: float) -> bool:
+        touched = self._touched.get(chat_id)
+        if touched is not None and time.monotonic() - touched < self.idle_after:
+            return False
+        last = chat_data.get("last_message_time")
+        # В chat_data время хранится как naive UTC
+        if isinstance(last, datetime) and now - last.replace(tzinfo=timezone.utc).timestamp() < self.idle_after:
+            return False
+        return True
+
+    def freeze(self, chat_id: int, chat_data: dict) -> bool:
+        """Убирает COLD_KEYS чата в сжатый блоб; False, если нечего или не вышло."""
+        if self.is_frozen(chat_data):
+            return False
+        state = {key: chat_data[key] for key in COLD_KEYS if key in chat_data}
+        if not state:
+            return False
+        try:
+            raw = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self.stats["failed"] += 1
+            logging.debug(f"[TIERING] Chat {chat_id} state is not picklable, kept in memory")
+            return False
+        blob = zlib.compress(raw, self.level)
+        for key in state:
+            del chat_data[key]
+        if self.mode == TIER_SPILL:
+            self._unwritten[chat_id] = blob
+            chat_data[FROZEN_KEY] = SPILLED
+        else:
+            chat_data[FROZEN_KEY] = blob
+        self._frozen.add(chat_id)
+        self._touched.pop(chat_id, None)
+        self.stats["frozen"] += 1
+        self.stats["raw_bytes"] += len(raw)
+        self.stats["stored_bytes"] += len(blob)
+        return True
+
+    def _read(self, chat_id: int) -> Optional[bytes]:
+        with self._db_lock:
+            row = self._conn.execute("SELECT data FROM cold_chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    async def thaw(self, chat_id: int, chat_data: dict) -> bool:
+        """Возвращает замороженные ключи чата в chat_data."""
+        self._touched[chat_id] = time.monotonic()
+        thawing = self._thawing.get(chat_id)
+        if thawing is not None:
+            # Чат уже размораживается для апдейта или джобы — ждём ту же разморозку
+            await asyncio.shield(thawing)
+            return False
+        if not self.is_frozen(chat_data):
+            return False
+        start = time.perf_counter()
+        frozen = chat_data.pop(FROZEN_KEY)
+        self._frozen.discard(chat_id)
+        if frozen == SPILLED:
+            blob = self._unwritten.pop(chat_id, None)
+            if blob is None and self._conn is not None:
+                thawing = self._thawing[chat_id] = asyncio.get_running_loop().create_future()
+                try:
+                    blob = await asyncio.to_thread(self._read, chat_id)
+                except BaseException:
+                    # Метку возвращаем: данные в файле целы, разморозим в следующий раз
+                    chat_data[FROZEN_KEY] = SPILLED
+                    self._frozen.add(chat_id)
+                    raise
+                finally:
+                    del self._thawing[chat_id]
+                    # Ждущие продолжат не раньше, чем ключи ниже вернутся в chat_data
+                    thawing.set_result(None)
+        else:
+            blob = frozen
+        if blob is None:
+            logging.error(f"[TIERING] No cold state for chat {chat_id}, starting fresh")
+            return False
+        try:
+            state = pickle.loads(zlib.decompress(blob))
+        except Exception:
+            logging.exception(f"[TIERING] Failed to thaw chat {chat_id}")
+            return False
+        # То, что успели создать после заморозки, важнее старого
+        for key, value in state.items():
+            chat_data.setdefault(key, value)
+        self.stats["thawed"] += 1
+        REHYDRATE_SECONDS.observe(time.perf_counter() - start)
+        return True
+
+    def _write(self, rows: list) -> None:
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO cold_chats (chat_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def sweep(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Джоба: замораживает все чаты, молчащие дольше idle_after."""
+        start = time.perf_counter()
+        now = time.time()
+        frozen = 0
+        for chat_id, chat_data in list(context.application.chat_data.items()):
+            if self.is_frozen(chat_data):
+                # Заморожен до перезапуска и загружен из persistence
+                self._frozen.add(chat_id)
+                continue
+            if not self._idle(chat_id, chat_data, now):
+                continue
+            if self.freeze(chat_id, chat_data):
+                frozen += 1
+                if frozen % self.SWEEP_BATCH == 0:
+                    await asyncio.sleep(0)
+        if self._unwritten:
+            rows = list(self._unwritten.items())
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception:
+                # Блобы остаются в памяти, запись повторится на следующем проходе
+                logging.exception("[TIERING] Spill failed")
+            else:
+                for chat_id, blob in rows:
+                    if self._unwritten.get(chat_id) is blob:
+                        del self._unwritten[chat_id]
+        if frozen:
+            logging.info(f"[TIERING] Froze {frozen} idle chats in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    async def on_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """TypeHandler (группа -1): размораживает чат до остальных хендлеров."""
+        if context.chat_data is not None and update.effective_chat is not None:
+            await self.thaw(update.effective_chat.id, context.chat_data)
+
+    def summary(self) -> str:
+        return (
+            f"{len(self)} заморожено ({self.mode}), заморозок {self.stats['frozen']}, "
+            f"разморозок {self.stats['thawed']}, сжатие {self.stats['raw_bytes'] // 1024}"
+            f"→{self.stats['stored_bytes'] // 1024} КБ"
+        )
+
+    def close(self) -> None:
+        if self._unwritten and self._conn is not None:
+            try:
+                self._write(list(self._unwritten.items()))
+                self._unwritten.clear()
+            except Exception:
+                logging.exception("[TIERING] Final spill failed")
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.close()
+            self._conn = None
+
+
+async def thaw_chat(chat_id: int, chat_data: dict) -> None:
+    """Разморозка для джоб, которые работают с chat_data без апдейта."""
+    tiering = SERVICES.get("tiering")
+    if tiering is not None:
+        await tiering.thaw(chat_id, chat_data)
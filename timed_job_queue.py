@@ -0,0 +1,53 @@
+# timed_job_queue.py
+"""
+JobQueue, которая меряет опоздание каждой джобы.
+
+Через job queue идут отложенные ответы, склейка сообщений, автосообщения,
+заморозка чатов и праздничная рассылка; если event loop перегружен, все
+они начинают срабатывать позже срока. Опоздание (фактический запуск минус
+плановое время) пишется в гистограмму bot_job_lag_seconds.
+
+Плановое время первого запуска берётся из триггера (run_once — дата,
+run_repeating — start_date), следующих — из next_run_time, которое
+APScheduler выставляет к моменту запуска предыдущего.
+"""
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from telegram.ext import Job, JobQueue
+
+from metrics import JOB_LAG_SECONDS
+
+
+class TimedJobQueue(JobQueue):
+    """JobQueue that records how late each job starts."""
+
+    def __init__(self):
+        super().__init__()
+        # id джобы APScheduler -> плановое время следующего запуска
+        self._next_due: Dict[str, datetime] = {}
+
+    def _due(self, job: Job) -> Optional[datetime]:
+        scheduled = job.job
+        due = self._next_due.pop(scheduled.id, None)
+        if due is not None:
+            return due
+        trigger = scheduled.trigger
+        if isinstance(trigger, DateTrigger):
+            return trigger.run_date
+        if isinstance(trigger, IntervalTrigger):
+            return trigger.start_date
+        # Первый запуск run_daily и прочих cron-джоб не меряем
+        return None
+
+    @staticmethod
+    async def job_callback(job_queue: "TimedJobQueue", job: Job) -> None:
+        due = job_queue._due(job)
+        if due is not None:
+            JOB_LAG_SECONDS.observe(max((datetime.now(timezone.utc) - due).total_seconds(), 0.0))
+        next_run = job.job.next_run_time
+        if next_run is not None and not isinstance(job.job.trigger, DateTrigger):
+            job_queue._next_due[job.job.id] = next_run
+        await JobQueue.job_callback(job_queue, job)
@@ -0,0 +1,152 @@
+# topic_pool.py
+"""
+Запас заранее придуманных тем для автосообщений.
+
+send_self_message раньше делал два запроса к LLM подряд: тему, потом сам
+пост. Теперь тема берётся из пула, а пул пополняется в фоне, так что на
+пути автосообщения остаётся один запрос.
+
+- Ключ пула — (хэш системного промпта, тип контента): после /set_prompt
+  старые темы не используются, а ключи старых промптов вытесняются LRU.
+- На ключ хранится не больше size тем, у каждой есть срок жизни ttl;
+  темы типов из DATED_TYPES зависят от даты и праздников и истекают в
+  ближайшую полночь UTC.
+- Пополнение идёт отдельной задачей на ключ, с приоритетом BACKGROUND, и
+  только когда idle() говорит, что очередь LLM пуста.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+CONTENT_TYPES = ("шутку", "анекдот", "ситуацию")
+# Темы с датой и праздниками внутри промпта
+DATED_TYPES = frozenset({"ситуацию"})
+
+TopicKey = Tuple[str, str]
+
+
+def _next_midnight(now: float) -> float:
+    day = datetime.fromtimestamp(now, tz=timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (day + timedelta(days=1)).timestamp()
+
+
+class TopicPool:
+    """Bounded, expiring per-prompt pool of autopost topics refilled in the background."""
+
+    def __init__(
+        self,
+        size: int = 3,
+        ttl: float = 24 * 3600,
+        max_prompts: int = 8,
+        idle: Optional[Callable[[], bool]] = None,
+        idle_wait: float = 30.0,
+        max_failures: int = 3,
+    ):
+        self.size = size
+        self.ttl = ttl
+        self.max_prompts = max_prompts
+        self.idle = idle
+        self.idle_wait = idle_wait
+        self.max_failures = max_failures
+        self.stats = {"hits": 0, "misses": 0, "generated": 0, "expired": 0}
+        # хэш промпта -> {тип контента -> deque[(тема, expires_at)]}
+        self._pools: "OrderedDict[str, Dict[str, deque]]" = OrderedDict()
+        self._tasks: Dict[TopicKey, asyncio.Task] = {}
+
+    @classmethod
+    def from_env(cls) -> "TopicPool":
+        return cls(
+            size=int(os.getenv("TOPIC_POOL_SIZE", "3")),
+            ttl=float(os.getenv("TOPIC_TTL", str(24 * 3600))),
+        )
+
+    @staticmethod
+    def key(system_prompt: str, content_type: str) -> TopicKey:
+        return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16], content_type
+
+    def __len__(self) -> int:
+        return sum(len(topics) for pools in self._pools.values() for topics in pools.values())
+
+    def expires_at(self, content_type: str, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        expires = now + self.ttl
+        if content_type in DATED_TYPES:
+            expires = min(expires, _next_midnight(now))
+        return expires
+
+    def _topics(self, key: TopicKey) -> deque:
+        prompt, content_type = key
+        pools = self._pools.get(prompt)
+        if pools is None:
+            pools = self._pools[prompt] = {}
+            while len(self._pools) > self.max_prompts:
+                self._pools.popitem(last=False)
+        self._pools.move_to_end(prompt)
+        topics = pools.get(content_type)
+        if topics is None:
+            topics = pools[content_type] = deque()
+        return topics
+
+    def _fresh(self, key: TopicKey) -> deque:
+        """Темы ключа без истёкших (они сразу выбрасываются)."""
+        topics = self._topics(key)
+        now = time.time()
+        while topics and topics[0][1] <= now:
+            topics.popleft()
+            self.stats["expired"] += 1
+        return topics
+
+    def put(self, key: TopicKey, topic: str) -> None:
+        topics = self._fresh(key)
+        if len(topics) < self.size:
+            topics.append((topic, self.expires_at(key[1])))
+
+    def take(self, key: TopicKey) -> Optional[str]:
+        """Самая старая свежая тема или None, если пул ключа пуст."""
+        topics = self._fresh(key)
+        if not topics:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return topics.popleft()[0]
+
+    def refill(self, key: TopicKey, generate: Callable[[], Awaitable[Optional[str]]]) -> None:
+        """Запускает фоновое пополнение ключа, если оно ещё не идёт."""
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            return
+        self._tasks[key] = asyncio.get_running_loop().create_task(self._refill(key, generate))
+
+    async def _refill(self, key: TopicKey, generate: Callable[[], Awaitable[Optional[str]]]) -> None:
+        failures = 0
+        try:
+            while len(self._fresh(key)) < self.size and failures < self.max_failures:
+                if self.idle is not None and not self.idle():
+                    await asyncio.sleep(self.idle_wait)
+                    continue
+                try:
+                    topic = await generate()
+                except Exception as e:
+                    logging.warning(f"[TOPICS] Prefetch for {key[1]} failed: {type(e).__name__}: {e}")
+                    topic = None
+                if not topic:
+                    failures += 1
+                    await asyncio.sleep(self.idle_wait)
+                    continue
+                self.stats["generated"] += 1
+                self.put(key, topic)
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
@@ -0,0 +1,66 @@
+# update_processor.py
+"""
+Обработчик апдейтов, который сохраняет порядок внутри одного чата, но
+позволяет разным чатам обрабатываться параллельно.
+
+Пока один чат ждёт ответа от LLM, апдейты из остальных чатов продолжают
+обрабатываться. Общее число одновременно обрабатываемых апдейтов ограничено
+max_concurrent_updates; слот занимает только апдейт, который реально
+выполняется, а не ждёт своей очереди в чате.
+"""
+import asyncio
+from typing import Awaitable, Dict, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATE_SECONDS, UPDATES_IN_FLIGHT
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Concurrent across chats, sequential within a chat."""
+
+    def __init__(self, max_concurrent_updates: int = 256):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiters: Dict[int, int] = {}
+
+    @staticmethod
+    def _chat_id(update: object) -> Optional[int]:
+        chat = getattr(update, "effective_chat", None)
+        return chat.id if chat is not None else None
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        # Базовый process_update берёт слот семафора до do_process_update, и
+        # апдейты, стоящие за медленным чатом, держали бы глобальные слоты,
+        # не давая работать другим чатам. Поэтому сначала замок чата, потом слот.
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._waiters[chat_id] = self._waiters.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            # Удаляем замок, когда чат больше никто не ждёт, чтобы не копить их
+            self._waiters[chat_id] -= 1
+            if not self._waiters[chat_id]:
+                del self._waiters[chat_id]
+                del self._locks[chat_id]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        UPDATES_IN_FLIGHT.inc()
+        try:
+            with UPDATE_SECONDS.time():
+                await coroutine
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -1,5 +1,12 @@
 # constants.py
 
+# Праздники. Фиксированные заданы датой "ДД-ММ"; у плавающих в "date" —
+# описание для людей, а дата вычисляется по "rule" (см. holiday_evaluator.py):
+#   {"type": "easter", "offset": N}                  — N дней от православной Пасхи
+#   {"type": "day_of_year", "day": N}                — N-й день года
+#   {"type": "nth_weekday", "month", "weekday", "n"} — n-й день недели месяца (weekday: 0 — пн)
+#   {"type": "last_weekday", "month", "weekday"}     — последний такой день недели месяца
+
 RUSSIAN_HOLIDAYS = [
     {"name": "Новый год", "date": "01-01", 'float_date': False},
     {"name": "Канун Нового года", "date": "31-12", 'float_date': False},
@@ -14,17 +21,35 @@ RUSSIAN_HOLIDAYS = [
     {"name": "День России", "date": "12-06", 'float_date': False},
     {"name": "День ВДВ", "date": "02-08", 'float_date': False},
     {"name": "День знаний", "date": "01-09", 'float_date': False},
-    {"name": "День программиста", "date": "256-й день года (13-09 или 12-09)", 'float_date': True},
+    {"name": "День программиста", "date": "256-й день года (13-09 или 12-09)", 'float_date': True,
+     "rule": {"type": "day_of_year", "day": 256}},
     {"name": "День учителя", "date": "05-10", 'float_date': False},
     {"name": "День народного единства", "date": "04-11", 'float_date': False},
     {"name": "День военного разведчика", "date": "05-11", 'float_date': False},
     {"name": "День Конституции РФ", "date": "12-12", 'float_date': False},
-    {"name": "День матери", "date": "последнее воскресенье ноября", 'float_date': True},
-    {"name": "Масленица", "date": "плавающая (февраль/март, за 7 недель до Пасхи)", 'float_date': True},
-    {"name": "Пасха (православная)", "date": "плавающая (март/апрель)", 'float_date': True},
-    {"name": "Радоница", "date": "вторник после Пасхи", 'float_date': True},
-    {"name": "Троица (Пятидесятница)", "date": "на 50-й день после Пасхи", 'float_date': True},
-    {"name": "День ПВО", "date": "второе воскресенье апреля", 'float_date': True},
+    {"name": "День матери", "date": "последнее воскресенье ноября", 'float_date': True,
+     "rule": {"type": "last_weekday", "month": 11, "weekday": 6}},
+    {"name": "Масленица", "date": "плавающая (февраль/март, за 7 недель до Пасхи)", 'float_date': True,
+     "rule": {"type": "easter", "offset": -49}},
+    {"name": "Пасха (православная)", "date": "плавающая (март/апрель)", 'float_date': True,
+     "rule": {"type": "easter", "offset": 0}},
+    {"name": "Радоница", "date": "вторник после Пасхи", 'float_date': True,
+     "rule": {"type": "easter", "offset": 9}},
+    {"name": "Троица (Пятидесятница)", "date": "на 50-й день после Пасхи", 'float_date': True,
+     "rule": {"type": "easter", "offset": 49}},
+    {"name": "День ПВО", "date": "второе воскресенье апреля", 'float_date': True,
+     "rule": {"type": "nth_weekday", "month": 4, "weekday": 6, "n": 2}},
     {"name": "Хэллоуин", "date": "31-10", 'float_date': False},
     {"name": "День арбуза", "date": "03-08", 'float_date': False}
 ]
+
+# Словари признаков для TextMatcher (text_matcher.py): признак -> подстроки.
+# Регистр не важен; @тег бота добавляется к "mention" и "bot_tag" автоматически,
+# смех ищется отдельным правилом. Новые слова можно добавлять без потери скорости.
+TEXT_LEXICONS = {
+    "mention": ["роберт"],
+    "help": ["помощь", "команды", "help", "команда"],
+    "react_funny": ["ахах", "хаха", "смешно", "рж", "лол"],
+    "react_love": ["спасибо", "красава", "огонь", "топ"],
+    "react_shock": ["жесть", "пиздец", "капец", "ужас"],
+}
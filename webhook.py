@@ -0,0 +1,135 @@
+# webhook.py
+"""
+Режим webhook: Telegram сам присылает апдейты POST-запросами.
+
+Сервер на tornado принимает JSON апдейта по WEBHOOK_PATH, проверяет
+заголовок X-Telegram-Bot-Api-Secret-Token и передаёт словарь апдейта в
+sink (в обычном режиме — в update_queue приложения). Если sink не смог
+разобрать апдейт, он бросает BadUpdate и сервер отвечает 400: повторная
+доставка того же тела ничего не изменит. Остальные ошибки sink дают 500,
+и Telegram пришлёт апдейт ещё раз. Дополнительно есть
+/healthz (процесс жив) и /readyz (бот инициализирован и принимает апдейты).
+
+Локально можно проверить без Telegram:
+    curl -X POST -H 'Content-Type: application/json' \\
+         -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' \\
+         --data @update.json http://127.0.0.1:8443/telegram
+"""
+import hmac
+import json
+import logging
+import os
+import ssl
+from typing import Awaitable, Callable, Optional
+
+import tornado.httpserver
+import tornado.web
+
+UpdateSink = Callable[[dict], Awaitable[None]]
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class BadUpdate(ValueError):
+    """Raised by a sink when the update dict cannot be parsed."""
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, sink: UpdateSink, secret_token: Optional[str]) -> None:
+        self.sink = sink
+        self.secret_token = secret_token
+
+    async def post(self) -> None:
+        if self.secret_token:
+            received = self.request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(received, self.secret_token):
+                self.set_status(403)
+                return
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        if not isinstance(data, dict):
+            self.set_status(400)
+            return
+        try:
+            await self.sink(data)
+        except BadUpdate as exc:
+            logging.warning(f"[WEBHOOK] Отброшен битый апдейт: {exc}")
+            self.set_status(400)
+            return
+        self.set_status(200)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self) -> None:
+        self.write("ok")
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    def initialize(self, is_ready: Callable[[], bool]) -> None:
+        self.is_ready = is_ready
+
+    def get(self) -> None:
+        if self.is_ready():
+            self.write("ready")
+        else:
+            self.set_status(503)
+            self.write("not ready")
+
+
+class WebhookServer:
+    """Tornado server with the webhook endpoint and health/readiness probes."""
+
+    def __init__(
+        self,
+        sink: UpdateSink,
+        is_ready: Callable[[], bool],
+        listen: str = "0.0.0.0",
+        port: int = 8443,
+        url_path: str = "/telegram",
+        secret_token: Optional[str] = None,
+        cert: Optional[str] = None,
+        key: Optional[str] = None,
+    ):
+        self.listen = listen
+        self.port = port
+        self.url_path = "/" + url_path.lstrip("/")
+        self.secret_token = secret_token
+        self.cert = cert
+        self.key = key
+        self._app = tornado.web.Application([
+            (self.url_path, WebhookHandler, {"sink": sink, "secret_token": secret_token}),
+            (r"/healthz", HealthHandler),
+            (r"/readyz", ReadyHandler, {"is_ready": is_ready}),
+        ])
+        self._server: Optional[tornado.httpserver.HTTPServer] = None
+
+    @classmethod
+    def from_env(cls, sink: UpdateSink, is_ready: Callable[[], bool]) -> "WebhookServer":
+        return cls(
+            sink,
+            is_ready,
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            url_path=os.getenv("WEBHOOK_PATH", "/telegram"),
+            secret_token=os.getenv("WEBHOOK_SECRET") or None,
+            cert=os.getenv("WEBHOOK_CERT") or None,
+            key=os.getenv("WEBHOOK_KEY") or None,
+        )
+
+    def start(self) -> None:
+        ssl_options = None
+        if self.cert:
+            ssl_options = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_options.load_cert_chain(self.cert, self.key)
+        self._server = tornado.httpserver.HTTPServer(self._app, ssl_options=ssl_options)
+        self._server.listen(self.port, address=self.listen)
+        logging.info(f"Webhook server listening on {self.listen}:{self.port}{self.url_path}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None